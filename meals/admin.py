@@ -1,11 +1,18 @@
 from django.contrib import admin
-from .models import Student, Meal, MealConsumption
+from . import dietary, search
+from .models import Student, Meal, MealConsumption, DietaryTag, ServingDay, ReportJob, School
 
 @admin.register(Student)
 class StudentAdmin(admin.ModelAdmin):
     list_display = ('student_id', 'name', 'grade', 'dietary_restrictions', 'created_at')
     search_fields = ('student_id', 'name', 'grade')
     list_filter = ('grade', 'created_at')
+    # Parsed from dietary_restrictions on save
+    readonly_fields = ('dietary_tags',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # The full-text index covers search_fields; nothing is duplicated by its filter
+        return search.search(queryset, search_term), False
 
 @admin.register(Meal)
 class MealAdmin(admin.ModelAdmin):
@@ -13,6 +20,17 @@ class MealAdmin(admin.ModelAdmin):
     search_fields = ('name', 'description')
     list_filter = ('meal_type', 'serving_date')
     date_hierarchy = 'serving_date'
+    filter_horizontal = ('allergen_tags',)
+    actions = ['finalize_serving_days']
+
+    def get_search_results(self, request, queryset, search_term):
+        return search.search(queryset, search_term), False
+
+    @admin.action(description='Finalize the menu of the selected meals\' serving days')
+    def finalize_serving_days(self, request, queryset):
+        days = sorted(set(queryset.values_list('serving_date', flat=True)))
+        conflicts = sum(dietary.build_day(day) for day in days)
+        self.message_user(request, f'Finalized {len(days)} serving day(s) with {conflicts} dietary conflict(s).')
 
 @admin.register(MealConsumption)
 class MealConsumptionAdmin(admin.ModelAdmin):
@@ -20,3 +38,24 @@ class MealConsumptionAdmin(admin.ModelAdmin):
     search_fields = ('student__name', 'meal__name')
     list_filter = ('consumed_at', 'portion_consumed')
     date_hierarchy = 'consumed_at'
+
+@admin.register(DietaryTag)
+class DietaryTagAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+
+@admin.register(ServingDay)
+class ServingDayAdmin(admin.ModelAdmin):
+    list_display = ('date', 'finalized_at')
+    date_hierarchy = 'date'
+
+@admin.register(ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'created_at', 'finished_at')
+    list_filter = ('name', 'status')
+    readonly_fields = ('params_key', 'version', 'started_at', 'finished_at')
+
+@admin.register(School)
+class SchoolAdmin(admin.ModelAdmin):
+    list_display = ('name', 'code')
+    search_fields = ('name', 'code')
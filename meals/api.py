@@ -0,0 +1,282 @@
+"""Read-only JSON API, version 1 (``/meals/api/v1/``).
+
+List endpoints serialize straight from ``values_list`` rows, never building
+model instances.  ``?fields=a,b`` picks the columns, the resource's filter
+form validates the other parameters, and pages are keyset-paginated: the
+``next`` link carries an opaque ``after`` cursor of the page's last row.
+
+Responses carry an ETag derived from the request parameters and the data
+versions of the tables involved (the Counter rows behind the report cache),
+and a Last-Modified of when those versions were last bumped.  A conditional
+GET whose validators still match is answered 304 from that one query.
+
+In the district view (see ``meals.sharding``) reports merge every school's
+share, lists merge every school's page in key order and tag each row with its
+``school``, and the ETag covers every school's data versions.
+"""
+import base64
+import hashlib
+import json
+
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET
+
+from . import exports, reports, search, sharding
+from .forms import ConsumptionApiForm, MealApiForm, StudentApiForm, WasteReportForm
+from .models import Meal, MealConsumption, Student
+from .pagination import decode_cursor, encode_cursor
+
+DEFAULT_LIMIT = 100
+
+
+class Resource:
+    """A listable table: public field names mapped to ORM paths, its filter form and data versions."""
+
+    model = None
+    fields = {}
+    form_class = None
+    versions = []
+
+    def filter(self, queryset, _data):
+        """Hook applying the validated filter parameters; the base resource lists every row."""
+        return queryset
+
+    # Keyset pagination on the primary key; subclasses may seek on another indexed key
+    key_fields = ['id']
+    descending = False
+
+    def decode(self, cursor):
+        """The key of the row ``cursor`` names, as a tuple in ``key_fields`` order."""
+        try:
+            return (int(json.loads(_b64decode(cursor))[0]),)
+        except (ValueError, TypeError, IndexError, KeyError) as exc:
+            raise ValueError('Invalid cursor.') from exc
+
+    def seek(self, queryset, cursor, inclusive=False):
+        """``queryset`` in key order from the row after ``cursor``, or from that row itself if ``inclusive``."""
+        if cursor:
+            last_id, = self.decode(cursor)
+            queryset = queryset.filter(id__gte=last_id) if inclusive else queryset.filter(id__gt=last_id)
+        return queryset.order_by('id')
+
+    def cursor(self, key):
+        return base64.urlsafe_b64encode(json.dumps([key['id']]).encode()).decode().rstrip('=')
+
+
+class StudentResource(Resource):
+    model = Student
+    fields = {
+        'id': 'id',
+        'student_id': 'student_id',
+        'name': 'name',
+        'grade': 'grade',
+        'dietary_restrictions': 'dietary_restrictions',
+        'created_at': 'created_at',
+    }
+    form_class = StudentApiForm
+    versions = [reports.STUDENTS]
+
+    def filter(self, queryset, data):
+        if data.get('grade'):
+            queryset = queryset.filter(grade=data['grade'])
+        if data.get('student_id'):
+            queryset = queryset.filter(student_id=data['student_id'])
+        if data.get('q'):
+            queryset = search.search(queryset, data['q'])
+        return queryset
+
+
+class MealResource(Resource):
+    model = Meal
+    fields = {
+        name: name for name in [
+            'id', 'name', 'description', 'meal_type', 'serving_date', 'calories', 'protein', 'carbohydrates',
+            'fats', 'protein_pct', 'carbohydrates_pct', 'fats_pct', 'created_at',
+        ]
+    }
+    form_class = MealApiForm
+    versions = [reports.MEALS]
+
+    def filter(self, queryset, data):
+        if data.get('meal_type'):
+            queryset = queryset.filter(meal_type=data['meal_type'])
+        if data.get('serving_date'):
+            queryset = queryset.filter(serving_date=data['serving_date'])
+        if data.get('date_from'):
+            queryset = queryset.filter(serving_date__gte=data['date_from'])
+        if data.get('date_to'):
+            queryset = queryset.filter(serving_date__lte=data['date_to'])
+        if data.get('q'):
+            queryset = search.search(queryset, data['q'])
+        return queryset
+
+
+class ConsumptionResource(Resource):
+    model = MealConsumption
+    # Same names as the consumption export; student and meal columns are joined only when asked for
+    fields = exports.CONSUMPTION_FIELDS
+    form_class = ConsumptionApiForm
+    versions = [reports.CONSUMPTIONS, reports.STUDENTS, reports.MEALS]
+    key_fields = ['consumed_at', 'id']
+
+    def filter(self, queryset, data):
+        if data.get('student'):
+            queryset = queryset.filter(student_id=data['student'])
+        if data.get('meal'):
+            queryset = queryset.filter(meal_id=data['meal'])
+        return exports.filter_consumptions(queryset, data.get('date_from'), data.get('date_to'), data.get('meal_type'))
+
+    descending = True
+
+    def decode(self, cursor):
+        key = decode_cursor(cursor)
+        if key is None:
+            raise ValueError('Invalid cursor.')
+        return key
+
+    def seek(self, queryset, cursor, inclusive=False):
+        # Newest first through the (consumed_at) and (student|meal, consumed_at) indexes, like the history pages
+        if cursor:
+            consumed_at, pk = self.decode(cursor)
+            same_time = Q(consumed_at=consumed_at, id__lte=pk) if inclusive else Q(consumed_at=consumed_at, id__lt=pk)
+            queryset = queryset.filter(Q(consumed_at__lt=consumed_at) | same_time)
+        return queryset.order_by('-consumed_at', '-id')
+
+    def cursor(self, key):
+        return encode_cursor(key['consumed_at'], key['id'])
+
+
+def _b64decode(cursor):
+    return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+
+
+def _district_cursor(code, cursor):
+    return base64.urlsafe_b64encode(json.dumps([code, cursor]).encode()).decode().rstrip('=')
+
+
+def _decode_district_cursor(cursor):
+    """(school code, that school's cursor) of a district cursor, or (None, None) when there is none."""
+    if not cursor:
+        return None, None
+    try:
+        code, school_cursor = json.loads(_b64decode(cursor))
+    except (ValueError, TypeError) as exc:
+        raise ValueError('Invalid cursor.') from exc
+    if not isinstance(code, str) or not isinstance(school_cursor, str):
+        raise ValueError('Invalid cursor.')
+    return code, school_cursor
+
+
+RESOURCES = {
+    'students': StudentResource(),
+    'meals': MealResource(),
+    'consumptions': ConsumptionResource(),
+}
+
+
+def _conditional(request, names, build):
+    """Answer 304 if the client's validators match the data versions of ``names``, else ``build()``'s JSON."""
+    version, last_modified = reports.current_data_state(names)
+    params = sorted((key, value) for key, values in request.GET.lists() for value in values)
+    # Schools have their own data versions, so the selected school's database is part of the tag
+    digest = hashlib.md5(json.dumps([request.path, sharding.current_database(), version, params]).encode()).hexdigest()
+    etag = f'"{digest}"'
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        body, status = build()
+        response = JsonResponse(body, status=status)
+        if status != 200:
+            return response
+    response['ETag'] = etag
+    if timestamp is not None:
+        response['Last-Modified'] = http_date(timestamp)
+    return response
+
+
+@sharding.district_view
+@require_GET
+def resource_list(request, resource):
+    resource = RESOURCES[resource]
+    form = resource.form_class(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    requested = [name for name in request.GET.get('fields', '').split(',') if name] or list(resource.fields)
+    unknown = [name for name in requested if name not in resource.fields]
+    if unknown:
+        return JsonResponse({'errors': {'fields': [f'Unknown field: {name}' for name in unknown]}}, status=400)
+
+    # The pagination key is fetched alongside the requested columns
+    paths = [resource.fields[name] for name in requested] + resource.key_fields
+
+    def next_url(after):
+        params = request.GET.copy()
+        params['after'] = after
+        return f'{request.path}?{params.urlencode()}'
+
+    def build():
+        data = form.cleaned_data
+        limit = data.get('limit') or DEFAULT_LIMIT
+        queryset = resource.filter(resource.model.objects.all(), data)
+        try:
+            queryset = resource.seek(queryset, data.get('after'))
+        except ValueError as e:
+            return {'errors': {'after': [str(e)]}}, 400
+        rows = list(queryset.values_list(*paths)[:limit + 1])
+
+        results = [dict(zip(requested, row)) for row in rows[:limit]]
+        after = None
+        if len(rows) > limit:
+            after = resource.cursor(dict(zip(resource.key_fields, rows[limit - 1][len(requested):])))
+        return {'results': results, 'next': next_url(after) if after else None}, 200
+
+    def build_district():
+        data = form.cleaned_data
+        limit = data.get('limit') or DEFAULT_LIMIT
+        try:
+            # Every school seeks to the key of the last row served, whichever school it came from
+            last_code, school_cursor = _decode_district_cursor(data.get('after'))
+            last_key = resource.decode(school_cursor) if school_cursor else None
+        except ValueError as e:
+            return {'errors': {'after': [str(e)]}}, 400
+
+        def school_page():
+            # Rows with the last key from schools ordered after its school come next, so the seek keeps that key
+            queryset = resource.seek(resource.filter(resource.model.objects.all(), data), school_cursor,
+                                     inclusive=True)
+            return list(queryset.values_list(*paths)[:limit + 2])
+
+        rows = [
+            (school.code, row) for school, page in sharding.fan_out(school_page) for row in page
+            if last_key is None or tuple(row[len(requested):]) != last_key or school.code > last_code
+        ]
+        # In key order, then by school for rows with the same key
+        rows.sort(key=lambda item: item[0])
+        rows.sort(key=lambda item: item[1][len(requested):], reverse=resource.descending)
+
+        results = [{**dict(zip(requested, row)), 'school': code} for code, row in rows[:limit]]
+        after = None
+        if len(rows) > limit:
+            code, row = rows[limit - 1]
+            after = _district_cursor(code, resource.cursor(dict(zip(resource.key_fields, row[len(requested):]))))
+        return {'results': results, 'next': next_url(after) if after else None}, 200
+
+    return _conditional(request, resource.versions, build_district if sharding.is_district() else build)
+
+
+@sharding.district_view
+@require_GET
+def report(request, name):
+    params = {}
+    if name == 'waste':
+        form = WasteReportForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        params = form.cleaned_data
+    _, versions = reports.REPORTS[name]
+    get_report = reports.get_district_report if sharding.is_district() else reports.get_report
+    return _conditional(request, versions, lambda: (get_report(name, **params), 200))
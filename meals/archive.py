@@ -0,0 +1,317 @@
+"""Columnar archive of consumptions from closed school terms.
+
+``archive_before`` copies every consumption older than a cutoff into a
+segment directory of NumPy ``.npy`` column files, sorted by ``consumed_at``
+(microseconds since the epoch, UTC; a missing waste weight is NaN), and
+records it in ``index.json``; each school database has its own archive
+directory.  ``delete_archived`` then removes exactly those
+rows from the live table with raw deletes, so the rollups and counters, which
+already include them, are left alone.
+
+Readers open the columns memory-mapped and walk them a bounded chunk at a
+time with ``iter_chunks``, using binary search on the sorted timestamps to
+touch only the requested date range.  NumPy is needed to read or write the
+archive.
+"""
+import heapq
+import json
+import os
+import shutil
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router, transaction
+from django.utils import timezone
+
+from . import exports
+from .models import MealConsumption
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is an optional dependency
+    np = None
+
+COLUMNS = {
+    'id': 'int64',
+    'student_id': 'int64',
+    'meal_id': 'int64',
+    'consumed_at': 'int64',
+    'portion_consumed': 'float64',
+    'waste_weight': 'float64',
+}
+INDEX_FILE = 'index.json'
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Rows materialised at once when reading a segment
+CHUNK_ROWS = 1_000_000
+# Ids per DELETE statement, below SQLite's bound parameter limit
+DELETE_BATCH_SIZE = 500
+DELETES_PER_TRANSACTION = 20
+
+
+def get_archive_dir():
+    archive_dir = Path(getattr(settings, 'MEALS_ARCHIVE_DIR', Path(settings.BASE_DIR) / 'var' / 'archive'))
+    # Each school database keeps its own segments, like the write-behind logs
+    database = router.db_for_write(MealConsumption)
+    return archive_dir if database == 'default' else archive_dir / database
+
+
+def to_micros(moment):
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def read_index(archive_dir=None):
+    path = (archive_dir or get_archive_dir()) / INDEX_FILE
+    try:
+        return json.loads(path.read_text(encoding='utf-8'))['segments']
+    except FileNotFoundError:
+        return []
+
+
+def _write_index(archive_dir, segments):
+    staging = archive_dir / (INDEX_FILE + '.tmp')
+    staging.write_text(json.dumps({'segments': segments}, indent=2), encoding='utf-8')
+    os.replace(staging, archive_dir / INDEX_FILE)
+
+
+class Segment:
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self._columns = {}
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(self.path / f'{name}.npy', mmap_mode='r')
+        return self._columns[name]
+
+    def overlaps(self, start=None, end=None):
+        return ((end is None or self.meta['first_consumed_at'] < end)
+                and (start is None or self.meta['last_consumed_at'] >= start))
+
+    def rows_between(self, start=None, end=None):
+        """Slice of the rows with start <= consumed_at < end (microseconds; None is unbounded)."""
+        times = self.column('consumed_at')
+        first = 0 if start is None else int(np.searchsorted(times, start, side='left'))
+        last = len(times) if end is None else int(np.searchsorted(times, end, side='left'))
+        return slice(first, last)
+
+
+def segments(archive_dir=None):
+    archive_dir = archive_dir or get_archive_dir()
+    index = read_index(archive_dir)
+    if index and np is None:
+        raise ImproperlyConfigured('NumPy is required to read the consumption archive')
+    return [Segment(archive_dir / meta['name'], meta) for meta in index]
+
+
+def _segment_chunks(segment, columns, start, end, chunk_rows):
+    rows = segment.rows_between(start, end)
+    for first in range(rows.start, rows.stop, chunk_rows):
+        part = slice(first, min(first + chunk_rows, rows.stop))
+        yield {name: np.asarray(segment.column(name)[part]) for name in columns}
+
+
+def iter_chunks(columns, start=None, end=None, chunk_rows=CHUNK_ROWS):
+    """Yield {column: array} for archived consumptions with start <= consumed_at < end, chunk by chunk."""
+    for segment in segments():
+        if segment.overlaps(start, end):
+            yield from _segment_chunks(segment, columns, start, end, chunk_rows)
+
+
+def _segment_rows(segment, start, end, chunk_rows):
+    for chunk in _segment_chunks(segment, list(COLUMNS), start, end, chunk_rows):
+        values = [chunk[name].tolist() for name in COLUMNS]
+        for row in zip(*values):
+            yield dict(zip(COLUMNS, row))
+
+
+def iter_rows(start=None, end=None, chunk_rows=CHUNK_ROWS):
+    """Archived consumptions with start <= consumed_at < end, one ``{column: value}`` at a time.
+
+    Rows come in (consumed_at, id) order; segments are sorted on their own and
+    may overlap in time, so their rows are merged.
+    """
+    return heapq.merge(
+        *[_segment_rows(segment, start, end, chunk_rows) for segment in segments() if segment.overlaps(start, end)],
+        key=lambda row: (row['consumed_at'], row['id']),
+    )
+
+
+def totals():
+    """(consumptions, total waste weight) across every segment, from the index alone."""
+    index = read_index()
+    return sum(meta['rows'] for meta in index), sum(meta['waste_sum'] for meta in index)
+
+
+def local_day_offsets(times, first_day, days):
+    """Offset from ``first_day`` of the local day of each timestamp (microseconds)."""
+    boundaries = [to_micros(exports.day_start(first_day + timedelta(days=offset))) for offset in range(days + 1)]
+    return np.searchsorted(boundaries, times, side='right') - 1
+
+
+def waste_totals(start=None, end=None, student_ids=None, meal_ids=None):
+    """{meal_id: [total waste, weighed consumptions, consumptions]} of the archived rows in a time range."""
+    totals = {}
+    for chunk in iter_chunks(['student_id', 'meal_id', 'waste_weight'], start, end):
+        keep = np.ones(len(chunk['meal_id']), dtype=bool)
+        if student_ids is not None:
+            keep &= np.isin(chunk['student_id'], student_ids)
+        if meal_ids is not None:
+            keep &= np.isin(chunk['meal_id'], meal_ids)
+        meals, waste = chunk['meal_id'][keep], chunk['waste_weight'][keep]
+        weighed = ~np.isnan(waste)
+        unique, inverse = np.unique(meals, return_inverse=True)
+        sums = np.bincount(inverse, weights=np.where(weighed, waste, 0.0), minlength=len(unique))
+        weighed_counts = np.bincount(inverse, weights=weighed, minlength=len(unique))
+        counts = np.bincount(inverse, minlength=len(unique))
+        for meal_id, total, weighed_count, count in zip(unique.tolist(), sums.tolist(), weighed_counts.tolist(),
+                                                        counts.tolist()):
+            entry = totals.setdefault(meal_id, [0.0, 0, 0])
+            entry[0] += total
+            entry[1] += int(weighed_count)
+            entry[2] += count
+    return totals
+
+
+def daily_buckets(start=None, end=None, meal_ids=None):
+    """Rollup buckets of the archived rows, {(meal_id, day): {count, portion_sum, waste_count, ...}}."""
+    buckets = {}
+    for chunk in iter_chunks(['meal_id', 'consumed_at', 'portion_consumed', 'waste_weight'], start, end):
+        if meal_ids is not None:
+            keep = np.isin(chunk['meal_id'], meal_ids)
+            chunk = {name: values[keep] for name, values in chunk.items()}
+        if not len(chunk['meal_id']):
+            continue
+        times = chunk['consumed_at']
+        first_day = timezone.localdate(from_micros(times.min()))
+        days = (timezone.localdate(from_micros(times.max())) - first_day).days + 1
+        keys = chunk['meal_id'] * days + local_day_offsets(times, first_day, days)
+
+        order = np.argsort(keys, kind='stable')
+        keys, portions, waste = keys[order], chunk['portion_consumed'][order], chunk['waste_weight'][order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        weighed = ~np.isnan(waste)
+        groups = zip(
+            keys[starts].tolist(),
+            np.diff(np.r_[starts, len(keys)]).tolist(),
+            np.add.reduceat(portions, starts).tolist(),
+            np.add.reduceat(weighed.astype(np.int64), starts).tolist(),
+            np.add.reduceat(np.where(weighed, waste, 0.0), starts).tolist(),
+            np.fmin.reduceat(waste, starts).tolist(),
+            np.fmax.reduceat(waste, starts).tolist(),
+        )
+        for key, count, portion_sum, waste_count, waste_sum, waste_min, waste_max in groups:
+            merge_bucket(buckets, (key // days, first_day + timedelta(days=key % days)), {
+                'consumption_count': count,
+                'portion_sum': portion_sum,
+                'waste_count': waste_count,
+                'waste_sum': waste_sum,
+                'waste_min': None if waste_count == 0 else waste_min,
+                'waste_max': None if waste_count == 0 else waste_max,
+            })
+    return buckets
+
+
+def merge_bucket(buckets, key, bucket):
+    existing = buckets.get(key)
+    if existing is None:
+        buckets[key] = dict(bucket)
+        return
+    for field in ('consumption_count', 'portion_sum', 'waste_count', 'waste_sum'):
+        existing[field] += bucket[field]
+    for field, pick in (('waste_min', min), ('waste_max', max)):
+        values = [value for value in (existing[field], bucket[field]) if value is not None]
+        existing[field] = pick(values) if values else None
+
+
+def archive_before(cutoff, name, archive_dir=None, chunk_size=10_000):
+    """Copy the consumptions older than ``cutoff`` into a new segment; returns its metadata, or None if none are."""
+    if np is None:
+        raise ImproperlyConfigured('NumPy is required to write the consumption archive')
+    archive_dir = archive_dir or get_archive_dir()
+    index = read_index(archive_dir)
+    if any(meta['name'] == name for meta in index):
+        raise ValueError(f'An archive segment named {name!r} already exists')
+
+    rows = MealConsumption.objects.filter(consumed_at__lt=cutoff).order_by('consumed_at', 'id')
+    count = rows.count()
+    if not count:
+        return None
+
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    staging = archive_dir / f'{name}.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+    columns = {
+        column: np.lib.format.open_memmap(staging / f'{column}.npy', mode='w+', dtype=dtype, shape=(count,))
+        for column, dtype in COLUMNS.items()
+    }
+
+    written = 0
+    batch = []
+    # Rows added meanwhile are left for a later archive; only what was counted is written and deleted
+    for row in rows.values_list(*COLUMNS)[:count].iterator(chunk_size=chunk_size):
+        batch.append(row)
+        if len(batch) == chunk_size:
+            written = _fill(columns, batch, written)
+            batch = []
+    written = _fill(columns, batch, written)
+    waste = columns['waste_weight'][:written]
+
+    meta = {
+        'name': name,
+        'cutoff': cutoff.isoformat(),
+        'rows': written,
+        'first_consumed_at': int(columns['consumed_at'][0]),
+        'last_consumed_at': int(columns['consumed_at'][written - 1]),
+        'waste_count': int(np.count_nonzero(~np.isnan(waste))),
+        'waste_sum': float(np.nansum(waste)),
+        'created': timezone.now().isoformat(),
+    }
+    for column in columns.values():
+        column.flush()
+    del columns, waste
+    (staging / 'meta.json').write_text(json.dumps(meta, indent=2), encoding='utf-8')
+    os.replace(staging, archive_dir / name)
+    _write_index(archive_dir, index + [meta])
+    return meta
+
+
+def _fill(columns, batch, written):
+    if not batch:
+        return written
+    ids, students, meals, times, portions, waste = zip(*batch)
+    end = written + len(batch)
+    columns['id'][written:end] = ids
+    columns['student_id'][written:end] = students
+    columns['meal_id'][written:end] = meals
+    columns['consumed_at'][written:end] = [to_micros(moment) for moment in times]
+    columns['portion_consumed'][written:end] = portions
+    columns['waste_weight'][written:end] = [np.nan if value is None else value for value in waste]
+    return end
+
+
+def delete_archived(name, archive_dir=None):
+    """Delete a segment's rows from the live table; safe to repeat. Returns the number of rows deleted."""
+    archive_dir = archive_dir or get_archive_dir()
+    meta = next((meta for meta in read_index(archive_dir) if meta['name'] == name), None)
+    if meta is None:
+        raise ValueError(f'No archive segment named {name!r}')
+    ids = Segment(archive_dir / name, meta).column('id')
+    deleted = 0
+    for first in range(0, len(ids), DELETE_BATCH_SIZE * DELETES_PER_TRANSACTION):
+        # Commit every few thousand rows: one commit per statement is slow, one for all holds the write lock
+        with transaction.atomic(using=router.db_for_write(MealConsumption)):
+            for start in range(first, min(first + DELETE_BATCH_SIZE * DELETES_PER_TRANSACTION, len(ids)),
+                               DELETE_BATCH_SIZE):
+                batch = ids[start:start + DELETE_BATCH_SIZE].tolist()
+                # Raw deletes skip the signals: the rollups and counters keep counting archived rows
+                deleted += MealConsumption.objects.filter(id__in=batch)._raw_delete(MealConsumption.objects.db) or 0
+    return deleted
@@ -0,0 +1,174 @@
+import math
+
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import roster
+from .models import Student, Meal, MealConsumption
+from .signals import consumptions_bulk_created
+
+# Largest number of records accepted in one check-in batch
+MAX_BATCH_RECORDS = getattr(settings, 'MEALS_BATCH_MAX_RECORDS', 5000)
+
+# Rows per INSERT statement; SQLite caps the number of bound variables per query
+INSERT_BATCH_SIZE = getattr(settings, 'MEALS_INSERT_BATCH_SIZE', 500)
+
+ALREADY_SERVED = 'This student has already been served this meal.'
+
+
+def _parse_float(value, field, errors, minimum=None, maximum=None, required=True):
+    if value is None or value == '':
+        if required:
+            errors.setdefault(field, []).append('This field is required.')
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        errors.setdefault(field, []).append('Enter a number.')
+        return None
+    if not math.isfinite(value):
+        errors.setdefault(field, []).append('Enter a number.')
+        return None
+    if minimum is not None and value < minimum:
+        errors.setdefault(field, []).append(f'Ensure this value is greater than or equal to {minimum}.')
+    if maximum is not None and value > maximum:
+        errors.setdefault(field, []).append(f'Ensure this value is less than or equal to {maximum}.')
+    return value
+
+
+def _to_int(value):
+    """``value`` as an int, or None unless it is a whole number (``3.7`` is not truncated to 3)."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            return None
+    return None
+
+
+def _parse_int(value, field, errors):
+    if value is None or value == '':
+        errors.setdefault(field, []).append('This field is required.')
+        return None
+    value = _to_int(value)
+    if value is None:
+        errors.setdefault(field, []).append('Enter a whole number.')
+    return value
+
+
+def _parse_datetime(value, field, errors):
+    if value in (None, ''):
+        return timezone.now()
+    try:
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        errors.setdefault(field, []).append('Enter a valid date/time.')
+        return None
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def validate_consumption_records(records):
+    """Validate raw check-in records in bulk.
+
+    Each record is a mapping with ``student_id`` (the school-issued id),
+    ``meal`` (the meal pk), ``portion_consumed`` and optionally
+    ``waste_weight`` and ``consumed_at`` (ISO 8601, defaults to now).
+    Students and today's meals are resolved from the process's serving
+    roster; anything it does not hold costs one query per kind.  A student
+    already served a meal is rejected.
+    Returns ``(consumptions, errors)`` where ``errors`` is a list of
+    ``{'index': ..., 'errors': {field: [messages]}}`` entries.
+    """
+    student_ids = set()
+    meal_ids = set()
+    for record in records:
+        if isinstance(record, dict):
+            if record.get('student_id') not in (None, ''):
+                student_ids.add(str(record['student_id']))
+            meal_id = _to_int(record.get('meal'))
+            if meal_id is not None:
+                meal_ids.add(meal_id)
+
+    service = roster.get_roster()
+    students = {}
+    meals = set()
+    if service is not None:
+        students = {student_id: service.student_pk(student_id) for student_id in student_ids
+                    if service.student_pk(student_id) is not None}
+        meals = {meal_pk for meal_pk in meal_ids if service.has_meal(meal_pk)}
+    # Students added since the roster was built, and meals of other days, come from the database
+    missing = student_ids - students.keys()
+    if missing:
+        students.update(Student.objects.filter(student_id__in=missing).values_list('student_id', 'id'))
+    other_meals = set()
+    if meal_ids - meals:
+        other_meals = set(Meal.objects.filter(id__in=meal_ids - meals).values_list('id', flat=True))
+        meals |= other_meals
+    served = set()
+    if other_meals and students:
+        served = set(MealConsumption.objects.filter(
+            meal_id__in=other_meals, student_id__in=students.values(),
+        ).values_list('student_id', 'meal_id'))
+
+    consumptions = []
+    errors = []
+    seen = set()
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append({'index': index, 'errors': {'__all__': ['Expected an object.']}})
+            continue
+
+        row_errors = {}
+        student_pk = students.get(str(record.get('student_id', '')))
+        if student_pk is None:
+            row_errors['student_id'] = ['Unknown student.']
+
+        meal_pk = _parse_int(record.get('meal'), 'meal', row_errors)
+        if meal_pk is not None and meal_pk not in meals:
+            row_errors['meal'] = ['Unknown meal.']
+
+        portion = _parse_float(record.get('portion_consumed'), 'portion_consumed', row_errors, 0.0, 1.0)
+        waste = _parse_float(record.get('waste_weight'), 'waste_weight', row_errors, 0.0, required=False)
+        consumed_at = _parse_datetime(record.get('consumed_at'), 'consumed_at', row_errors)
+
+        if not row_errors:
+            key = (student_pk, meal_pk)
+            if key in seen:
+                row_errors['__all__'] = ['Duplicate student and meal in this batch.']
+            elif key in served or (meal_pk not in other_meals and service.is_served(*key)):
+                row_errors['__all__'] = [ALREADY_SERVED]
+            seen.add(key)
+
+        if row_errors:
+            errors.append({'index': index, 'errors': row_errors})
+            continue
+
+        consumptions.append(MealConsumption(
+            student_id=student_pk,
+            meal_id=meal_pk,
+            consumed_at=consumed_at,
+            portion_consumed=portion,
+            waste_weight=waste,
+        ))
+
+    return consumptions, errors
+
+
+def bulk_insert_consumptions(consumptions):
+    # All rows of a batch go in one transaction so a terminal never sees a partial batch
+    with transaction.atomic(using=router.db_for_write(MealConsumption)):
+        created = MealConsumption.objects.bulk_create(consumptions, batch_size=INSERT_BATCH_SIZE)
+        consumptions_bulk_created.send(sender=MealConsumption, consumptions=created)
+    return created
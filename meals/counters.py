@@ -0,0 +1,67 @@
+"""Running totals shown on the dashboard.
+
+Each counter is one row changed with a single ``UPDATE ... SET value = value
++ delta``, from the save/delete signals and the bulk write paths, inside the
+writer's transaction.  ``recount`` recomputes them from the tables to repair
+drift after raw SQL or other writes that skip the signals.
+"""
+import math
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from . import archive
+from .models import Counter, Meal, MealConsumption, Student
+
+STUDENTS = 'students'
+MEALS = 'meals'
+CONSUMPTIONS = 'consumptions'
+WASTE_WEIGHT = 'waste_weight'
+
+
+def increment(**deltas):
+    """Add each delta to its counter, e.g. ``increment(consumptions=1, waste_weight=120.5)``."""
+    now = timezone.now()
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        if Counter.objects.filter(name=name).update(value=F('value') + delta, updated_at=now):
+            continue
+        try:
+            with transaction.atomic(using=router.db_for_write(Counter)):
+                Counter.objects.create(name=name, value=delta, updated_at=now)
+        except IntegrityError:
+            # Another writer created the counter first
+            Counter.objects.filter(name=name).update(value=F('value') + delta, updated_at=now)
+
+
+def get_counts():
+    counts = dict.fromkeys([STUDENTS, MEALS, CONSUMPTIONS, WASTE_WEIGHT], 0)
+    counts.update(Counter.objects.filter(name__in=counts).values_list('name', 'value'))
+    return counts
+
+
+def current_totals():
+    # Archived consumptions still count, as they do in the rollups
+    archived_consumptions, archived_waste = archive.totals()
+    return {
+        STUDENTS: Student.objects.count(),
+        MEALS: Meal.objects.count(),
+        CONSUMPTIONS: MealConsumption.objects.count() + archived_consumptions,
+        WASTE_WEIGHT: (MealConsumption.objects.aggregate(total=Sum('waste_weight'))['total'] or 0) + archived_waste,
+    }
+
+
+def recount():
+    """Recompute every counter from the tables; returns {name: (old, new)} for the counters that drifted."""
+    with transaction.atomic(using=router.db_for_write(Counter)):
+        previous = get_counts()
+        totals = current_totals()
+        for name, value in totals.items():
+            Counter.objects.update_or_create(name=name, defaults={'value': value, 'updated_at': timezone.now()})
+    # Sums of many floats differ in the last digits depending on order, which is not drift
+    return {
+        name: (previous[name], value) for name, value in totals.items()
+        if not math.isclose(previous[name], value, rel_tol=1e-9, abs_tol=1e-6)
+    }
@@ -0,0 +1,183 @@
+"""Dietary restriction tags and the per-day meal conflict set.
+
+``Student.dietary_restrictions`` stays free text for people to read;
+``parse_tags`` turns it into normalized ``DietaryTag`` names ("Peanut
+allergy, lactose intolerant" -> peanuts, dairy), kept in
+``Student.dietary_tags``.  Meals carry the tags they contain in
+``Meal.allergen_tags``.
+
+Finalizing the menu of a serving date (``build_day``) joins the two once and
+stores every clashing (meal, student) pair in ``MealConflict``.  Check-in
+paths call ``find_conflicts``, which loads those pairs for the meals involved
+in one query and answers each tray with a dict lookup.  Meals of days that
+are not finalized yet are checked by joining the tag tables instead, so a
+conflict is never missed, only computed more slowly.
+"""
+import re
+from collections import defaultdict
+
+from django.db import router, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .models import DietaryTag, Meal, MealConflict, ServingDay, Student
+
+StudentTag = Student.dietary_tags.through
+MealTag = Meal.allergen_tags.through
+
+# Common spellings mapped to one tag
+ALIASES = {
+    'peanut': 'peanuts',
+    'groundnut': 'peanuts',
+    'groundnuts': 'peanuts',
+    'nut': 'tree-nuts',
+    'nuts': 'tree-nuts',
+    'tree-nut': 'tree-nuts',
+    'milk': 'dairy',
+    'lactose': 'dairy',
+    'cheese': 'dairy',
+    'wheat': 'gluten',
+    'celiac': 'gluten',
+    'coeliac': 'gluten',
+    'egg': 'eggs',
+    'shrimp': 'shellfish',
+    'prawn': 'shellfish',
+    'prawns': 'shellfish',
+    'soya': 'soy',
+    'sesame-seeds': 'sesame',
+}
+# Diets stand for the ingredients they exclude
+DIETS = {
+    'vegetarian': ['meat', 'fish', 'shellfish'],
+    'vegan': ['meat', 'fish', 'shellfish', 'dairy', 'eggs'],
+    'pescatarian': ['meat'],
+}
+# Words that qualify a restriction rather than name one
+FILLER_WORDS = {'allergy', 'allergies', 'allergic', 'to', 'intolerance', 'intolerant', 'no', 'free', 'diet', 'only'}
+NO_RESTRICTION = {'', 'none', 'n-a', 'na', 'nil'}
+SEPARATORS = re.compile(r'[,;/\n]|\band\b|&', re.IGNORECASE)
+
+# Rows per INSERT statement, below SQLite's bound parameter limit
+INSERT_BATCH_SIZE = 500
+
+
+def parse_tags(text, expand_diets=True):
+    """Sorted tag names of a free-text restriction, e.g. "Peanut allergy; vegetarian".
+
+    Meals list what they contain, so their tags are parsed with ``expand_diets=False``.
+    """
+    tags = set()
+    for part in SEPARATORS.split(text or ''):
+        words = [word for word in re.findall(r'[a-z]+', part.lower()) if word not in FILLER_WORDS]
+        name = slugify(' '.join(words))
+        if name in NO_RESTRICTION:
+            continue
+        name = ALIASES.get(name, name)
+        tags.update(DIETS.get(name, [name]) if expand_diets else [name])
+    return sorted(tags)
+
+
+def get_tags(names):
+    """{name: DietaryTag} for the given names, creating the missing ones."""
+    names = set(names)
+    existing = {tag.name: tag for tag in DietaryTag.objects.filter(name__in=names)}
+    missing = [DietaryTag(name=name) for name in names - set(existing)]
+    if missing:
+        DietaryTag.objects.bulk_create(missing, ignore_conflicts=True)
+        existing = {tag.name: tag for tag in DietaryTag.objects.filter(name__in=names)}
+    return existing
+
+
+def sync_student_tags(students):
+    """Re-parse the restrictions of many students, replacing their tags with two bulk statements."""
+    parsed = {student.pk: parse_tags(student.dietary_restrictions) for student in students}
+    tags = get_tags(name for names in parsed.values() for name in names)
+    with transaction.atomic(using=router.db_for_write(StudentTag)):
+        StudentTag.objects.filter(student_id__in=list(parsed)).delete()
+        StudentTag.objects.bulk_create([
+            StudentTag(student_id=pk, dietarytag_id=tags[name].pk) for pk, names in parsed.items() for name in names
+        ], batch_size=INSERT_BATCH_SIZE)
+    return parsed
+
+
+def set_meal_tags(meal, names):
+    meal.allergen_tags.set(get_tags(names).values())
+
+
+def _finalized_meals():
+    return Meal.objects.filter(serving_date__in=ServingDay.objects.values('date'))
+
+
+def _conflicts(meals, student_ids=None):
+    """{(student pk, meal pk): [tag names]} for the given meals (ids or a queryset), joining the tag tables."""
+    meals_by_tag = defaultdict(list)
+    names = {}
+    for meal_id, tag_id, name in MealTag.objects.filter(meal_id__in=meals).values_list(
+            'meal_id', 'dietarytag_id', 'dietarytag__name'):
+        meals_by_tag[tag_id].append(meal_id)
+        names[tag_id] = name
+    if not meals_by_tag:
+        return {}
+
+    students = StudentTag.objects.filter(dietarytag_id__in=list(meals_by_tag))
+    if student_ids is not None:
+        students = students.filter(student_id__in=student_ids)
+    conflicts = defaultdict(list)
+    for student_id, tag_id in students.values_list('student_id', 'dietarytag_id'):
+        for meal_id in meals_by_tag[tag_id]:
+            conflicts[(student_id, meal_id)].append(names[tag_id])
+    return conflicts
+
+
+def _store(conflicts):
+    MealConflict.objects.bulk_create([
+        MealConflict(student_id=student_id, meal_id=meal_id, tags=','.join(sorted(tags)))
+        for (student_id, meal_id), tags in conflicts.items()
+    ], batch_size=INSERT_BATCH_SIZE)
+    return len(conflicts)
+
+
+def build_day(day):
+    """Finalize the menu of a serving date and precompute its conflicts; returns how many there are."""
+    with transaction.atomic(using=router.db_for_write(ServingDay)):
+        ServingDay.objects.update_or_create(date=day, defaults={'finalized_at': timezone.now()})
+        meals = Meal.objects.filter(serving_date=day).values('id')
+        MealConflict.objects.filter(meal_id__in=meals).delete()
+        return _store(_conflicts(meals))
+
+
+def refresh_meals(meal_ids):
+    """Recompute the stored conflicts of meals whose tags or serving date changed."""
+    with transaction.atomic(using=router.db_for_write(MealConflict)):
+        MealConflict.objects.filter(meal_id__in=meal_ids).delete()
+        _store(_conflicts(_finalized_meals().filter(id__in=meal_ids).values('id')))
+
+
+def refresh_students(student_ids):
+    """Recompute the stored conflicts of students whose tags changed."""
+    with transaction.atomic(using=router.db_for_write(MealConflict)):
+        MealConflict.objects.filter(student_id__in=student_ids).delete()
+        _store(_conflicts(_finalized_meals().values('id'), student_ids))
+
+
+def find_conflicts(pairs):
+    """{(student pk, meal pk): [tag names]} for the (student pk, meal pk) pairs that clash."""
+    pairs = set(pairs)
+    if not pairs:
+        return {}
+    meal_ids = {meal_id for _, meal_id in pairs}
+    student_ids = {student_id for student_id, _ in pairs}
+    finalized = set(_finalized_meals().filter(id__in=meal_ids).values_list('id', flat=True))
+
+    conflicts = {}
+    if finalized:
+        stored = MealConflict.objects.filter(meal_id__in=finalized)
+        if len(student_ids) == 1:
+            stored = stored.filter(student_id__in=student_ids)
+        conflicts = {
+            (student_id, meal_id): tags.split(',')
+            for student_id, meal_id, tags in stored.values_list('student_id', 'meal_id', 'tags')
+        }
+    if meal_ids - finalized:
+        conflicts.update(_conflicts(meal_ids - finalized, student_ids if len(student_ids) == 1 else None))
+    return {pair: conflicts[pair] for pair in pairs if pair in conflicts}
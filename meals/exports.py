@@ -0,0 +1,157 @@
+import csv
+import heapq
+import json
+import math
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from . import archive
+from .models import Meal, MealConsumption, Student
+
+# Rows fetched from the database cursor per round-trip
+EXPORT_CHUNK_SIZE = 2000
+
+CONSUMPTION_FIELDS = {
+    'id': 'id',
+    'consumed_at': 'consumed_at',
+    'student_id': 'student__student_id',
+    'student_name': 'student__name',
+    'grade': 'student__grade',
+    'meal_id': 'meal_id',
+    'meal_name': 'meal__name',
+    'meal_type': 'meal__meal_type',
+    'serving_date': 'meal__serving_date',
+    'portion_consumed': 'portion_consumed',
+    'waste_weight': 'waste_weight',
+}
+
+WASTE_FIELDS = ['meal_id', 'meal_name', 'meal_type', 'serving_date', 'servings', 'avg_waste', 'total_waste']
+
+
+def day_start(day):
+    # Range filters on the raw column keep the consumed_at index usable
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def filter_consumptions(queryset, date_from=None, date_to=None, meal_type=None):
+    if date_from:
+        queryset = queryset.filter(consumed_at__gte=day_start(date_from))
+    if date_to:
+        queryset = queryset.filter(consumed_at__lt=day_start(date_to + timedelta(days=1)))
+    if meal_type:
+        queryset = queryset.filter(meal__meal_type=meal_type)
+    return queryset
+
+
+def archive_range(date_from=None, date_to=None):
+    """(start, end) of the archive's consumed_at microseconds for a date filter; None is unbounded."""
+    start = archive.to_micros(day_start(date_from)) if date_from else None
+    end = archive.to_micros(day_start(date_to + timedelta(days=1))) if date_to else None
+    return start, end
+
+
+def _archived_consumption_rows(date_from, date_to, meal_type):
+    """Export rows of the archived consumptions, in (consumed_at, id) order, their students and meals looked up."""
+    rows = archive.iter_rows(*archive_range(date_from, date_to), chunk_rows=EXPORT_CHUNK_SIZE)
+    while True:
+        chunk = [row for _, row in zip(range(EXPORT_CHUNK_SIZE), rows)]
+        if not chunk:
+            return
+        students = Student.objects.only('student_id', 'name', 'grade').in_bulk({row['student_id'] for row in chunk})
+        meals = Meal.objects.only('name', 'meal_type', 'serving_date').in_bulk({row['meal_id'] for row in chunk})
+        for row in chunk:
+            student, meal = students.get(row['student_id']), meals.get(row['meal_id'])
+            if meal_type and (meal is None or meal.meal_type != meal_type):
+                continue
+            waste = row['waste_weight']
+            yield {
+                'id': row['id'],
+                'consumed_at': archive.from_micros(row['consumed_at']),
+                'student_id': student and student.student_id,
+                'student_name': student and student.name,
+                'grade': student and student.grade,
+                'meal_id': row['meal_id'],
+                'meal_name': meal and meal.name,
+                'meal_type': meal and meal.meal_type,
+                'serving_date': meal and meal.serving_date,
+                'portion_consumed': row['portion_consumed'],
+                'waste_weight': None if math.isnan(waste) else waste,
+            }
+
+
+def consumption_rows(date_from=None, date_to=None, meal_type=None):
+    """Live and archived consumptions in (consumed_at, id) order."""
+    queryset = filter_consumptions(MealConsumption.objects.all(), date_from, date_to, meal_type)
+    queryset = queryset.order_by('consumed_at', 'id').values_list(*CONSUMPTION_FIELDS.values())
+    live = (dict(zip(CONSUMPTION_FIELDS, row)) for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    yield from heapq.merge(live, _archived_consumption_rows(date_from, date_to, meal_type),
+                           key=lambda row: (row['consumed_at'], row['id']))
+
+
+def waste_rows(date_from=None, date_to=None, meal_type=None):
+    """Per meal waste of the live and archived consumptions, by serving date."""
+    queryset = filter_consumptions(MealConsumption.objects.all(), date_from, date_to, meal_type)
+    queryset = queryset.values(
+        'meal_id',
+        meal_name=F('meal__name'),
+        meal_type=F('meal__meal_type'),
+        serving_date=F('meal__serving_date'),
+    ).annotate(
+        servings=Count('id'),
+        weighed=Count('waste_weight'),
+        total_waste=Sum('waste_weight'),
+    )
+    per_meal = {row['meal_id']: row for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE)}
+
+    archived = archive.waste_totals(*archive_range(date_from, date_to))
+    meals = Meal.objects.filter(id__in=[meal_id for meal_id in archived if meal_id not in per_meal])
+    if meal_type:
+        meals = meals.filter(meal_type=meal_type)
+    for meal in meals.only('name', 'meal_type', 'serving_date').iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        per_meal[meal.id] = {'meal_id': meal.id, 'meal_name': meal.name, 'meal_type': meal.meal_type,
+                             'serving_date': meal.serving_date, 'servings': 0, 'weighed': 0, 'total_waste': None}
+    for meal_id, row in per_meal.items():
+        if meal_id in archived:
+            total, weighed, count = archived[meal_id]
+            row['servings'] += count
+            row['weighed'] += weighed
+            if weighed:
+                row['total_waste'] = (row['total_waste'] or 0) + total
+        row['avg_waste'] = row['total_waste'] / row['weighed'] if row['weighed'] else None
+
+    for row in sorted(per_meal.values(), key=lambda row: (row['serving_date'], row['meal_id'])):
+        yield {field: row[field] for field in WASTE_FIELDS}
+
+
+class Echo:
+    """File-like object whose write() hands the line straight back to the caller."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def render(rows, fields, fmt):
+    if fmt == 'ndjson':
+        return ndjson_lines(rows)
+    return csv_lines(rows, fields)
+
+
+EXPORTS = {
+    'consumptions': (consumption_rows, list(CONSUMPTION_FIELDS)),
+    'waste': (waste_rows, WASTE_FIELDS),
+}
@@ -1,4 +1,7 @@
 from django import forms
+from django.urls import reverse
+from . import dietary, roster
+from .batch import ALREADY_SERVED
 from .models import Student, Meal, MealConsumption
 
 class StudentForm(forms.ModelForm):
@@ -18,6 +21,10 @@ class MealForm(forms.ModelForm):
     protein = forms.FloatField(min_value=0)
     carbohydrates = forms.FloatField(min_value=0)
     fats = forms.FloatField(min_value=0)
+    allergens = forms.CharField(
+        required=False,
+        help_text='Comma-separated allergens and ingredients, e.g. "peanuts, dairy, gluten"',
+    )
 
     class Meta:
         model = Meal
@@ -33,18 +40,80 @@ class MealForm(forms.ModelForm):
             'serving_date': {'required': 'Serving date is required'}
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk and 'allergens' not in self.initial:
+            self.initial['allergens'] = ', '.join(tag.name for tag in self.instance.allergen_tags.order_by('name'))
+
+    def clean_allergens(self):
+        return dietary.parse_tags(self.cleaned_data['allergens'], expand_diets=False)
+
+    def _save_m2m(self):
+        super()._save_m2m()
+        dietary.set_meal_tags(self.instance, self.cleaned_data['allergens'])
+
+class AutocompleteSelect(forms.Widget):
+    """Search box backed by a JSON autocomplete endpoint, submitting the chosen object's pk.
+
+    Unlike ``Select`` it never iterates the field's choices: only the current
+    value, if any, is looked up to label the box.
+    """
+    template_name = 'meals/widgets/autocomplete.html'
+
+    def __init__(self, url_name, attrs=None):
+        super().__init__(attrs)
+        self.url_name = url_name
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        selected = None
+        if value not in (None, ''):
+            try:
+                selected = self.choices.queryset.filter(pk=value).first()
+            except (ValueError, TypeError):
+                pass
+        context['widget'].update({
+            'url': reverse(self.url_name),
+            'value': selected.pk if selected else '',
+            'label': str(selected) if selected else '',
+        })
+        return context
+
+
 class MealConsumptionForm(forms.ModelForm):
     class Meta:
         model = MealConsumption
         fields = ['student', 'meal', 'portion_consumed', 'waste_weight']
         widgets = {
+            # ModelChoiceField validates just the submitted pk; these widgets never load the tables
+            'student': AutocompleteSelect('student-autocomplete', attrs={'placeholder': 'Name or student ID'}),
+            'meal': AutocompleteSelect('meal-autocomplete', attrs={'placeholder': "Search today's meals"}),
             'portion_consumed': forms.NumberInput(attrs={'step': '0.1', 'min': '0', 'max': '1'}),
             'waste_weight': forms.NumberInput(attrs={'step': '0.1', 'min': '0'}),
         }
 
+    def clean(self):
+        cleaned_data = super().clean()
+        student, meal = cleaned_data.get('student'), cleaned_data.get('meal')
+        if student and meal and roster.already_served(student.pk, meal.pk):
+            raise forms.ValidationError(ALREADY_SERVED)
+        return cleaned_data
+
 
 
 class MealSearchForm(forms.Form):
+    # Stored meal fields filtered by the <field>_min/<field>_max pairs below
+    RANGE_FIELDS = ['calories', 'protein_pct', 'carbohydrates_pct', 'fats_pct']
+    SORTS = [
+        ('', 'Newest first'),
+        ('calories', 'Calories, lowest first'),
+        ('-calories', 'Calories, highest first'),
+        ('-protein_pct', 'Protein share, highest first'),
+        ('carbohydrates_pct', 'Carbohydrate share, lowest first'),
+        ('fats_pct', 'Fat share, lowest first'),
+    ]
+
+    q = forms.CharField(required=False, label='Search')
     meal_type = forms.ChoiceField(
         choices=[('', 'All')] + Meal.MEAL_TYPES,
         required=False
@@ -57,7 +126,97 @@ class MealSearchForm(forms.Form):
         required=False,
         widget=forms.DateInput(attrs={'type': 'date'})
     )
+    calories_min = forms.IntegerField(required=False, min_value=0)
+    calories_max = forms.IntegerField(required=False, min_value=0)
+    protein_pct_min = forms.FloatField(required=False, min_value=0, max_value=100)
+    protein_pct_max = forms.FloatField(required=False, min_value=0, max_value=100)
+    carbohydrates_pct_min = forms.FloatField(required=False, min_value=0, max_value=100)
+    carbohydrates_pct_max = forms.FloatField(required=False, min_value=0, max_value=100)
+    fats_pct_min = forms.FloatField(required=False, min_value=0, max_value=100)
+    fats_pct_max = forms.FloatField(required=False, min_value=0, max_value=100)
+    sort = forms.ChoiceField(choices=SORTS, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for field in self.RANGE_FIELDS:
+            low, high = cleaned_data.get(f'{field}_min'), cleaned_data.get(f'{field}_max')
+            if low is not None and high is not None and low > high:
+                self.add_error(f'{field}_max', 'The maximum must not be below the minimum.')
+        return cleaned_data
+
+class ExportForm(forms.Form):
+    FORMATS = [
+        ('csv', 'CSV'),
+        ('ndjson', 'NDJSON'),
+    ]
+
+    format = forms.ChoiceField(choices=FORMATS, required=False)
+    meal_type = forms.ChoiceField(
+        choices=[('', 'All')] + Meal.MEAL_TYPES,
+        required=False
+    )
+    date_from = forms.DateField(required=False)
+    date_to = forms.DateField(required=False)
+
+class WasteReportForm(forms.Form):
+    date_from = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    date_to = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    grade = forms.CharField(required=False, max_length=10)
+    meal_type = forms.ChoiceField(
+        choices=[('', 'All')] + Meal.MEAL_TYPES,
+        required=False
+    )
+
+class IntakeReportForm(forms.Form):
+    date_from = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    date_to = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    grade = forms.CharField(required=False, max_length=10)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError('The start date must not be after the end date.')
+        return cleaned_data
 
 class StudentSearchForm(forms.Form):
     grade = forms.CharField(required=False)
-    name = forms.CharField(required=False)
\ No newline at end of file
+    name = forms.CharField(required=False)
+
+
+class ApiListForm(forms.Form):
+    # Page size and the opaque cursor of the last row of the previous page
+    limit = forms.IntegerField(required=False, min_value=1, max_value=1000)
+    after = forms.CharField(required=False)
+
+class StudentApiForm(ApiListForm):
+    q = forms.CharField(required=False)
+    grade = forms.CharField(required=False, max_length=10)
+    student_id = forms.CharField(required=False, max_length=20)
+
+class MealApiForm(ApiListForm):
+    q = forms.CharField(required=False)
+    meal_type = forms.ChoiceField(choices=[('', 'All')] + Meal.MEAL_TYPES, required=False)
+    serving_date = forms.DateField(required=False)
+    date_from = forms.DateField(required=False)
+    date_to = forms.DateField(required=False)
+
+class ConsumptionApiForm(ApiListForm):
+    student = forms.IntegerField(required=False)
+    meal = forms.IntegerField(required=False)
+    meal_type = forms.ChoiceField(choices=[('', 'All')] + Meal.MEAL_TYPES, required=False)
+    date_from = forms.DateField(required=False)
+    date_to = forms.DateField(required=False)
@@ -0,0 +1,191 @@
+"""Per-student nutrient intake, computed with NumPy.
+
+What a student ate is each consumed meal's calories, protein, carbohydrates
+and fats scaled by ``portion_consumed``.  ``compute_intake`` pulls the few
+columns it needs with ``values_list`` into arrays, and groups by student and
+day with ``np.unique``/``np.bincount`` instead of looping over rows.  Only
+(student, day) pairs that actually occur are stored, so a whole school term
+does not need a dense students x days matrix; ``Intake.matrix`` builds the
+dense one for a single student.
+
+NumPy is optional: ``is_available()`` is False without it and the intake
+views show a notice instead.
+"""
+from datetime import timedelta
+from itertools import islice
+
+from django.db.models import IntegerField, Value
+from django.utils import timezone
+
+from . import archive
+from .exports import day_start
+from .models import Meal, MealConsumption, Student
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is an optional dependency
+    np = None
+
+NUTRIENTS = ('calories', 'protein', 'carbohydrates', 'fats')
+
+# Days combined into one UNION ALL statement (SQLite allows 500 compound SELECT terms)
+DAYS_PER_QUERY = 100
+
+# Period covered when the report is not given dates
+DEFAULT_DAYS = 28
+
+
+def is_available():
+    return np is not None
+
+
+def default_period(date_from=None, date_to=None):
+    """(date_from, date_to) with the missing ends filled in: up to today, DEFAULT_DAYS long."""
+    date_to = date_to or timezone.localdate()
+    return date_from or date_to - timedelta(days=DEFAULT_DAYS - 1), date_to
+
+
+def _group_sum(keys, values):
+    """Sum the rows of ``values`` per distinct key; returns (sorted unique keys, sums)."""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = np.column_stack([
+        np.bincount(inverse, weights=values[:, column], minlength=len(unique)) for column in range(values.shape[1])
+    ])
+    return unique, sums
+
+
+class Intake:
+    """Intake per (student, day) pair, with per-student and per-week views of it."""
+
+    def __init__(self, first_day, student_ids, pair_students, pair_days, daily):
+        self.first_day = first_day
+        # Student primary keys, sorted; other arrays index into this one
+        self.student_ids = student_ids
+        # One entry per (student, day) that has consumptions: student index, day offset and nutrient totals
+        self.pair_students = pair_students
+        self.pair_days = pair_days
+        self.daily = daily
+
+    def day(self, offset):
+        return self.first_day + timedelta(days=int(offset))
+
+    def student_index(self, student_id):
+        index = int(np.searchsorted(self.student_ids, student_id))
+        if index < len(self.student_ids) and self.student_ids[index] == student_id:
+            return index
+        return None
+
+    def summary(self):
+        """Per student: days with a recorded meal, nutrient totals and average intake per such day."""
+        days_eaten = np.bincount(self.pair_students, minlength=len(self.student_ids))
+        totals = np.column_stack([
+            np.bincount(self.pair_students, weights=self.daily[:, column], minlength=len(self.student_ids))
+            for column in range(len(NUTRIENTS))
+        ])
+        averages = totals / np.maximum(days_eaten, 1)[:, None]
+        return days_eaten, totals, averages
+
+    def weekly(self):
+        """Intake per (student, week), weeks starting on Monday; returns (student index, week start, totals)."""
+        week = (self.pair_days + self.first_day.weekday()) // 7
+        n_weeks = int(week.max()) + 1 if len(week) else 1
+        keys, totals = _group_sum(self.pair_students.astype(np.int64) * n_weeks + week, self.daily)
+        week_starts = [self.first_day - timedelta(days=self.first_day.weekday()) + timedelta(weeks=int(w))
+                       for w in keys % n_weeks]
+        return keys // n_weeks, week_starts, totals
+
+    def matrix(self, student_id, days):
+        """Dense (days x nutrients) intake for one student, day 0 being ``first_day``."""
+        matrix = np.zeros((days, len(NUTRIENTS)))
+        index = self.student_index(student_id)
+        if index is not None:
+            rows = (self.pair_students == index) & (self.pair_days < days)
+            matrix[self.pair_days[rows]] = self.daily[rows]
+        return matrix
+
+    def daily_rows(self, student_id):
+        """[(date, {nutrient: amount})] for the days one student has consumptions."""
+        index = self.student_index(student_id)
+        if index is None:
+            return []
+        rows = np.flatnonzero(self.pair_students == index)
+        return [(self.day(self.pair_days[row]), dict(zip(NUTRIENTS, self.daily[row].tolist()))) for row in rows]
+
+
+def _consumption_chunks(consumptions, boundaries, chunk_size):
+    """Yield (student_id, meal_id, portion, day offset) arrays for consumptions between consecutive boundaries.
+
+    Each day is its own indexed range on consumed_at, tagged with its offset, so no timestamp is
+    fetched or converted; the days are combined with UNION ALL, DAYS_PER_QUERY at a time.  Rows are
+    turned into arrays ``chunk_size`` at a time, so only one chunk of them is held as Python tuples.
+    """
+    for first in range(0, len(boundaries) - 1, DAYS_PER_QUERY):
+        days = [
+            consumptions.filter(consumed_at__gte=boundaries[offset], consumed_at__lt=boundaries[offset + 1]).annotate(
+                day_offset=Value(offset, output_field=IntegerField()),
+            ).values_list('student_id', 'meal_id', 'portion_consumed', 'day_offset')
+            for offset in range(first, min(first + DAYS_PER_QUERY, len(boundaries) - 1))
+        ]
+        combined = days[0].union(*days[1:], all=True) if len(days) > 1 else days[0]
+        rows = combined.iterator(chunk_size=chunk_size)
+        while chunk := list(islice(rows, chunk_size)):
+            yield (
+                np.fromiter((row[0] for row in chunk), dtype=np.int64, count=len(chunk)),
+                np.fromiter((row[1] for row in chunk), dtype=np.int64, count=len(chunk)),
+                np.fromiter((row[2] for row in chunk), dtype=np.float64, count=len(chunk)),
+                np.fromiter((row[3] for row in chunk), dtype=np.int64, count=len(chunk)),
+            )
+
+
+def compute_intake(date_from, date_to, student_ids=None, grade=None, chunk_size=10_000):
+    """Compute the intake of every student (or the given ones) between two dates, inclusive."""
+    if np is None:
+        raise RuntimeError('NumPy is required for intake analytics')
+
+    n_days = (date_to - date_from).days + 1
+    # Local midnights bounding each day, so days follow the current time zone
+    boundaries = [day_start(date_from + timedelta(days=offset)) for offset in range(n_days + 1)]
+    consumptions = MealConsumption.objects.order_by()
+    if student_ids is not None:
+        consumptions = consumptions.filter(student_id__in=student_ids)
+    if grade:
+        consumptions = consumptions.filter(student__grade=grade)
+
+    columns = [[] for _ in range(4)]
+    for chunk in _consumption_chunks(consumptions, boundaries, chunk_size):
+        for column, values in zip(columns, chunk):
+            column.append(values)
+
+    # Archived terms are read chunk by chunk from the memory-mapped columns
+    start, end = archive.to_micros(boundaries[0]), archive.to_micros(boundaries[-1])
+    if any(segment.overlaps(start, end) for segment in archive.segments()):
+        if grade:
+            grade_ids = Student.objects.filter(grade=grade).values_list('id', flat=True)
+            allowed = list(grade_ids.filter(id__in=student_ids) if student_ids is not None else grade_ids)
+        else:
+            allowed = student_ids
+        for chunk in archive.iter_chunks(['student_id', 'meal_id', 'portion_consumed', 'consumed_at'], start, end):
+            keep = np.isin(chunk['student_id'], allowed) if allowed is not None else slice(None)
+            offsets = archive.local_day_offsets(chunk['consumed_at'][keep], date_from, n_days)
+            for column, values in zip(columns, (chunk['student_id'][keep], chunk['meal_id'][keep],
+                                                chunk['portion_consumed'][keep], offsets)):
+                column.append(values)
+
+    students, meals, portions, day_offsets = (
+        np.concatenate(column) if column else np.zeros(0) for column in columns
+    )
+    meals = meals.astype(np.int64)
+
+    # Nutrient table of the meals involved, sorted by id so rows are found with searchsorted
+    meal_rows = Meal.objects.filter(id__in=np.unique(meals).tolist()).order_by('id').values_list('id', *NUTRIENTS)
+    meal_table = np.array(list(meal_rows), dtype=np.float64).reshape(-1, len(NUTRIENTS) + 1)
+    meal_ids = meal_table[:, 0].astype(np.int64)
+    positions = np.minimum(np.searchsorted(meal_ids, meals), max(len(meal_ids) - 1, 0))
+    # Archived consumptions of since deleted meals are left out
+    known = meal_ids[positions] == meals if len(meal_ids) else np.zeros(len(meals), dtype=bool)
+    eaten = meal_table[positions[known], 1:] * portions[known].astype(np.float64)[:, None]
+
+    student_ids, student_index = np.unique(students[known].astype(np.int64), return_inverse=True)
+    keys = student_index.astype(np.int64) * n_days + day_offsets[known].astype(np.int64)
+    pairs, daily = _group_sum(keys, eaten)
+    return Intake(date_from, student_ids, pairs // n_days, pairs % n_days, daily)
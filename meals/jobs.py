@@ -0,0 +1,230 @@
+"""Heavy reports computed outside the web process.
+
+Posting to a report's jobs endpoint queues a ``ReportJob`` and answers at
+once with the job's id and poll URL.  The ``run_report_worker`` command
+claims queued jobs and computes them in a pool of worker processes, storing
+each result on its row.  A finished job is handed back to later requests for
+the same report and parameters until the data versions the report depends on
+change; until then, posting again queues nothing.
+
+The report pages go through ``report_for_view``: while a worker is running
+(it refreshes a heartbeat in the cache each time it checks the queue) they
+queue a job and show its result, or an earlier result for the same
+parameters while it is computed, or a page polling for it.  Without a worker
+they compute through the report cache in the web process, as before.
+
+Parameters are validated with the report's filter form and stored as JSON,
+with the intake report's default period filled in, so "the last four weeks"
+asked on different days are different jobs.  Jobs are kept in the default
+database and compute their report in the school database selected when they
+were queued (see ``meals.sharding``); jobs queued in the district view merge
+every school's share of the report and are outdated by a change in any school.
+"""
+import json
+import time
+import traceback
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from . import intake, reports, sharding
+from .forms import IntakeReportForm, WasteReportForm
+from .models import ReportJob
+
+# Report name: form validating its parameters (None when it takes none)
+JOB_FORMS = {
+    'nutrition': None,
+    'waste': WasteReportForm,
+    'intake': IntakeReportForm,
+}
+# Claimed queued rows looked at per attempt; another worker may win some of them
+CLAIM_CANDIDATES = 10
+WORKER_HEARTBEAT_KEY = 'report-worker:heartbeat'
+
+
+def get_job_timeout():
+    return getattr(settings, 'MEALS_REPORT_JOB_TIMEOUT', 30 * 60)
+
+
+def get_job_retention():
+    return getattr(settings, 'MEALS_REPORT_JOB_RETENTION', 7 * 24 * 60 * 60)
+
+
+def get_worker_heartbeat():
+    return getattr(settings, 'MEALS_REPORT_WORKER_HEARTBEAT', 30)
+
+
+def heartbeat():
+    """Record that a worker is checking the queue; it counts as running for ``MEALS_REPORT_WORKER_HEARTBEAT``."""
+    cache.set(WORKER_HEARTBEAT_KEY, time.time(), get_worker_heartbeat())
+
+
+def worker_running():
+    return cache.get(WORKER_HEARTBEAT_KEY) is not None
+
+
+def clean_params(name, data):
+    """(parameters for the report function, None) or (None, form errors)."""
+    form_class = JOB_FORMS[name]
+    if form_class is None:
+        return {}, None
+    form = form_class(data)
+    if not form.is_valid():
+        return None, form.errors
+    params = {key: value for key, value in form.cleaned_data.items() if value not in (None, '')}
+    if name == 'intake':
+        params['date_from'], params['date_to'] = intake.default_period(params.get('date_from'), params.get('date_to'))
+    return params, None
+
+
+def _stored_params(params):
+    return {key: value.isoformat() if isinstance(value, date) else value for key, value in params.items()}
+
+
+def _encode_version(version):
+    return json.dumps(list(version))
+
+
+def current_version(name):
+    _, dependencies = reports.REPORTS[name]
+    return _encode_version(reports.current_data_state(dependencies)[0])
+
+
+def enqueue(name, params):
+    """The job computing report ``name`` with cleaned ``params``: a reusable one, or a newly queued one."""
+    key = reports.cache_key(name, params)
+    version = current_version(name)
+    reusable = ReportJob.objects.filter(
+        params_key=key, version=version,
+    ).exclude(status=ReportJob.FAILED).order_by('-id').first()
+    if reusable is not None:
+        return reusable
+    return ReportJob.objects.create(name=name, database=sharding.current_database(), params=_stored_params(params),
+                                    params_key=key, version=version)
+
+
+def claim_next():
+    """Mark the oldest queued job running and return its id, or None when the queue is empty."""
+    candidates = ReportJob.objects.filter(status=ReportJob.QUEUED).order_by('id').values_list('id', flat=True)
+    for job_id in candidates[:CLAIM_CANDIDATES]:
+        # The status condition makes the claim atomic: of several workers, one updates the row
+        if ReportJob.objects.filter(id=job_id, status=ReportJob.QUEUED).update(
+                status=ReportJob.RUNNING, started_at=timezone.now()):
+            return job_id
+    return None
+
+
+def fail(job_id, error):
+    ReportJob.objects.filter(id=job_id).update(status=ReportJob.FAILED, error=error, finished_at=timezone.now())
+
+
+def requeue_stale():
+    """Queue again the jobs left running longer than ``MEALS_REPORT_JOB_TIMEOUT`` (their worker died)."""
+    cutoff = timezone.now() - timedelta(seconds=get_job_timeout())
+    return ReportJob.objects.filter(status=ReportJob.RUNNING, started_at__lt=cutoff).update(
+        status=ReportJob.QUEUED, started_at=None)
+
+
+def prune():
+    """Delete finished jobs older than ``MEALS_REPORT_JOB_RETENTION``; returns how many."""
+    cutoff = timezone.now() - timedelta(seconds=get_job_retention())
+    deleted, _ = ReportJob.objects.filter(
+        status__in=[ReportJob.DONE, ReportJob.FAILED], finished_at__lt=cutoff,
+    ).delete()
+    return deleted
+
+
+def run_job(job_id):
+    """Compute a claimed job and store its result, or its traceback if it failed."""
+    try:
+        job = ReportJob.objects.get(id=job_id)
+        compute, dependencies = reports.REPORTS[job.name]
+        params, errors = clean_params(job.name, job.params)
+        if errors:
+            raise ValueError(f'Invalid parameters: {errors.as_json()}')
+        with sharding.use_database(job.database):
+            # Read before computing, like the report cache, so changes made meanwhile outdate the result
+            version = reports.current_data_state(dependencies)[0]
+            if sharding.is_district():
+                result = reports.compute_district_report(job.name, **params)
+            else:
+                result = compute(**params)
+        ReportJob.objects.filter(id=job_id).update(
+            status=ReportJob.DONE, result=result, version=_encode_version(version), error='',
+            finished_at=timezone.now(),
+        )
+    except Exception:
+        fail(job_id, traceback.format_exc())
+    finally:
+        connections.close_all()
+
+
+def job_state(job):
+    state = {
+        'id': job.pk,
+        'report': job.name,
+        'params': job.params,
+        'status': job.status,
+        'url': reverse('report-job-detail', kwargs={'pk': job.pk}),
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
+    if job.status == ReportJob.QUEUED:
+        # Jobs ahead of this one in the queue
+        state['position'] = ReportJob.objects.filter(status=ReportJob.QUEUED, id__lt=job.pk).count()
+    elif job.status == ReportJob.RUNNING:
+        state['elapsed'] = round((timezone.now() - job.started_at).total_seconds(), 1)
+    elif job.status == ReportJob.DONE:
+        state['result'] = job.result
+        with sharding.use_database(job.database):
+            state['outdated'] = job.version != current_version(job.name)
+    else:
+        state['error'] = job.error.strip().splitlines()[-1] if job.error.strip() else ''
+    return state
+
+
+def report_for_view(name, params):
+    """(result or None, job or None) of report ``name`` for a page, with its filters in ``params``.
+
+    The job is the one queued for the current result, while the result shown
+    is an earlier one for the same parameters, or None if there is none yet.
+    """
+    params = {key: value for key, value in params.items() if value not in (None, '')}
+    if not worker_running():
+        get_report = reports.get_district_report if sharding.is_district() else reports.get_report
+        return get_report(name, **params), None
+    job = enqueue(name, params)
+    if job.status == ReportJob.DONE:
+        return job.result, None
+    earlier = ReportJob.objects.filter(params_key=job.params_key, status=ReportJob.DONE).order_by('-id').first()
+    return (earlier.result if earlier is not None else None), job
+
+
+@sharding.district_view
+@csrf_exempt
+@require_POST
+def create(request, name):
+    if name not in JOB_FORMS:
+        raise Http404('Unknown report.')
+    params, errors = clean_params(name, request.POST)
+    if errors is not None:
+        return JsonResponse({'errors': errors}, status=400)
+    job = enqueue(name, params)
+    response = JsonResponse(job_state(job), status=200 if job.status == ReportJob.DONE else 202)
+    response['Location'] = reverse('report-job-detail', kwargs={'pk': job.pk})
+    return response
+
+
+@sharding.district_view
+@require_GET
+def detail(request, pk):
+    return JsonResponse(job_state(get_object_or_404(ReportJob, pk=pk)))
@@ -0,0 +1,49 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+
+from meals import archive, reports
+from meals.exports import day_start
+from meals.models import MealConsumption
+
+
+class Command(BaseCommand):
+    help = 'Move consumptions from before a date into a memory-mappable column archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', required=True, type=date.fromisoformat,
+                            help='First day (YYYY-MM-DD) that stays in the live table')
+        parser.add_argument('--name', help='Segment name; defaults to before-<date>')
+        parser.add_argument('--chunk-size', type=int, default=10_000)
+        parser.add_argument('--vacuum', action='store_true', help='Run VACUUM afterwards to shrink the database file')
+
+    def handle(self, *args, **options):
+        name = options['name'] or f'before-{options["before"].isoformat()}'
+        archive_dir = archive.get_archive_dir()
+        started = time.monotonic()
+
+        if any(meta['name'] == name for meta in archive.read_index(archive_dir)):
+            # A previous run wrote the segment but may have stopped before deleting every row
+            self.stdout.write(f'Segment {name} already exists; removing any of its rows still in the live table.')
+        else:
+            try:
+                meta = archive.archive_before(day_start(options['before']), name, archive_dir, options['chunk_size'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            if meta is None:
+                self.stdout.write(f'No consumptions before {options["before"]}; nothing archived.')
+                return
+            self.stdout.write(f'Wrote {meta["rows"]} consumptions to {archive_dir / name}')
+
+        deleted = archive.delete_archived(name, archive_dir)
+        reports.bump_versions(reports.CONSUMPTIONS)
+        connection = connections[router.db_for_write(MealConsumption)]
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {deleted} archived consumptions from the live table in {time.monotonic() - started:.1f}s.'
+        ))
@@ -0,0 +1,69 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from meals import roster
+from meals.batch import validate_consumption_records
+from meals.models import Meal, Student
+
+
+class Command(BaseCommand):
+    help = "Time check-in validation against today's serving roster and against the ORM alone"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkins', type=int, default=1000, help='Single-record check-ins per run')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per path; the median is reported')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if options['checkins'] < 1 or options['repeat'] < 1:
+            raise CommandError('--checkins and --repeat must be positive')
+        meals = list(Meal.objects.filter(serving_date=timezone.localdate()).values_list('id', flat=True))
+        if not meals:
+            raise CommandError('No meals are served today; generate data ending today first')
+        rng = random.Random(options['seed'])
+        student_ids = list(Student.objects.values_list('student_id', flat=True))
+        records = [
+            {'student_id': rng.choice(student_ids), 'meal': rng.choice(meals), 'portion_consumed': 1.0}
+            for _ in range(options['checkins'])
+        ]
+
+        with override_settings(MEALS_SERVING_ROSTER=False):
+            orm = self.run(records, options['repeat'])
+        with override_settings(MEALS_SERVING_ROSTER=True):
+            roster._clear()
+            started = time.perf_counter()
+            service = roster.get_roster()
+            build_ms = (time.perf_counter() - started) * 1000
+            cached = self.run(records, options['repeat'])
+        roster._clear()
+
+        self.stdout.write(f'Roster of {len(service.student_pks)} students and {len(service.meal_pks)} meals '
+                          f'built in {build_ms:.1f} ms')
+        for name, (micros, queries) in (('orm', orm), ('roster', cached)):
+            self.stdout.write(f'{name:<8} {micros:>10.1f} us/check-in {queries:>6.2f} queries/check-in')
+        self.stdout.write(f'Speed-up {orm[0] / cached[0]:.1f}x; the roster pays for itself after '
+                          f'{build_ms * 1000 / max(orm[0] - cached[0], 1e-9):.0f} check-ins')
+
+    def run(self, records, repeat):
+        """(median microseconds, queries) per check-in, validating each record on its own."""
+        timings = []
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            for _ in range(repeat):
+                started = time.perf_counter()
+                for record in records:
+                    validate_consumption_records([record])
+                timings.append((time.perf_counter() - started) / len(records) * 1_000_000)
+        return statistics.median(timings), queries / repeat / len(records)
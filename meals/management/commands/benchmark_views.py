@@ -0,0 +1,201 @@
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import URLPattern, reverse
+
+from meals import urls as meal_urls
+from meals.models import Student, Meal
+
+# Write endpoints that cannot be exercised with a GET, and report jobs (no sample row to poll)
+SKIPPED = {'consumption-batch', 'report-job-create', 'report-job-detail'}
+
+
+def view_urls():
+    """Yield (name, url) for every named GET-able route in meals/urls.py, using sample rows for <pk> routes."""
+    student = Student.objects.order_by('id').values_list('id', flat=True).first()
+    meal = Meal.objects.order_by('id').values_list('id', flat=True).first()
+    for pattern in meal_urls.urlpatterns:
+        if not isinstance(pattern, URLPattern) or not pattern.name or pattern.name in SKIPPED:
+            continue
+        if 'pk' in pattern.pattern.converters:
+            pk = student if pattern.name.startswith('student') else meal
+            if pk is None:
+                continue
+            yield pattern.name, reverse(pattern.name, kwargs={'pk': pk})
+        else:
+            yield pattern.name, reverse(pattern.name)
+
+
+def body_size(response):
+    # Streaming responses are only finished once their body has been consumed
+    if not response.streaming:
+        return len(response.content)
+    if response.is_async:
+        return async_to_sync(abody_size)(response)
+    return sum(len(chunk) for chunk in response.streaming_content)
+
+
+async def abody_size(response):
+    if not response.streaming:
+        return len(response.content)
+    if response.is_async:
+        return sum([len(chunk) async for chunk in response.streaming_content])
+    return sum(len(chunk) for chunk in response.streaming_content)
+
+
+def measure(client, url):
+    """One request through the WSGI handler (``Client``) or the ASGI handler (``AsyncClient``)."""
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    # Counted through a wrapper rather than connection.queries, so queries run on the pool in meals.parallel count too
+    with connection.execute_wrapper(count):
+        response = async_to_sync(client.get)(url) if isinstance(client, AsyncClient) else client.get(url)
+        first_byte = time.perf_counter() - started
+        size = body_size(response)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'status': response.status_code,
+        'wall_ms': elapsed * 1000,
+        'first_byte_ms': first_byte * 1000,
+        'queries': queries,
+        'peak_kib': peak / 1024,
+        'bytes': size,
+    }
+
+
+def measure_concurrent(handler, url, concurrency):
+    """Per-request wall times (ms) of ``concurrency`` simultaneous requests through one handler."""
+    if handler == 'asgi':
+        async def one():
+            started = time.perf_counter()
+            await abody_size(await AsyncClient().get(url))
+            return (time.perf_counter() - started) * 1000
+
+        async def run_all():
+            return await asyncio.gather(*(one() for _ in range(concurrency)))
+
+        return async_to_sync(run_all)()
+
+    def one(_):
+        started = time.perf_counter()
+        body_size(Client().get(url))
+        return (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(concurrency)))
+
+
+class Command(BaseCommand):
+    help = 'Time every view in meals/urls.py through the test client and record a JSON baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Requests per view; the median is recorded')
+        parser.add_argument('--only', nargs='+', metavar='NAME', help='Only benchmark these URL names')
+        parser.add_argument('--skip', nargs='+', metavar='NAME', default=[], help='URL names to leave out')
+        parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a JSON file written by a previous run')
+        parser.add_argument('--threshold', type=float, default=20.0,
+                            help='Percent increase in wall time or queries reported as a regression')
+        parser.add_argument('--asgi', action='store_true',
+                            help='Also time each view through the ASGI handler, side by side with WSGI')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Also time this many simultaneous requests per view (per handler)')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--repeat and --concurrency must be positive')
+
+        # The test client's host is not a real deployment host
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            results = self.run_views(Client(), AsyncClient() if options['asgi'] else None, options)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as handle:
+                json.dump(results, handle, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as handle:
+                baseline = json.load(handle)
+            regressions = self.compare(baseline, results, options['threshold'])
+            if regressions:
+                raise CommandError(f'{regressions} regression(s) above {options["threshold"]}%')
+
+    def run_views(self, client, async_client, options):
+        handlers = ['wsgi'] + (['asgi'] if async_client else [])
+        results = {}
+        for name, url in view_urls():
+            if (options['only'] and name not in options['only']) or name in options['skip']:
+                continue
+            try:
+                runs = [measure(client, url) for _ in range(options['repeat'])]
+                asgi_runs = [measure(async_client, url) for _ in range(options['repeat'])] if async_client else []
+                concurrent = {
+                    handler: [
+                        latency for _ in range(options['repeat'])
+                        for latency in measure_concurrent(handler, url, options['concurrency'])
+                    ]
+                    for handler in handlers
+                } if options['concurrency'] > 1 else {}
+            except Exception as e:
+                results[name] = {'url': url, 'error': f'{type(e).__name__}: {e}'}
+                self.stderr.write(f'{name:<24} {url:<40} failed: {results[name]["error"]}')
+                continue
+            results[name] = {
+                'url': url,
+                'status': runs[-1]['status'],
+                'wall_ms': round(statistics.median(r['wall_ms'] for r in runs), 2),
+                'first_byte_ms': round(statistics.median(r['first_byte_ms'] for r in runs), 2),
+                'queries': max(r['queries'] for r in runs),
+                'peak_kib': round(max(r['peak_kib'] for r in runs), 1),
+                'bytes': runs[-1]['bytes'],
+            }
+            row = results[name]
+            line = (f'{name:<24} {row["status"]:>3} {row["wall_ms"]:>10.2f} ms {row["queries"]:>5} queries '
+                    f'{row["peak_kib"]:>10.1f} KiB peak')
+            if asgi_runs:
+                row['asgi_status'] = asgi_runs[-1]['status']
+                row['asgi_wall_ms'] = round(statistics.median(r['wall_ms'] for r in asgi_runs), 2)
+                line += f' | asgi {row["asgi_wall_ms"]:>10.2f} ms'
+            for handler, latencies in concurrent.items():
+                key = 'concurrent_ms' if handler == 'wsgi' else 'asgi_concurrent_ms'
+                row[key] = round(statistics.median(latencies), 2)
+                line += f' | {handler} x{options["concurrency"]} {row[key]:>10.2f} ms'
+            self.stdout.write(line)
+        return results
+
+    def compare(self, baseline, results, threshold):
+        regressions = 0
+        self.stdout.write('')
+        self.stdout.write(f'{"view":<24} {"wall ms":>20} {"queries":>12} {"peak KiB":>22}')
+        for name, current in sorted(results.items()):
+            before = baseline.get(name)
+            if not before or 'error' in before or 'error' in current:
+                continue
+            changes = []
+            for metric in ('wall_ms', 'queries', 'peak_kib'):
+                old, new = before[metric], current[metric]
+                change = (new - old) / old * 100 if old else 0.0
+                changes.append(f'{old:>8} -> {new:<8} ({change:+.0f}%)')
+                if metric != 'peak_kib' and change > threshold:
+                    regressions += 1
+            self.stdout.write(f'{name:<24} ' + ' '.join(changes))
+        return regressions
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from meals import exports
+from meals.forms import ExportForm
+
+
+class Command(BaseCommand):
+    help = 'Stream consumption or per-meal waste data as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(exports.EXPORTS))
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--date-from', help='First consumption day (YYYY-MM-DD)')
+        parser.add_argument('--date-to', help='Last consumption day (YYYY-MM-DD)')
+        parser.add_argument('--meal-type', help='Only export this meal type')
+        parser.add_argument('-o', '--output', help='Output file (defaults to stdout)')
+
+    def handle(self, *args, **options):
+        # Validate the filters with the same form as the export endpoints
+        form = ExportForm({
+            'format': options['format'],
+            'date_from': options['date_from'],
+            'date_to': options['date_to'],
+            'meal_type': options['meal_type'],
+        })
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+
+        rows_func, fields = exports.EXPORTS[options['dataset']]
+        rows = rows_func(
+            date_from=form.cleaned_data.get('date_from'),
+            date_to=form.cleaned_data.get('date_to'),
+            meal_type=form.cleaned_data.get('meal_type'),
+        )
+
+        lines = exports.render(rows, fields, options['format'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,19 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from meals import dietary
+
+
+class Command(BaseCommand):
+    help = 'Finalize the menu of serving dates and precompute their dietary conflicts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dates', nargs='*', type=date.fromisoformat,
+                            help='Serving dates (YYYY-MM-DD); defaults to today')
+
+    def handle(self, *args, **options):
+        for day in options['dates'] or [timezone.localdate()]:
+            conflicts = dietary.build_day(day)
+            self.stdout.write(self.style.SUCCESS(f'Finalized {day}: {conflicts} dietary conflicts.'))
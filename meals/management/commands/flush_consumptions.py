@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from meals import writebehind
+
+
+class Command(BaseCommand):
+    help = 'Write all queued write-behind consumption records to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Write-behind log directory (defaults to MEALS_WRITE_BEHIND_DIR, '
+                                          "or every school's directory under it in the district view)")
+
+    def handle(self, *args, **options):
+        written = writebehind.drain_directory(options['dir'])
+        self.stdout.write(self.style.SUCCESS(f'Flushed {written} queued consumption records.'))
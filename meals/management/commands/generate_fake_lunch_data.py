@@ -0,0 +1,164 @@
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.utils import timezone
+
+from meals import counters, dietary, reports, rollups
+from meals.models import (
+    Meal, MealConflict, MealConsumption, MealDailyRollup, ServingDay, Student, Tombstone,
+)
+
+FIRST_NAMES = ['Aarav', 'Maya', 'Liam', 'Zara', 'Noah', 'Isha', 'Ethan', 'Sofia', 'Kabir', 'Ava', 'Omar', 'Mia']
+LAST_NAMES = ['Patel', 'Smith', 'Khan', 'Garcia', 'Chen', 'Iyer', 'Brown', 'Silva', 'Mehta', 'Nguyen', 'Lopez']
+RESTRICTIONS = ['Peanuts', 'Dairy', 'Gluten', 'Vegetarian', 'Shellfish', 'Eggs']
+DISHES = {
+    'breakfast': ['Oatmeal', 'Pancakes', 'Idli', 'Egg Wrap', 'Fruit Bowl', 'Poha'],
+    'lunch': ['Rice Bowl', 'Pasta', 'Dal Khichdi', 'Veggie Burger', 'Chicken Curry', 'Rajma Chawal'],
+    'snack': ['Apple Slices', 'Yogurt Cup', 'Trail Mix', 'Sprouts Chaat', 'Cheese Stick'],
+}
+DISH_ALLERGENS = {
+    'Pancakes': ['gluten', 'eggs', 'dairy'],
+    'Egg Wrap': ['eggs', 'gluten'],
+    'Pasta': ['gluten'],
+    'Veggie Burger': ['gluten', 'soy'],
+    'Chicken Curry': ['meat', 'dairy'],
+    'Yogurt Cup': ['dairy'],
+    'Trail Mix': ['peanuts', 'tree-nuts'],
+    'Cheese Stick': ['dairy'],
+}
+# Serving window start per meal type, as (hour, minute)
+SERVICE_START = {'breakfast': (7, 30), 'lunch': (12, 0), 'snack': (15, 0)}
+# A fixed first serving day, so a seed gives the same dataset whenever it is generated
+DEFAULT_START_DATE = date(2025, 1, 6)
+# Emptied by --clear, rows referring to others first
+CLEARED_MODELS = [
+    MealConsumption, MealConflict, dietary.MealTag, dietary.StudentTag, MealDailyRollup, ServingDay, Meal, Student,
+    Tombstone,
+]
+
+
+class Command(BaseCommand):
+    help = 'Generate a reproducible synthetic dataset of students, meals and consumptions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=50_000)
+        parser.add_argument('--meals', type=int, default=5_000)
+        parser.add_argument('--consumptions', type=int, default=10_000_000)
+        parser.add_argument('--days', type=int, default=180, help='Number of serving days')
+        parser.add_argument('--start-date', type=date.fromisoformat, default=DEFAULT_START_DATE,
+                            help=f'First serving day, YYYY-MM-DD (default {DEFAULT_START_DATE.isoformat()})')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--chunk-size', type=int, default=5_000)
+        parser.add_argument('--clear', action='store_true', help='Delete existing lunch data first')
+
+    def handle(self, *args, **options):
+        if options['students'] < 1 or options['meals'] < 1 or options['days'] < 1:
+            raise CommandError('--students, --meals and --days must be positive')
+
+        self.rng = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+
+        if options['clear']:
+            with transaction.atomic(using=router.db_for_write(MealConsumption)):
+                # Raw deletes skip the per-row signals (counters, rollups, dietary tags, tombstones); rollups and
+                # counters are rebuilt below, and kiosks synced against the old data need a full pull
+                for model in CLEARED_MODELS:
+                    model.objects.all()._raw_delete(model.objects.db)
+
+        started = time.monotonic()
+        student_ids = self.create_students(options['students'])
+        meals = self.create_meals(options['meals'], options['start_date'], options['days'])
+        self.create_consumptions(options['consumptions'], student_ids, meals)
+        buckets = rollups.rebuild()
+        counters.recount()
+        reports.bump_versions(reports.STUDENTS, reports.MEALS, reports.CONSUMPTIONS)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {len(student_ids)} students, {len(meals)} meals, {options["consumptions"]} consumptions '
+            f'and {buckets} rollups in {time.monotonic() - started:.1f}s.'
+        ))
+
+    def chunks(self, total, factory):
+        for start in range(0, total, self.chunk_size):
+            yield [factory(n) for n in range(start, min(start + self.chunk_size, total))]
+
+    def create_students(self, count):
+        offset = Student.objects.count()
+        rng = self.rng
+
+        def student(n):
+            return Student(
+                student_id=f'S{offset + n:07d}',
+                name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                grade=str(rng.randint(1, 12)),
+                dietary_restrictions=rng.choice(RESTRICTIONS) if rng.random() < 0.1 else '',
+            )
+
+        for chunk in self.chunks(count, student):
+            Student.objects.bulk_create(chunk)
+        created = list(Student.objects.order_by('id').values_list('id', flat=True)[offset:])
+        dietary.sync_student_tags(Student.objects.filter(id__gte=created[0]).exclude(
+            dietary_restrictions='').only('id', 'dietary_restrictions'))
+        self.stdout.write(f'{count} students created')
+        return created
+
+    def create_meals(self, count, first_day, days):
+        meal_types = list(DISHES)
+        rng = self.rng
+
+        def meal(n):
+            meal_type = meal_types[n % len(meal_types)]
+            protein = round(rng.uniform(2, 35), 1)
+            carbohydrates = round(rng.uniform(10, 90), 1)
+            fats = round(rng.uniform(1, 30), 1)
+            return Meal(
+                name=rng.choice(DISHES[meal_type]),
+                meal_type=meal_type,
+                serving_date=first_day + timedelta(days=n * days // count),
+                protein=protein,
+                carbohydrates=carbohydrates,
+                fats=fats,
+            )
+
+        created = []
+        for chunk in self.chunks(count, meal):
+            created.extend(Meal.objects.bulk_create(chunk))
+        tags = dietary.get_tags(name for names in DISH_ALLERGENS.values() for name in names)
+        dietary.MealTag.objects.bulk_create([
+            dietary.MealTag(meal_id=m.id, dietarytag_id=tags[name].pk)
+            for m in created for name in DISH_ALLERGENS.get(m.name, [])
+        ], batch_size=dietary.INSERT_BATCH_SIZE)
+        self.stdout.write(f'{count} meals created')
+        return [(m.id, m.meal_type, m.serving_date) for m in created]
+
+    def create_consumptions(self, count, student_ids, meals):
+        rng = self.rng
+        tz = timezone.get_current_timezone()
+
+        def consumption(n):
+            meal_id, meal_type, serving_date = meals[rng.randrange(len(meals))]
+            hour, minute = SERVICE_START[meal_type]
+            # n in the microseconds keeps (student, meal, consumed_at) unique
+            consumed_at = datetime(serving_date.year, serving_date.month, serving_date.day, hour, minute, tzinfo=tz)
+            consumed_at += timedelta(seconds=rng.randrange(45 * 60), microseconds=n % 1_000_000)
+            portion = round(rng.betavariate(4, 2), 2)
+            return MealConsumption(
+                student_id=student_ids[rng.randrange(len(student_ids))],
+                meal_id=meal_id,
+                consumed_at=consumed_at,
+                portion_consumed=portion,
+                waste_weight=round((1 - portion) * rng.uniform(150, 350), 1) if rng.random() < 0.9 else None,
+            )
+
+        started = time.monotonic()
+        written = 0
+        for chunk in self.chunks(count, consumption):
+            # Derived tables and counters are rebuilt once at the end instead of per chunk
+            MealConsumption.objects.bulk_create(chunk, batch_size=500)
+            written += len(chunk)
+            if written % (self.chunk_size * 20) == 0 or written == count:
+                rate = written / max(time.monotonic() - started, 1e-6)
+                self.stdout.write(f'{written} consumptions created ({rate:.0f} rows/s)')
@@ -0,0 +1,159 @@
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from meals import counters, dietary, reports
+from meals.batch import INSERT_BATCH_SIZE, bulk_insert_consumptions, validate_consumption_records
+from meals.forms import StudentForm, MealForm
+from meals.models import Student, Meal
+
+
+class ImportStudentForm(StudentForm):
+    def validate_unique(self):
+        # Rows are upserted on student_id, so an existing id is not an error
+        pass
+
+
+def read_rows(handle, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(handle)
+        return
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError('each NDJSON line must be an object')
+        yield record
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def form_errors(form):
+    return {field: list(errors) for field, errors in form.errors.items()}
+
+
+class Command(BaseCommand):
+    help = 'Stream students, meals or consumptions from a CSV or NDJSON file into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=['students', 'meals', 'consumptions'])
+        parser.add_argument('path', help="Input file, or '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Input format (defaults to the file extension, csv for stdin)')
+        parser.add_argument('--chunk-size', type=int, default=INSERT_BATCH_SIZE,
+                            help='Rows validated and written per transaction')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format']
+        if fmt is None:
+            fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        writer = getattr(self, f'write_{options["model"]}')
+        self.imported = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+        handle = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            rows = read_rows(handle, fmt)
+            line_no = 1
+            for chunk in chunked(rows, options['chunk_size']):
+                writer(chunk, line_no)
+                line_no += len(chunk)
+                self.report_progress()
+        except (ValueError, csv.Error) as e:
+            raise CommandError(f'Could not parse input near row {self.imported + self.failed + 1}: {e}')
+        finally:
+            if handle is not sys.stdin:
+                handle.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.imported} {options["model"]} ({self.failed} rejected) in '
+            f'{time.monotonic() - self.started:.1f}s.'
+        ))
+
+    def report_progress(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        self.stdout.write(f'{self.imported} rows imported, {self.failed} rejected, '
+                          f'{self.imported / elapsed:.0f} rows/s')
+
+    def reject(self, line_no, errors):
+        self.failed += 1
+        self.stderr.write(f'Row {line_no}: {json.dumps(errors)}')
+
+    def write_students(self, chunk, first_line):
+        students = {}
+        for offset, row in enumerate(chunk):
+            form = ImportStudentForm(row)
+            if not form.is_valid():
+                self.reject(first_line + offset, form_errors(form))
+                continue
+            student = form.save(commit=False)
+            # A later row for the same student_id wins, as it would with sequential updates
+            students[student.student_id] = student
+
+        with transaction.atomic(using=router.db_for_write(Student)):
+            # bulk_create skips the signals, and upserted rows are not new students
+            existing = Student.objects.filter(student_id__in=list(students)).count()
+            Student.objects.bulk_create(
+                students.values(),
+                batch_size=INSERT_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['student_id'],
+                update_fields=['name', 'grade', 'dietary_restrictions', 'updated_at'],
+            )
+            counters.increment(students=len(students) - existing)
+            reports.bump_versions(reports.STUDENTS)
+            # The upsert skips the signals that keep the dietary tags in step with the text
+            upserted = Student.objects.filter(student_id__in=list(students)).only('id', 'dietary_restrictions')
+            student_pks = list(dietary.sync_student_tags(upserted))
+            dietary.refresh_students(student_pks)
+        self.imported += len(students)
+
+    def write_meals(self, chunk, first_line):
+        meals = []
+        allergens = []
+        for offset, row in enumerate(chunk):
+            form = MealForm(row)
+            if not form.is_valid():
+                self.reject(first_line + offset, form_errors(form))
+                continue
+            meals.append(form.save(commit=False))
+            allergens.append(form.cleaned_data['allergens'])
+
+        with transaction.atomic(using=router.db_for_write(Meal)):
+            Meal.objects.bulk_create(meals, batch_size=INSERT_BATCH_SIZE)
+            tags = dietary.get_tags(name for names in allergens for name in names)
+            dietary.MealTag.objects.bulk_create([
+                dietary.MealTag(meal_id=meal.pk, dietarytag_id=tags[name].pk)
+                for meal, names in zip(meals, allergens) for name in names
+            ], batch_size=INSERT_BATCH_SIZE)
+            dietary.refresh_meals([meal.pk for meal, names in zip(meals, allergens) if names])
+            counters.increment(meals=len(meals))
+            reports.bump_versions(reports.MEALS)
+        self.imported += len(meals)
+
+    def write_consumptions(self, chunk, first_line):
+        consumptions, errors = validate_consumption_records(chunk)
+        for error in errors:
+            self.reject(first_line + error['index'], error['errors'])
+        if consumptions:
+            bulk_insert_consumptions(consumptions)
+        self.imported += len(consumptions)
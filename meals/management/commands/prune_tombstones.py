@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from meals import sharding, sync
+
+
+class Command(BaseCommand):
+    help = 'Delete the deletion records kiosk sync tokens can no longer ask for'
+
+    def handle(self, *args, **options):
+        if sharding.is_district():
+            deleted = sum(count for _, count in sharding.fan_out(sync.prune_tombstones))
+        else:
+            deleted = sync.prune_tombstones()
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} tombstone(s).'))
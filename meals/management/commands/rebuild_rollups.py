@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from meals import rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily per-meal rollups from the consumption history'
+
+    def handle(self, *args, **options):
+        written = rollups.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {written} daily meal rollups.'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from meals import counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the dashboard counters from the tables and report any drift'
+
+    def handle(self, *args, **options):
+        drifted = counters.recount()
+        for name, (old, new) in sorted(drifted.items()):
+            self.stdout.write(f'{name}: {old} -> {new}')
+        self.stdout.write(self.style.SUCCESS(f'Recounted; {len(drifted)} counter(s) had drifted.'))
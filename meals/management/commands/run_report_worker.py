@@ -0,0 +1,93 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.core.management.base import BaseCommand
+
+from meals import jobs
+
+
+class Command(BaseCommand):
+    help = 'Compute queued report jobs in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Worker processes; 0 computes jobs in this process (default 2)')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds between checks of an empty queue (default 1.0)')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        requeued = jobs.requeue_stale()
+        pruned = jobs.prune()
+        if requeued or pruned:
+            self.stdout.write(f'Requeued {requeued} stale job(s), pruned {pruned} old job(s).')
+        try:
+            if options['processes'] < 1:
+                completed = self.run_inline(options)
+            else:
+                completed = self.run_pool(options)
+        except KeyboardInterrupt:
+            # Jobs still running are requeued by the next worker once they time out
+            return
+        self.stdout.write(self.style.SUCCESS(f'Completed {completed} report job(s).'))
+
+    def run_inline(self, options):
+        completed = 0
+        while True:
+            # Jobs computed here block the heartbeat, so a long one may let the report pages compute meanwhile
+            jobs.heartbeat()
+            job_id = jobs.claim_next()
+            if job_id is None:
+                if options['once']:
+                    return completed
+                time.sleep(options['poll_interval'])
+                continue
+            jobs.run_job(job_id)
+            completed += 1
+
+    def run_pool(self, options):
+        completed = 0
+        while True:
+            finished, broken = self.run_pool_until_broken(options)
+            completed += finished
+            if not broken:
+                return completed
+            self.stderr.write('A worker process died; starting a new pool.')
+
+    def run_pool_until_broken(self, options):
+        """Feed jobs to a pool until the queue is empty (with --once) or a worker process dies."""
+        processes = options['processes']
+        completed = 0
+        running = {}
+        # Spawned workers open their own connections instead of inheriting this process's; they set Django up
+        # before unpickling any task, which imports the models
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=django.setup) as pool:
+            while True:
+                jobs.heartbeat()
+                # Claimed only when a worker is free, so queued jobs stay claimable by other worker commands
+                while len(running) < processes:
+                    job_id = jobs.claim_next()
+                    if job_id is None:
+                        break
+                    running[pool.submit(jobs.run_job, job_id)] = job_id
+                if not running:
+                    if options['once']:
+                        return completed, False
+                    time.sleep(options['poll_interval'])
+                    continue
+                done, _ = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id = running.pop(future)
+                    completed += 1
+                    try:
+                        future.result()
+                    except BrokenProcessPool as e:
+                        # run_job records its own errors, so this is a worker killed mid-job (out of memory,
+                        # a signal); every job of the pool is lost and cannot be told apart from the culprit
+                        for lost_id in [job_id, *running.values()]:
+                            jobs.fail(lost_id, f'Worker process died: {e}')
+                        return completed + len(running), True
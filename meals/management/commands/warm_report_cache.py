@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from meals import reports, sharding
+from meals.models import Meal
+
+
+def default_variants():
+    """The unfiltered reports plus the per meal type waste report, as linked from the navigation."""
+    yield 'nutrition', {}
+    yield 'waste', {}
+    for meal_type, _ in Meal.MEAL_TYPES:
+        yield 'waste', {'meal_type': meal_type}
+
+
+class Command(BaseCommand):
+    help = 'Compute the cached reports ahead of service so the first requests are served from the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', nargs='+', choices=sorted(reports.REPORTS), help='Only warm these reports')
+
+    def handle(self, *args, **options):
+        warmed = 0
+        for name, params in default_variants():
+            if options['report'] and name not in options['report']:
+                continue
+            started = time.perf_counter()
+            if sharding.is_district():
+                # Every school's share of the district report, each in its own database
+                partial, _ = reports.DISTRICT_REPORTS[name]
+                sharding.fan_out(lambda: reports.refresh(partial, params))
+            else:
+                reports.refresh(name, params)
+            warmed += 1
+            self.stdout.write(f'{name} {params or ""} computed in {(time.perf_counter() - started) * 1000:.1f} ms')
+        self.stdout.write(self.style.SUCCESS(f'Warmed {warmed} report(s).'))
@@ -1,4 +1,5 @@
 # Generated by Django 5.2 on 2025-04-14 11:08
+# pylint: disable=line-too-long
 
 import django.core.validators
 import django.db.models.deletion
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:46
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0003_remove_meal_cost_per_serving_delete_feedback'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mealconsumption',
+            name='consumed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
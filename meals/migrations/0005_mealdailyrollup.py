@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import Coalesce, TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    MealConsumption = apps.get_model('meals', 'MealConsumption')
+    MealDailyRollup = apps.get_model('meals', 'MealDailyRollup')
+    # The database being migrated, which the router would not pick for historical models
+    db_alias = schema_editor.connection.alias
+    aggregated = MealConsumption.objects.using(db_alias).annotate(
+        day=TruncDate('consumed_at'),
+    ).values('meal_id', 'day').annotate(
+        consumption_count=Count('id'),
+        portion_sum=Coalesce(Sum('portion_consumed'), 0.0),
+        waste_count=Count('waste_weight'),
+        waste_sum=Coalesce(Sum('waste_weight'), 0.0),
+        waste_min=Min('waste_weight'),
+        waste_max=Max('waste_weight'),
+    ).order_by()
+    MealDailyRollup.objects.using(db_alias).bulk_create(
+        (MealDailyRollup(**row) for row in aggregated.iterator()), batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0004_alter_mealconsumption_consumed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MealDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('consumption_count', models.PositiveIntegerField(default=0)),
+                ('portion_sum', models.FloatField(default=0)),
+                ('waste_count', models.PositiveIntegerField(
+                    default=0, help_text='Consumptions with a recorded waste weight')),
+                ('waste_sum', models.FloatField(default=0)),
+                ('waste_min', models.FloatField(blank=True, null=True)),
+                ('waste_max', models.FloatField(blank=True, null=True)),
+                ('meal', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='meals.meal')),
+            ],
+            options={
+                'unique_together': {('meal', 'day')},
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0005_mealdailyrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mealconsumption',
+            name='meal',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='meals.meal'),
+        ),
+        migrations.AlterField(
+            model_name='mealconsumption',
+            name='student',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='meals.student'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['serving_date'], name='meal_serving_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['meal_type', 'serving_date'], name='meal_type_serving_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mealconsumption',
+            index=models.Index(fields=['consumed_at'], name='consumption_consumed_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mealconsumption',
+            index=models.Index(fields=['meal', 'consumed_at'], name='consumption_meal_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mealconsumption',
+            index=models.Index(fields=['student', 'consumed_at'], name='consumption_student_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mealdailyrollup',
+            index=models.Index(fields=['day', 'meal'], name='rollup_day_meal_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['grade'], name='student_grade_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:56
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_counters(apps, schema_editor):
+    Counter = apps.get_model('meals', 'Counter')
+    MealConsumption = apps.get_model('meals', 'MealConsumption')
+    db_alias = schema_editor.connection.alias
+    consumptions = MealConsumption.objects.using(db_alias)
+    Counter.objects.using(db_alias).bulk_create([
+        Counter(name='students', value=apps.get_model('meals', 'Student').objects.using(db_alias).count()),
+        Counter(name='meals', value=apps.get_model('meals', 'Meal').objects.using(db_alias).count()),
+        Counter(name='consumptions', value=consumptions.count()),
+        Counter(name='waste_weight', value=consumptions.aggregate(total=Sum('waste_weight'))['total'] or 0),
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0006_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from meals.dietary import parse_tags
+
+
+def backfill_student_tags(apps, schema_editor):
+    DietaryTag = apps.get_model('meals', 'DietaryTag')
+    Student = apps.get_model('meals', 'Student')
+    StudentTag = Student.dietary_tags.through
+    db_alias = schema_editor.connection.alias
+    parsed = {
+        pk: parse_tags(text)
+        for pk, text in Student.objects.using(db_alias).exclude(dietary_restrictions='').values_list(
+            'id', 'dietary_restrictions')
+    }
+    names = {name for tags in parsed.values() for name in tags}
+    DietaryTag.objects.using(db_alias).bulk_create([DietaryTag(name=name) for name in sorted(names)])
+    tags = dict(DietaryTag.objects.using(db_alias).values_list('name', 'id'))
+    StudentTag.objects.using(db_alias).bulk_create([
+        StudentTag(student_id=pk, dietarytag_id=tags[name]) for pk, names in parsed.items() for name in names
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0007_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DietaryTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServingDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('finalized_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='allergen_tags',
+            field=models.ManyToManyField(blank=True, related_name='meals', to='meals.dietarytag'),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='dietary_tags',
+            field=models.ManyToManyField(blank=True, related_name='students', to='meals.dietarytag'),
+        ),
+        migrations.CreateModel(
+            name='MealConflict',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tags', models.CharField(help_text='Comma-separated conflicting tags', max_length=200)),
+                ('meal', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='conflicts', to='meals.meal')),
+                ('student', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='meal_conflicts', to='meals.student')),
+            ],
+            options={
+                'unique_together': {('meal', 'student')},
+            },
+        ),
+        migrations.RunPython(backfill_student_tags, migrations.RunPython.noop),
+    ]
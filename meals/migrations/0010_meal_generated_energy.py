@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:18
+# pylint: disable=line-too-long
+
+import django.db.models.expressions
+import django.db.models.functions.comparison
+from importlib import import_module
+
+from django.db import migrations, models
+
+search_index = import_module('meals.migrations.0009_search_index')
+
+
+def recreate_meal_search_index(apps, schema_editor):
+    # SQLite rebuilds meals_meal to change its columns, which drops the triggers feeding meals_meal_fts
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for trigger in ('insert', 'delete', 'update'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS meals_meal_fts_{trigger}')
+    schema_editor.execute('DROP TABLE IF EXISTS meals_meal_fts')
+    for statement in search_index.index_sql('meals_meal', search_index.INDEXES['meals_meal']):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_meal_search_index),
+        # A column cannot become generated in place. Re-adding it recomputes the calories of every existing
+        # meal, including those saved through MealUpdateView, which never updated them
+        migrations.RemoveField(
+            model_name='meal',
+            name='calories',
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='calories',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(4), '*', django.db.models.expressions.CombinedExpression(models.F('protein'), '+', models.F('carbohydrates'))), '+', django.db.models.expressions.CombinedExpression(models.Value(9), '*', models.F('fats'))), models.IntegerField()), output_field=models.IntegerField()),
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='carbohydrates_pct',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(4), '*', models.F('carbohydrates')), '*', models.Value(100.0)), '/', django.db.models.functions.comparison.NullIf(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(4), '*', django.db.models.expressions.CombinedExpression(models.F('protein'), '+', models.F('carbohydrates'))), '+', django.db.models.expressions.CombinedExpression(models.Value(9), '*', models.F('fats'))), 0)), output_field=models.FloatField()),
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='fats_pct',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(9), '*', models.F('fats')), '*', models.Value(100.0)), '/', django.db.models.functions.comparison.NullIf(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(4), '*', django.db.models.expressions.CombinedExpression(models.F('protein'), '+', models.F('carbohydrates'))), '+', django.db.models.expressions.CombinedExpression(models.Value(9), '*', models.F('fats'))), 0)), output_field=models.FloatField()),
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='protein_pct',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(4), '*', models.F('protein')), '*', models.Value(100.0)), '/', django.db.models.functions.comparison.NullIf(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.Value(4), '*', django.db.models.expressions.CombinedExpression(models.F('protein'), '+', models.F('carbohydrates'))), '+', django.db.models.expressions.CombinedExpression(models.Value(9), '*', models.F('fats'))), 0)), output_field=models.FloatField()),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['calories'], name='meal_calories_idx'),
+        ),
+        migrations.RunPython(recreate_meal_search_index, migrations.RunPython.noop),
+    ]
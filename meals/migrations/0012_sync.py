@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:23
+
+import django.utils.timezone
+from importlib import import_module
+
+from django.db import migrations, models
+
+search_index = import_module('meals.migrations.0009_search_index')
+
+
+def recreate_search_indexes(apps, schema_editor):
+    # Adding the updated_at columns rebuilds meals_student and meals_meal on SQLite, dropping the FTS triggers
+    search_index.drop_indexes(apps, schema_editor)
+    search_index.create_indexes(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0011_counter_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_search_indexes),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.PositiveIntegerField()),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='mealconsumption',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['updated_at'], name='meal_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['updated_at'], name='student_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['model', 'deleted_at'], name='tombstone_model_deleted_idx'),
+        ),
+        migrations.RunPython(recreate_search_indexes, migrations.RunPython.noop),
+    ]
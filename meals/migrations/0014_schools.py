@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:39
+# pylint: disable=line-too-long
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0013_report_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='School',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.SlugField(help_text="Also names the school's database alias", max_length=30, unique=True)),
+                ('name', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='reportjob',
+            name='database',
+            field=models.CharField(default='default', max_length=40),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:57
+# pylint: disable=line-too-long
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0014_schools'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MealSearchEntry',
+            fields=[
+                ('rank', models.FloatField()),
+                ('meal', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='meals.meal')),
+                ('document', models.TextField(db_column='meals_meal_fts')),
+            ],
+            options={
+                'db_table': 'meals_meal_fts',
+                'abstract': False,
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='StudentSearchEntry',
+            fields=[
+                ('rank', models.FloatField()),
+                ('student', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='meals.student')),
+                ('document', models.TextField(db_column='meals_student_fts')),
+            ],
+            options={
+                'db_table': 'meals_student_fts',
+                'abstract': False,
+                'managed': False,
+            },
+        ),
+    ]
@@ -1,16 +1,45 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Cast, NullIf
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
+
+class DietaryTag(models.Model):
+    # Normalized allergen or ingredient, e.g. "dairy"; see meals.dietary for how free text maps to tags
+    name = models.SlugField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.name
 
 class Student(models.Model):
     student_id = models.CharField(max_length=20, unique=True)
     name = models.CharField(max_length=100)
     grade = models.CharField(max_length=10)
     dietary_restrictions = models.TextField(blank=True)
+    # Parsed from dietary_restrictions by meals.dietary: the tags this student must avoid
+    dietary_tags = models.ManyToManyField(DietaryTag, blank=True, related_name='students')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Kiosks pull the roster rows changed since their last sync (see meals.sync)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['grade'], name='student_grade_idx'),
+            models.Index(fields=['updated_at'], name='student_updated_at_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.student_id})"
 
+def energy():
+    # 4cal/g protein & carbs, 9cal/g fat
+    return 4 * (F('protein') + F('carbohydrates')) + 9 * F('fats')
+
+def energy_share(kcal_per_gram, nutrient):
+    # Percentage of a meal's energy coming from one macronutrient; NULL for a meal with no energy
+    return kcal_per_gram * F(nutrient) * Value(100.0) / NullIf(energy(), 0)
+
 class Meal(models.Model):
     MEAL_TYPES = [
         ('breakfast', 'Breakfast'),
@@ -22,25 +51,208 @@ class Meal(models.Model):
     description = models.TextField(blank=True, null=True)
     meal_type = models.CharField(max_length=20, choices=MEAL_TYPES)
     serving_date = models.DateField()
-    calories = models.IntegerField()
     protein = models.FloatField(help_text='Protein content in grams')
     carbohydrates = models.FloatField(help_text='Carbohydrates content in grams')
     fats = models.FloatField(help_text='Fats content in grams')
+    # Derived by the database from the macronutrients, so every write path (forms, bulk_create,
+    # update()) keeps them consistent and they can be filtered and sorted on
+    calories = models.GeneratedField(
+        expression=Cast(energy(), models.IntegerField()), output_field=models.IntegerField(), db_persist=True,
+    )
+    protein_pct = models.GeneratedField(
+        expression=energy_share(4, 'protein'), output_field=models.FloatField(), db_persist=True,
+    )
+    carbohydrates_pct = models.GeneratedField(
+        expression=energy_share(4, 'carbohydrates'), output_field=models.FloatField(), db_persist=True,
+    )
+    fats_pct = models.GeneratedField(
+        expression=energy_share(9, 'fats'), output_field=models.FloatField(), db_persist=True,
+    )
+    allergen_tags = models.ManyToManyField(DietaryTag, blank=True, related_name='meals')
     
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Dashboard's recent meals and the default meal list ordering
+            models.Index(fields=['serving_date'], name='meal_serving_date_idx'),
+            # Meal list filtered by type and date range
+            models.Index(fields=['meal_type', 'serving_date'], name='meal_type_serving_date_idx'),
+            # Meal list sorted or filtered by calories
+            models.Index(fields=['calories'], name='meal_calories_idx'),
+            # Menu changes pulled by kiosks
+            models.Index(fields=['updated_at'], name='meal_updated_at_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} - {self.serving_date}"
 
 class MealConsumption(models.Model):
-    student = models.ForeignKey(Student, on_delete=models.CASCADE)
-    meal = models.ForeignKey(Meal, on_delete=models.CASCADE)
-    consumed_at = models.DateTimeField(auto_now_add=True)
+    # Lookups by student or meal use the composite (fk, consumed_at) indexes below
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, db_index=False)
+    meal = models.ForeignKey(Meal, on_delete=models.CASCADE, db_index=False)
+    consumed_at = models.DateTimeField(default=timezone.now, editable=False)
     portion_consumed = models.FloatField(
         validators=[MinValueValidator(0.0), MaxValueValidator(1.0)],
         help_text='Portion consumed (0.0 to 1.0)'
     )
     waste_weight = models.FloatField(help_text='Food waste in grams', null=True, blank=True)
+    # Client-generated key of a check-in pushed by a kiosk, so replaying it records nothing new
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
 
     class Meta:
         unique_together = ['student', 'meal', 'consumed_at']
+        # SQLite appends the rowid (id) to every index, so these also serve the (consumed_at, id) keyset order
+        indexes = [
+            models.Index(fields=['consumed_at'], name='consumption_consumed_at_idx'),
+            models.Index(fields=['meal', 'consumed_at'], name='consumption_meal_time_idx'),
+            models.Index(fields=['student', 'consumed_at'], name='consumption_student_time_idx'),
+        ]
+
+class MealDailyRollup(models.Model):
+    # Per meal, per consumption day totals maintained incrementally by meals.rollups
+    meal = models.ForeignKey(Meal, on_delete=models.CASCADE, related_name='daily_rollups')
+    day = models.DateField()
+    consumption_count = models.PositiveIntegerField(default=0)
+    portion_sum = models.FloatField(default=0)
+    waste_count = models.PositiveIntegerField(default=0, help_text='Consumptions with a recorded waste weight')
+    waste_sum = models.FloatField(default=0)
+    waste_min = models.FloatField(null=True, blank=True)
+    waste_max = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ['meal', 'day']
+        indexes = [
+            # Date-range filtered waste report
+            models.Index(fields=['day', 'meal'], name='rollup_day_meal_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.meal_id} on {self.day}"
+
+
+class Counter(models.Model):
+    # Running totals for the dashboard, maintained by meals.counters
+    name = models.CharField(max_length=50, unique=True)
+    value = models.FloatField(default=0)
+    # Last change, so data version counters also tell when their data last changed
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class Tombstone(models.Model):
+    # A deleted student or meal, so kiosks syncing changes since a version token drop it too
+    model = models.CharField(max_length=20)
+    object_id = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'deleted_at'], name='tombstone_model_deleted_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.model} {self.object_id} deleted {self.deleted_at:%Y-%m-%d %H:%M}"
+
+
+class ServingDay(models.Model):
+    # A serving date whose menu has been finalized, with its conflicts precomputed in MealConflict
+    date = models.DateField(unique=True)
+    finalized_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.date} (finalized {self.finalized_at:%Y-%m-%d %H:%M})"
+
+
+class MealConflict(models.Model):
+    # A student whose restrictions clash with a meal on a finalized serving day
+    meal = models.ForeignKey(Meal, on_delete=models.CASCADE, related_name='conflicts')
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='meal_conflicts')
+    tags = models.CharField(max_length=200, help_text='Comma-separated conflicting tags')
+
+    class Meta:
+        unique_together = ['meal', 'student']
+
+    def __str__(self):
+        return f"{self.student_id} x {self.meal_id}: {self.tags}"
+
+
+class SearchEntry(models.Model):
+    # A row of the FTS5 index migration 0009 keeps beside a table (SQLite only); see meals.search.
+    # ``document`` is the hidden column named after the index, which MATCH is applied to
+    # bm25 score of the row for the MATCH of the query, lower is better
+    rank = models.FloatField()
+
+    class Meta:
+        abstract = True
+        managed = False
+
+
+class StudentSearchEntry(SearchEntry):
+    student = models.OneToOneField(Student, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                   db_constraint=False, related_name='search_entry')
+    document = models.TextField(db_column='meals_student_fts')
+
+    class Meta(SearchEntry.Meta):
+        db_table = 'meals_student_fts'
+
+
+class MealSearchEntry(SearchEntry):
+    meal = models.OneToOneField(Meal, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                db_constraint=False, related_name='search_entry')
+    document = models.TextField(db_column='meals_meal_fts')
+
+    class Meta(SearchEntry.Meta):
+        db_table = 'meals_meal_fts'
+
+
+class ReportJob(models.Model):
+    # A report computed by the run_report_worker command; see meals.jobs
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    name = models.CharField(max_length=30)
+    # Alias of the school database the report reads (see meals.sharding)
+    database = models.CharField(max_length=40, default='default')
+    params = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    # Report name and parameters hashed, shared with the report cache key
+    params_key = models.CharField(max_length=60)
+    # Data versions the result was computed from, as a JSON list
+    version = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Finding a reusable result, and the queue in order
+            models.Index(fields=['params_key', 'version'], name='reportjob_params_version_idx'),
+            models.Index(fields=['status', 'id'], name='reportjob_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} job {self.pk} ({self.status})"
+
+
+class School(models.Model):
+    # A school whose meals tables live in their own database, the ``school_<code>`` alias; see meals.sharding
+    DATABASE_PREFIX = 'school_'
+
+    code = models.SlugField(max_length=30, unique=True, help_text='Also names the school\'s database alias')
+    name = models.CharField(max_length=100)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def database(self):
+        return self.DATABASE_PREFIX + self.code
@@ -0,0 +1,110 @@
+"""Keyset (cursor) pagination for consumption history.
+
+Pages are ordered newest first on ``(consumed_at, id)`` and addressed by an
+opaque cursor holding the boundary row's key, so the database seeks straight
+to the page through the index instead of counting past an OFFSET.
+"""
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def encode_cursor(consumed_at, pk):
+    raw = json.dumps([consumed_at.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(consumed_at, pk)`` for a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        consumed_at, pk = json.loads(raw)
+        consumed_at = parse_datetime(consumed_at)
+        pk = int(pk)
+    except (ValueError, TypeError):
+        return None
+    if consumed_at is None:
+        return None
+    return consumed_at, pk
+
+
+class KeysetPage:
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            last = self.object_list[-1]
+            return encode_cursor(last.consumed_at, last.pk)
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            first = self.object_list[0]
+            return encode_cursor(first.consumed_at, first.pk)
+        return None
+
+
+class KeysetPaginator:
+    def __init__(self, queryset, per_page=DEFAULT_PAGE_SIZE):
+        self.queryset = queryset.select_related('student', 'meal')
+        self.per_page = per_page
+
+    def get_page(self, after=None, before=None):
+        """Page of rows older than the ``after`` cursor, or newer than ``before``; first page otherwise."""
+        after = decode_cursor(after)
+        before = decode_cursor(before) if after is None else None
+
+        if before is not None:
+            consumed_at, pk = before
+            rows = list(self.queryset.filter(
+                Q(consumed_at__gt=consumed_at) | Q(consumed_at=consumed_at, id__gt=pk)
+            ).order_by('consumed_at', 'id')[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            return KeysetPage(rows, has_next=True, has_previous=has_previous)
+
+        queryset = self.queryset
+        if after is not None:
+            consumed_at, pk = after
+            queryset = queryset.filter(Q(consumed_at__lt=consumed_at) | Q(consumed_at=consumed_at, id__lt=pk))
+        rows = list(queryset.order_by('-consumed_at', '-id')[:self.per_page + 1])
+        return KeysetPage(rows[:self.per_page], has_next=len(rows) > self.per_page, has_previous=after is not None)
+
+
+def paginate_consumptions(request, queryset, per_page=DEFAULT_PAGE_SIZE):
+    return KeysetPaginator(queryset, per_page).get_page(
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+    )
+
+
+class KeysetPaginationMixin:
+    """ListView mixin that pages a MealConsumption queryset by cursor instead of page number."""
+
+    paginate_by = DEFAULT_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size)
+        page = paginator.get_page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        return paginator, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,83 @@
+"""Run independent read queries at the same time on a bounded thread pool.
+
+Each worker thread keeps its own database connection; SQLite releases the GIL
+while it steps through a query, so two aggregates over different indexes
+really do run side by side.  ``MEALS_QUERY_POOL_SIZE`` bounds the workers
+shared by every request of the process (0 runs everything inline).
+
+A caller inside a transaction runs its functions inline instead: other
+connections could not see the rows it has not committed.  Workers apply the
+caller's ``execute_wrapper`` hooks, so request metrics still count their
+queries, and run in a copy of its context, so they read the same school
+database (``meals.sharding``).  Like request threads, workers drop
+connections older than ``CONN_MAX_AGE``, or broken ones, before and after
+each call, and keep the others for their next calls.  A caller may set
+``worker_wrapper`` to have each call run through it on the worker, as the
+request profiler does to profile the worker threads too.
+"""
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+_executor = None
+_executor_lock = threading.Lock()
+_worker = threading.local()
+# Called as wrapper(function) in place of function() on the worker; copied to workers with the caller's context
+worker_wrapper = contextvars.ContextVar('meals_parallel_worker_wrapper', default=None)
+
+
+def get_pool_size():
+    return getattr(settings, 'MEALS_QUERY_POOL_SIZE', 4)
+
+
+def _mark_worker():
+    _worker.active = True
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_pool_size(), thread_name_prefix='meals-query', initializer=_mark_worker,
+            )
+        return _executor
+
+
+def _in_transaction():
+    return any(connections[alias].in_atomic_block for alias in connections)
+
+
+def _call(function, wrappers):
+    # What request_started and request_finished do for a request thread
+    close_old_connections()
+    try:
+        with ExitStack() as stack:
+            for alias, hooks in wrappers.items():
+                for hook in hooks:
+                    stack.enter_context(connections[alias].execute_wrapper(hook))
+            wrapper = worker_wrapper.get()
+            return function() if wrapper is None else wrapper(function)
+    finally:
+        close_old_connections()
+
+
+def gather(*functions):
+    """Call each function concurrently and return their results in order; the first exception propagates."""
+    # Workers gathering again run inline: waiting on the pool they occupy could exhaust it
+    if len(functions) < 2 or get_pool_size() < 1 or _in_transaction() or getattr(_worker, 'active', False):
+        return [function() for function in functions]
+    wrappers = {alias: list(connections[alias].execute_wrappers) for alias in connections}
+    executor = get_executor()
+    futures = [executor.submit(contextvars.copy_context().run, _call, function, wrappers) for function in functions]
+    return [future.result() for future in futures]
+
+
+async def agather(*functions):
+    """``gather`` for async views, run from the request's sync thread so it sees that thread's transaction."""
+    return await sync_to_async(gather)(*functions)
@@ -0,0 +1,382 @@
+"""Report computations and their versioned cache.
+
+Each report is a function of its filter parameters that returns plain,
+picklable data.  Results are cached under the report name and parameters,
+tagged with the data versions of the tables the report reads.  The versions
+are Counter rows bumped by the model signals inside the writer's transaction,
+so a reader never tags old data with a new version.
+
+A cached result whose version is out of date is still served for
+``REPORT_CACHE_MAX_STALE`` seconds after the data changed, and a single
+background thread recomputes it (stale-while-revalidate); entries out of
+date for longer are recomputed before responding.  How long an entry has
+been out of date is measured from the version bump that outdated it, as
+seen by the first reader to find it stale, not from when it was computed.
+
+Each school database (see ``meals.sharding``) has its own entries and
+versions.  The district reports combine every school's share of a report,
+computed as sums and counts so averages come out exact, in ``DISTRICT_REPORTS``.
+"""
+import contextvars
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count, F, Sum
+from django.db.models.functions import NullIf
+
+from . import archive, counters, exports, intake, parallel, sharding
+from .models import Counter, Meal, MealConsumption, MealDailyRollup, Student
+
+# Data version names, bumped by meals.signals when the matching table changes
+STUDENTS = 'students'
+MEALS = 'meals'
+CONSUMPTIONS = 'consumptions'
+
+VERSION_PREFIX = 'version:'
+REFRESH_LOCK_TIMEOUT = 60
+
+
+def bump_versions(*names):
+    counters.increment(**{VERSION_PREFIX + name: 1 for name in names})
+
+
+def data_state(names):
+    """(data version, when the newest of its parts was bumped or None) of the named data, from one query."""
+    stored = {
+        name: (value, updated_at) for name, value, updated_at in
+        Counter.objects.filter(name__in=[VERSION_PREFIX + n for n in names]).values_list('name', 'value', 'updated_at')
+    }
+    version = tuple(int(stored.get(VERSION_PREFIX + name, (0, None))[0]) for name in names)
+    return version, max((updated_at for _, updated_at in stored.values()), default=None)
+
+
+def data_version(names):
+    return data_state(names)[0]
+
+
+def current_data_state(names):
+    """``data_state`` of the selected school, or of every school in turn in the district view."""
+    if not sharding.is_district():
+        return data_state(names)
+    states = [state for _, state in sharding.fan_out(lambda: data_state(names))]
+    version = tuple(part for school_version, _ in states for part in school_version)
+    return version, max((changed_at for _, changed_at in states if changed_at is not None), default=None)
+
+
+# Report key: Meal field, for the averages of the nutrition report
+NUTRITION_FIELDS = {'calories': 'calories', 'protein': 'protein', 'carbs': 'carbohydrates', 'fats': 'fats'}
+
+
+def nutrition_totals():
+    """Sums and counts behind the nutrition report; unlike averages, they add up across school databases."""
+    meals = Meal.objects.all()
+    sums = {f'{key}_sum': Sum(field) for key, field in NUTRITION_FIELDS.items()}
+    # The three queries are independent, so a cache miss runs them side by side
+    totals, meal_types, meal_rows = parallel.gather(
+        lambda: meals.aggregate(total_meals=Count('id'), **sums),
+        lambda: list(meals.values('meal_type').annotate(total_meals=Count('id'), **sums).order_by('meal_type')),
+        lambda: list(meals.values('name', 'meal_type', 'calories', 'protein', 'carbohydrates', 'fats')),
+    )
+    return {'totals': totals, 'meal_types': meal_types, 'meals': meal_rows}
+
+
+def _averages(row):
+    return {key: (row[f'{key}_sum'] or 0) / row['total_meals'] if row['total_meals'] else None
+            for key in NUTRITION_FIELDS}
+
+
+def finish_nutrition(partial):
+    averages = _averages(partial['totals'])
+    meal_type_analysis = []
+    for row in partial['meal_types']:
+        row_averages = _averages(row)
+        meal_type_analysis.append({
+            'meal_type': row['meal_type'],
+            **{f'avg_{key}': value for key, value in row_averages.items()},
+            'total_meals': row['total_meals'],
+        })
+    return {
+        'meals': partial['meals'],
+        **{f'avg_{key}': round(value or 0, 1) for key, value in averages.items()},
+        'meal_type_analysis': meal_type_analysis,
+    }
+
+
+def nutrition_summary():
+    return finish_nutrition(nutrition_totals())
+
+
+def merge_nutrition(results):
+    """The nutrition report of every school, from ``[(school, nutrition_totals())]``."""
+    fields = ['total_meals'] + [f'{key}_sum' for key in NUTRITION_FIELDS]
+    totals = dict.fromkeys(fields, 0)
+    meal_types = {}
+    meals = []
+    for school, partial in results:
+        for row, target in [(partial['totals'], totals)] + [
+            (row, meal_types.setdefault(row['meal_type'], dict.fromkeys(fields, 0)))
+            for row in partial['meal_types']
+        ]:
+            for field in fields:
+                target[field] += row[field] or 0
+        meals.extend({**meal, 'school': school.code, 'school_name': school.name} for meal in partial['meals'])
+    return finish_nutrition({
+        'totals': totals,
+        'meal_types': [{'meal_type': meal_type, **meal_types[meal_type]} for meal_type in sorted(meal_types)],
+        'meals': meals,
+    })
+
+
+def _grade_waste_per_meal(date_from, date_to, grade, meal_type):
+    """Per meal waste of one grade's consumptions, live and archived, ordered like the rollup query."""
+    # Rollups are not kept per grade, so grade filters aggregate the consumption rows
+    consumptions = exports.filter_consumptions(MealConsumption.objects.all(), date_from, date_to, meal_type)
+    per_meal = {
+        item['meal']: item for item in consumptions.filter(student__grade=grade).values('meal').annotate(
+            total_waste=Sum('waste_weight'),
+            weighed=Count('waste_weight'),
+            count=Count('id'),
+            meal_name=F('meal__name'),
+            meal_type=F('meal__meal_type'),
+        )
+    }
+
+    start = archive.to_micros(exports.day_start(date_from)) if date_from else None
+    end = archive.to_micros(exports.day_start(date_to + timedelta(days=1))) if date_to else None
+    if any(segment.overlaps(start, end) for segment in archive.segments()):
+        student_ids = list(Student.objects.filter(grade=grade).values_list('id', flat=True))
+        meal_ids = list(Meal.objects.filter(meal_type=meal_type).values_list('id', flat=True)) if meal_type else None
+        archived = archive.waste_totals(start, end, student_ids, meal_ids)
+        meals = Meal.objects.in_bulk(set(archived) - set(per_meal))
+        for meal_id, (total_waste, weighed, count) in archived.items():
+            item = per_meal.get(meal_id)
+            if item is None:
+                if meal_id not in meals:
+                    # Archived consumptions of since deleted meals
+                    continue
+                item = per_meal[meal_id] = {
+                    'meal': meal_id, 'total_waste': None, 'weighed': 0, 'count': 0,
+                    'meal_name': meals[meal_id].name, 'meal_type': meals[meal_id].meal_type,
+                }
+            if weighed:
+                item['total_waste'] = (item['total_waste'] or 0) + total_waste
+            item['weighed'] += weighed
+            item['count'] += count
+
+    for item in per_meal.values():
+        item['avg_waste'] = item['total_waste'] / item['weighed'] if item['weighed'] else None
+    return sorted(per_meal.values(),
+                  key=lambda item: (item['avg_waste'] is None, -(item['avg_waste'] or 0), item['meal']))
+
+
+def waste_per_meal(date_from=None, date_to=None, grade=None, meal_type=None):
+    """Waste totals of each meal, unrounded, most wasted first."""
+    if grade:
+        return _grade_waste_per_meal(date_from, date_to, grade, meal_type)
+    # The rollups include archived consumptions
+    rollups = MealDailyRollup.objects.all()
+    if date_from:
+        rollups = rollups.filter(day__gte=date_from)
+    if date_to:
+        rollups = rollups.filter(day__lte=date_to)
+    if meal_type:
+        rollups = rollups.filter(meal__meal_type=meal_type)
+    # Meal details are joined into the aggregate rather than fetched per row
+    return list(rollups.values('meal').annotate(
+        total_waste=Sum('waste_sum'),
+        weighed=Sum('waste_count'),
+        count=Sum('consumption_count'),
+    ).annotate(
+        avg_waste=F('total_waste') / NullIf(F('weighed'), 0),
+        meal_name=F('meal__name'),
+        meal_type=F('meal__meal_type'),
+    ).order_by(F('avg_waste').desc(nulls_last=True), 'meal'))
+
+
+def finish_waste(per_meal):
+    meal_types = dict(Meal.MEAL_TYPES)
+    meals_with_waste = []
+    total_waste = 0
+    total_servings = 0
+    for item in per_meal:
+        total_waste += item['total_waste'] or 0
+        total_servings += item['count']
+        meals_with_waste.append({
+            'meal_id': item['meal'],
+            'meal_name': item['meal_name'],
+            'meal_type': meal_types.get(item['meal_type'], item['meal_type']),
+            'avg_waste': round(item['avg_waste'] or 0, 2),
+            'total_waste': round(item['total_waste'] or 0, 2),
+            'count': item['count'],
+            **{key: item[key] for key in ('school', 'school_name') if key in item},
+        })
+    return {
+        'total_waste': round(total_waste, 2),
+        'total_servings': total_servings,
+        'meals_with_waste': meals_with_waste,
+    }
+
+
+def waste_summary(date_from=None, date_to=None, grade=None, meal_type=None):
+    return finish_waste(waste_per_meal(date_from, date_to, grade, meal_type))
+
+
+def merge_waste(results):
+    """The waste report of every school, from ``[(school, waste_per_meal())]``; meals belong to one school."""
+    per_meal = [
+        {**item, 'school': school.code, 'school_name': school.name}
+        for school, partial in results for item in partial
+    ]
+    per_meal.sort(key=lambda item: (item['avg_waste'] is None, -(item['avg_waste'] or 0), item['school'], item['meal']))
+    return finish_waste(per_meal)
+
+
+def intake_summary(date_from, date_to, grade=None, limit=None):
+    """School average daily intake over a period and its students, or the ``limit`` of them, fewest calories first."""
+    result = intake.compute_intake(date_from, date_to, grade=grade)
+    days_eaten, totals, averages = result.summary()
+    lowest = averages[:, 0].argsort(kind='stable')[:limit].tolist()
+    students = Student.objects.in_bulk([int(result.student_ids[index]) for index in lowest])
+    rows = []
+    for index in lowest:
+        student = students.get(int(result.student_ids[index]))
+        if student is None:
+            continue
+        rows.append({
+            'id': student.pk,
+            'student_id': student.student_id,
+            'name': student.name,
+            'grade': student.grade,
+            'days_eaten': int(days_eaten[index]),
+            'average': dict(zip(intake.NUTRIENTS, averages[index].tolist())),
+            'total_calories': float(totals[index, 0]),
+        })
+    student_days = int(days_eaten.sum())
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'student_count': len(result.student_ids),
+        'student_days': student_days,
+        'school_average': dict(zip(intake.NUTRIENTS, (totals.sum(axis=0) / max(student_days, 1)).tolist())),
+        'lowest_intake': rows,
+    }
+
+
+def merge_intake(results):
+    """The intake report of every school, from ``[(school, intake_summary())]``; students belong to one school."""
+    first = results[0][1]
+    student_days = sum(partial['student_days'] for _, partial in results)
+    totals = {
+        nutrient: sum(partial['school_average'][nutrient] * partial['student_days'] for _, partial in results)
+        for nutrient in intake.NUTRIENTS
+    }
+    rows = [
+        {**row, 'school': school.code, 'school_name': school.name}
+        for school, partial in results for row in partial['lowest_intake']
+    ]
+    rows.sort(key=lambda row: (row['average']['calories'], row['school']))
+    return {
+        'date_from': first['date_from'],
+        'date_to': first['date_to'],
+        'student_count': sum(partial['student_count'] for _, partial in results),
+        'student_days': student_days,
+        'school_average': {nutrient: total / max(student_days, 1) for nutrient, total in totals.items()},
+        'lowest_intake': rows,
+    }
+
+
+# name: (compute function, data versions it depends on)
+REPORTS = {
+    'nutrition': (nutrition_summary, [MEALS]),
+    'waste': (waste_summary, [STUDENTS, MEALS, CONSUMPTIONS]),
+    'intake': (intake_summary, [STUDENTS, MEALS, CONSUMPTIONS]),
+    'nutrition-totals': (nutrition_totals, [MEALS]),
+    'waste-per-meal': (waste_per_meal, [STUDENTS, MEALS, CONSUMPTIONS]),
+}
+
+# name: (report computing one school's share, function merging every school's share)
+DISTRICT_REPORTS = {
+    'nutrition': ('nutrition-totals', merge_nutrition),
+    'waste': ('waste-per-meal', merge_waste),
+    'intake': ('intake', merge_intake),
+}
+
+
+def cache_key(name, params):
+    # Unset filters are left out so {} and {'grade': None} share an entry
+    params = {key: value for key, value in params.items() if value not in (None, '')}
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    database = sharding.current_database()
+    prefix = 'report' if database == 'default' else f'report:{database}'
+    return f'{prefix}:{name}:{hashlib.md5(encoded).hexdigest()}'
+
+
+def refresh(name, params, version=None):
+    """Compute a report and store it in the cache; returns the fresh value."""
+    compute, dependencies = REPORTS[name]
+    # The version is read before computing, so changes made meanwhile make the entry stale
+    if version is None:
+        version = data_version(dependencies)
+    value = compute(**params)
+    cache.set(
+        cache_key(name, params),
+        {'version': version, 'computed_at': time.time(), 'value': value},
+        getattr(settings, 'REPORT_CACHE_TIMEOUT', 3600),
+    )
+    return value
+
+
+def _refresh_in_background(name, params, lock_key):
+    try:
+        refresh(name, params)
+    finally:
+        cache.delete(lock_key)
+        connections.close_all()
+
+
+def schedule_refresh(name, params):
+    lock_key = cache_key(name, params) + ':refreshing'
+    # Only one refresh per entry at a time, however many requests see it stale
+    if cache.add(lock_key, True, REFRESH_LOCK_TIMEOUT):
+        # Run in a copy of the caller's context, so the refresh reads the same school database
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(_refresh_in_background, name, params, lock_key), daemon=True,
+        ).start()
+
+
+def get_report(name, **params):
+    _, dependencies = REPORTS[name]
+    version, changed_at = data_state(dependencies)
+    key = cache_key(name, params)
+    entry = cache.get(key)
+    if entry is not None:
+        if entry['version'] == version:
+            return entry['value']
+        max_stale = getattr(settings, 'REPORT_CACHE_MAX_STALE', 0)
+        if 'stale_since' not in entry and max_stale > 0:
+            # Remembered, so later bumps do not keep extending the grace period
+            entry['stale_since'] = changed_at.timestamp() if changed_at is not None else time.time()
+            cache.set(key, entry, getattr(settings, 'REPORT_CACHE_TIMEOUT', 3600))
+        if time.time() - entry.get('stale_since', 0) <= max_stale:
+            schedule_refresh(name, params)
+            return entry['value']
+    return refresh(name, params, version)
+
+
+def get_district_report(name, **params):
+    """Report ``name`` over every school: each school's share from its own cache, computed concurrently."""
+    partial, merge = DISTRICT_REPORTS[name]
+    return merge(sharding.fan_out(lambda: get_report(partial, **params)))
+
+
+def compute_district_report(name, **params):
+    """Report ``name`` over every school, computed afresh in each school's database."""
+    partial, merge = DISTRICT_REPORTS[name]
+    compute, _ = REPORTS[partial]
+    return merge(sharding.fan_out(lambda: compute(**params)))
@@ -0,0 +1,166 @@
+"""Incremental maintenance of MealDailyRollup.
+
+Every change to a MealConsumption is folded into the matching (meal, day)
+bucket with a single UPDATE of F() expressions, so concurrent writers never
+lose each other's increments.  Min/max waste cannot be decremented, so a
+bucket whose extreme value is removed is recomputed from its own rows, live
+and archived.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import Count, F, FloatField, Max, Min, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least, TruncDate
+from django.utils import timezone
+
+from . import archive
+from .exports import day_start
+from .models import Meal, MealConsumption, MealDailyRollup
+
+
+def consumption_day(consumed_at):
+    return timezone.localdate(consumed_at)
+
+
+def _buckets(rows):
+    buckets = defaultdict(lambda: {
+        'count': 0, 'portion_sum': 0.0, 'waste_count': 0, 'waste_sum': 0.0, 'waste_min': None, 'waste_max': None,
+    })
+    for meal_id, consumed_at, portion, waste in rows:
+        bucket = buckets[(meal_id, consumption_day(consumed_at))]
+        bucket['count'] += 1
+        bucket['portion_sum'] += portion
+        if waste is not None:
+            bucket['waste_count'] += 1
+            bucket['waste_sum'] += waste
+            bucket['waste_min'] = waste if bucket['waste_min'] is None else min(bucket['waste_min'], waste)
+            bucket['waste_max'] = waste if bucket['waste_max'] is None else max(bucket['waste_max'], waste)
+    return buckets
+
+
+def _extreme(field, value, function):
+    if value is None:
+        return F(field)
+    value = Value(value, output_field=FloatField())
+    return function(Coalesce(F(field), value), value)
+
+
+def add(rows):
+    """Fold newly created consumptions, given as (meal_id, consumed_at, portion, waste) tuples, into the rollups."""
+    for (meal_id, day), bucket in _buckets(rows).items():
+        changes = {
+            'consumption_count': F('consumption_count') + bucket['count'],
+            'portion_sum': F('portion_sum') + bucket['portion_sum'],
+            'waste_count': F('waste_count') + bucket['waste_count'],
+            'waste_sum': F('waste_sum') + bucket['waste_sum'],
+            'waste_min': _extreme('waste_min', bucket['waste_min'], Least),
+            'waste_max': _extreme('waste_max', bucket['waste_max'], Greatest),
+        }
+        if MealDailyRollup.objects.filter(meal_id=meal_id, day=day).update(**changes):
+            continue
+        try:
+            with transaction.atomic(using=router.db_for_write(MealDailyRollup)):
+                MealDailyRollup.objects.create(
+                    meal_id=meal_id,
+                    day=day,
+                    consumption_count=bucket['count'],
+                    portion_sum=bucket['portion_sum'],
+                    waste_count=bucket['waste_count'],
+                    waste_sum=bucket['waste_sum'],
+                    waste_min=bucket['waste_min'],
+                    waste_max=bucket['waste_max'],
+                )
+        except IntegrityError:
+            # Another writer created the bucket first
+            MealDailyRollup.objects.filter(meal_id=meal_id, day=day).update(**changes)
+
+
+def remove(rows):
+    """Take deleted consumptions, given as (meal_id, consumed_at, portion, waste) tuples, out of the rollups."""
+    for (meal_id, day), bucket in _buckets(rows).items():
+        rollups = MealDailyRollup.objects.filter(meal_id=meal_id, day=day)
+        rollups.update(
+            consumption_count=F('consumption_count') - bucket['count'],
+            portion_sum=F('portion_sum') - bucket['portion_sum'],
+            waste_count=F('waste_count') - bucket['waste_count'],
+            waste_sum=F('waste_sum') - bucket['waste_sum'],
+        )
+        rollups.filter(consumption_count__lte=0).delete()
+        if bucket['waste_count'] and rollups.filter(
+            Q(waste_min__gte=bucket['waste_min']) | Q(waste_max__lte=bucket['waste_max'])
+        ).exists():
+            recompute_bucket(meal_id, day)
+
+
+def replace(previous, current):
+    """Move an edited consumption between buckets; edits are rare, so the affected buckets are recomputed."""
+    for meal_id, consumed_at, _, _ in {previous, current}:
+        recompute_bucket(meal_id, consumption_day(consumed_at))
+
+
+def recompute_bucket(meal_id, day):
+    """Rebuild one bucket from its live rows and the rows archived from it."""
+    totals = MealConsumption.objects.filter(
+        meal_id=meal_id,
+        consumed_at__gte=day_start(day),
+        consumed_at__lt=day_start(day + timedelta(days=1)),
+    ).aggregate(
+        consumption_count=Count('id'),
+        portion_sum=Coalesce(Sum('portion_consumed'), 0.0),
+        waste_count=Count('waste_weight'),
+        waste_sum=Coalesce(Sum('waste_weight'), 0.0),
+        waste_min=Min('waste_weight'),
+        waste_max=Max('waste_weight'),
+    )
+    buckets = archive.daily_buckets(
+        archive.to_micros(day_start(day)), archive.to_micros(day_start(day + timedelta(days=1))), [meal_id],
+    )
+    if totals['consumption_count']:
+        archive.merge_bucket(buckets, (meal_id, day), totals)
+    bucket = buckets.get((meal_id, day))
+    if bucket:
+        MealDailyRollup.objects.update_or_create(meal_id=meal_id, day=day, defaults=bucket)
+    else:
+        MealDailyRollup.objects.filter(meal_id=meal_id, day=day).delete()
+
+
+def rebuild(chunk_size=1000):
+    """Recompute every rollup from the MealConsumption table and the archive; returns the number of buckets written."""
+    aggregated = MealConsumption.objects.annotate(
+        day=TruncDate('consumed_at'),
+    ).values('meal_id', 'day').annotate(
+        consumption_count=Count('id'),
+        portion_sum=Coalesce(Sum('portion_consumed'), 0.0),
+        waste_count=Count('waste_weight'),
+        waste_sum=Coalesce(Sum('waste_weight'), 0.0),
+        waste_min=Min('waste_weight'),
+        waste_max=Max('waste_weight'),
+    ).order_by()
+    archived = archive.daily_buckets()
+    # Archived rows of since deleted meals have no bucket to go into
+    existing_meals = set(Meal.objects.filter(id__in={meal_id for meal_id, _ in archived}).values_list('id', flat=True))
+
+    def rows():
+        for row in aggregated.iterator(chunk_size=chunk_size):
+            key = (row.pop('meal_id'), row.pop('day'))
+            if key in archived:
+                archive.merge_bucket(archived, key, row)
+            else:
+                yield key, row
+        for key, row in archived.items():
+            if key[0] in existing_meals:
+                yield key, row
+
+    written = 0
+    with transaction.atomic(using=router.db_for_write(MealDailyRollup)):
+        MealDailyRollup.objects.all().delete()
+        batch = []
+        for (meal_id, day), row in rows():
+            batch.append(MealDailyRollup(meal_id=meal_id, day=day, **row))
+            if len(batch) >= chunk_size:
+                written += len(MealDailyRollup.objects.bulk_create(batch))
+                batch = []
+        if batch:
+            written += len(MealDailyRollup.objects.bulk_create(batch))
+    return written
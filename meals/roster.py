@@ -0,0 +1,163 @@
+"""Per-process roster of today's service, for check-ins without database round-trips.
+
+A ``DailyRoster`` is built once per serving date from ``Student`` and
+``Meal``: a student_id -> pk dict, the set of meals on the menu, and for each
+of those meals a bitset (one bit per student pk) of who has been served.
+Check-in validation answers lookups and duplicate checks from it, and falls
+back to the ORM for anything it does not hold (students added since, meals
+of other days).
+
+Writes in this process update it at once through ``meals.signals``.  Writes
+made by other processes are noticed from the data versions, read at most
+every ``MEALS_ROSTER_RECHECK_INTERVAL`` seconds: a roster or menu change
+rebuilds it, new consumptions are read incrementally by id.  Consumptions
+deleted by another process stay marked until the next rebuild.  Each school
+database (see ``meals.sharding``) has its own roster.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import reports
+from .models import Meal, MealConsumption, Student
+
+# Data versions whose change means the roster or menu must be rebuilt
+STRUCTURE_VERSIONS = [reports.STUDENTS, reports.MEALS]
+
+_rosters = {}
+_rosters_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'MEALS_SERVING_ROSTER', True)
+
+
+def get_recheck_interval():
+    return getattr(settings, 'MEALS_ROSTER_RECHECK_INTERVAL', 2.0)
+
+
+class DailyRoster:
+    def __init__(self, day):
+        self.day = day
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        with self._lock:
+            # Versions are read first, so a change made while loading triggers another load
+            self.versions = reports.data_version(STRUCTURE_VERSIONS + [reports.CONSUMPTIONS])
+            self.checked_at = time.monotonic()
+            self.student_pks = dict(Student.objects.values_list('student_id', 'id'))
+            self.meal_pks = frozenset(Meal.objects.filter(serving_date=self.day).values_list('id', flat=True))
+            size = (max(self.student_pks.values(), default=0) >> 3) + 1
+            self.served = {meal_pk: bytearray(size) for meal_pk in self.meal_pks}
+            self.last_consumption_id = MealConsumption.objects.aggregate(last=Max('id'))['last'] or 0
+            if self.meal_pks:
+                self._mark(MealConsumption.objects.filter(
+                    meal_id__in=self.meal_pks, id__lte=self.last_consumption_id,
+                ).values_list('student_id', 'meal_id'))
+
+    def load_new_consumptions(self):
+        with self._lock:
+            # A rowid range scan of just the rows added since the last read
+            rows = list(MealConsumption.objects.filter(id__gt=self.last_consumption_id).order_by('id').values_list(
+                'id', 'student_id', 'meal_id'))
+            if rows:
+                self.last_consumption_id = rows[-1][0]
+            self._mark((student_pk, meal_pk) for _, student_pk, meal_pk in rows)
+
+    def refresh_if_stale(self):
+        if time.monotonic() - self.checked_at < get_recheck_interval():
+            return
+        with self._lock:
+            versions = reports.data_version(STRUCTURE_VERSIONS + [reports.CONSUMPTIONS])
+            self.checked_at = time.monotonic()
+            if versions[:-1] != self.versions[:-1]:
+                self.load()
+            elif versions != self.versions:
+                self.versions = versions
+                self.load_new_consumptions()
+
+    def student_pk(self, student_id):
+        return self.student_pks.get(student_id)
+
+    def has_meal(self, meal_pk):
+        return meal_pk in self.meal_pks
+
+    def is_served(self, student_pk, meal_pk):
+        bits = self.served[meal_pk]
+        index = student_pk >> 3
+        return index < len(bits) and bool(bits[index] & (1 << (student_pk & 7)))
+
+    def _mark(self, pairs, served=True):
+        for student_pk, meal_pk in pairs:
+            bits = self.served.get(meal_pk)
+            if bits is None:
+                continue
+            index = student_pk >> 3
+            if index >= len(bits):
+                bits.extend(bytes(index + 1 - len(bits)))
+            if served:
+                bits[index] |= 1 << (student_pk & 7)
+            else:
+                bits[index] &= ~(1 << (student_pk & 7)) & 0xFF
+
+    def mark_served(self, pairs, served=True):
+        with self._lock:
+            self._mark(pairs, served)
+
+
+def get_roster(day=None):
+    """The roster of ``day`` (today by default), or None when the roster is disabled."""
+    if not is_enabled():
+        return None
+    day = day or timezone.localdate()
+    database = router.db_for_read(MealConsumption)
+    with _rosters_lock:
+        roster = _rosters.get((database, day))
+        if roster is None:
+            # One day's service is kept per database
+            for key in [key for key in _rosters if key[0] == database]:
+                del _rosters[key]
+            roster = _rosters[database, day] = DailyRoster(day)
+    roster.refresh_if_stale()
+    return roster
+
+
+def already_served(student_pk, meal_pk):
+    """Whether the student has a consumption of the meal, from the roster when the meal is on today's menu."""
+    service = get_roster()
+    if service is not None and service.has_meal(meal_pk):
+        return service.is_served(student_pk, meal_pk)
+    return MealConsumption.objects.filter(student_id=student_pk, meal_id=meal_pk).exists()
+
+
+def _clear():
+    with _rosters_lock:
+        _rosters.clear()
+
+
+def invalidate():
+    """Drop this process's rosters once the current transaction commits; the next check-in rebuilds them."""
+    transaction.on_commit(_clear, using=router.db_for_write(MealConsumption))
+
+
+def mark_served(pairs, served=True):
+    """Record (student pk, meal pk) pairs as served, or no longer served, once the current transaction commits.
+
+    A rolled-back write leaves the rosters as they were.
+    """
+    pairs = list(pairs)
+    database = router.db_for_write(MealConsumption)
+
+    def mark():
+        with _rosters_lock:
+            rosters = [roster for key, roster in _rosters.items() if key[0] == database]
+        for roster in rosters:
+            roster.mark_served(pairs, served)
+
+    transaction.on_commit(mark, using=database)
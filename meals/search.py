@@ -0,0 +1,77 @@
+"""Full-text search over students and meals.
+
+On SQLite, migration 0009 keeps an FTS5 index (``<table>_fts``) beside
+``meals_student`` and ``meals_meal``, maintained by triggers.  ``search``
+turns what a user typed into a prefix query ("mar pat" matches "Maya
+Patel"), filters the queryset to the index's matches and annotates their
+bm25 ``search_rank`` (lower is better).  The index tables are mapped by the
+unmanaged ``StudentSearchEntry`` and ``MealSearchEntry`` models, so the
+match is an ordinary join and ``Match`` lookup.  Other backends, or
+``MEALS_FULL_TEXT_SEARCH = False``, fall back to ``icontains`` over the same
+fields, unranked.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Lookup, Q
+
+from .models import Meal, MealSearchEntry, Student, StudentSearchEntry
+
+# Model: columns in its full-text index, in index order
+SEARCH_FIELDS = {
+    Student: ['name', 'student_id', 'grade'],
+    Meal: ['name', 'description'],
+}
+WORD = re.compile(r'\w+')
+
+
+class Match(Lookup):
+    """``<index column> MATCH <query>``, an FTS5 full-text match."""
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', [*lhs_params, *rhs_params]
+
+
+for entry in (StudentSearchEntry, MealSearchEntry):
+    entry._meta.get_field('document').register_lookup(Match)
+
+
+def is_enabled(using='default'):
+    return getattr(settings, 'MEALS_FULL_TEXT_SEARCH', True) and connections[using].vendor == 'sqlite'
+
+
+def match_expression(text):
+    """FTS5 query requiring every word of ``text`` as a prefix, or None if it has no words."""
+    words = WORD.findall(text or '')
+    # Words are quoted so FTS5 operators typed by users (AND, NEAR, column:) are searched for literally
+    return ' '.join(f'"{word}"*' for word in words) or None
+
+
+def search(queryset, text):
+    """Rows of ``queryset`` matching ``text``, annotated with ``search_rank`` when the index is used."""
+    fields = SEARCH_FIELDS[queryset.model]
+    if not WORD.search(text or ''):
+        return queryset
+    if not is_enabled(queryset.db):
+        for word in WORD.findall(text):
+            condition = Q()
+            for field in fields:
+                condition |= Q(**{f'{field}__icontains': word})
+            queryset = queryset.filter(condition)
+        return queryset
+
+    # A join against the index: a correlated rank subquery re-runs the match once per row
+    return queryset.filter(search_entry__document__match=match_expression(text)).annotate(
+        search_rank=F('search_entry__rank'),
+    )
+
+
+def ranked(queryset, *fallback_ordering):
+    """Best matches first when ``queryset`` came from an indexed ``search``, else ``fallback_ordering``."""
+    if 'search_rank' in queryset.query.annotations:
+        return queryset.order_by('search_rank', *fallback_ordering)
+    return queryset.order_by(*fallback_ordering)
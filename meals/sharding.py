@@ -0,0 +1,173 @@
+"""One database per school, and district reports across them.
+
+Each school listed in ``MEALS_SCHOOL_DATABASES`` gets its own database alias,
+``school_<code>``, holding a full copy of the meals tables for that school
+only: students, meals, consumptions, rollups, counters and data versions.
+The ``default`` database keeps the directory (``School``, ``ReportJob``,
+users and sessions), and the meals tables of a single-school deployment.
+
+``SchoolRouter`` sends meals queries to the selected school's database.  The
+selection is a context variable: ``SchoolMiddleware`` sets it per request
+from ``?school=<code>`` (remembered in the session) or an ``X-School``
+header, and management commands take it from the ``MEALS_SCHOOL``
+environment variable.  Code that starts threads copies the context so their
+queries reach the same database.
+
+With no school selected, the district views ``fan_out`` a function to every
+school's database at once and merge the partial results.  Views that cannot
+merge schools (the lists, forms, exports and every write) are not marked
+``district_view``; the middleware sends browsers to the school picker and
+answers other clients with a 400 until a school is selected.
+"""
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+
+from django.db import connections
+from django.http import Http404, JsonResponse
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from . import parallel
+from .models import School
+
+DATABASE_PREFIX = School.DATABASE_PREFIX
+# Meals models kept once, in the default database
+DIRECTORY_MODELS = {'school', 'reportjob'}
+
+_selected = contextvars.ContextVar('meals_school_database', default=None)
+_schools = None
+_schools_lock = threading.Lock()
+
+
+def database_for(code):
+    return DATABASE_PREFIX + code
+
+
+def current_database():
+    """Alias of the selected school's database, or 'default'."""
+    selected = _selected.get()
+    if selected is None and os.environ.get('MEALS_SCHOOL'):
+        selected = database_for(os.environ['MEALS_SCHOOL'])
+    return selected or 'default'
+
+
+@contextmanager
+def use_database(alias):
+    token = _selected.set(alias)
+    try:
+        yield alias
+    finally:
+        _selected.reset(token)
+
+
+def schools():
+    """Schools whose database is configured, by name.
+
+    Read once per process: a new school database needs a settings change and
+    a restart anyway.  Changes made in this process clear it (``meals.signals``).
+    """
+    global _schools
+    configured = {alias for alias in connections if alias.startswith(DATABASE_PREFIX)}
+    if not configured:
+        return []
+    with _schools_lock:
+        if _schools is None:
+            _schools = list(School.objects.using('default').order_by('name'))
+        return [school for school in _schools if school.database in configured]
+
+
+def forget_schools():
+    global _schools
+    with _schools_lock:
+        _schools = None
+
+
+def is_district():
+    """True when no school is selected and there are school databases to combine."""
+    return current_database() == 'default' and bool(schools())
+
+
+def fan_out(function):
+    """``[(school, function())]`` run in every school's database concurrently.
+
+    A deployment without school databases runs ``function`` once, against the
+    current database, and pairs it with no school.
+    """
+    targets = schools()
+    if not targets:
+        return [(None, function())]
+
+    def in_school(school):
+        def call():
+            with use_database(school.database):
+                return function()
+        return call
+
+    return list(zip(targets, parallel.gather(*[in_school(school) for school in targets])))
+
+
+class SchoolRouter:
+    """Route meals models to the selected school's database."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'meals' or model._meta.model_name in DIRECTORY_MODELS:
+            return None
+        instance = hints.get('instance')
+        # Related rows are read from the database their instance came from
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return current_database()
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not db.startswith(DATABASE_PREFIX):
+            return None
+        return app_label == 'meals' and model_name not in DIRECTORY_MODELS
+
+
+def district_view(view):
+    """Mark a view that also serves the district view, across every school."""
+    view.district_view = True
+    return view
+
+
+class SchoolMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        by_code = {school.code: school for school in schools()}
+        if 'school' in request.GET:
+            code = request.GET['school']
+            if code and code not in by_code:
+                raise Http404('Unknown school.')
+            # Remembered only once known; an empty code goes back to the district view
+            request.session['school'] = code
+        elif request.session.get('school') and request.session['school'] not in by_code:
+            # Removed since it was chosen
+            del request.session['school']
+        code = request.headers.get('X-School') or request.session.get('school')
+        request.school = None
+        if code:
+            request.school = by_code.get(code)
+            if request.school is None:
+                raise Http404('Unknown school.')
+        with use_database(request.school.database if request.school else None):
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, _view_args, _view_kwargs):
+        # The rest of the site (admin, profiles) is not per school
+        if not view_func.__module__.startswith('meals.') or getattr(view_func, 'district_view', False):
+            return None
+        if not is_district():
+            return None
+        if request.method in ('GET', 'HEAD') and 'text/html' in request.headers.get('Accept', ''):
+            return redirect(f"{reverse('school-select')}?{urlencode({'next': request.get_full_path()})}")
+        return JsonResponse({
+            'error': 'Select a school with ?school=<code> or the X-School header.',
+            'schools': [school.code for school in schools()],
+        }, status=400)
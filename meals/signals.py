@@ -0,0 +1,199 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from . import counters, dietary, reports, rollups, roster, sharding
+from .models import Meal, MealConsumption, School, Student, Tombstone
+
+# Sent by bulk write paths, which bypass the per-instance save signals
+consumptions_bulk_created = Signal()
+
+
+def _rollup_row(consumption):
+    return (consumption.meal_id, consumption.consumed_at, consumption.portion_consumed, consumption.waste_weight)
+
+
+@receiver(pre_save, sender=MealConsumption)
+def remember_previous_consumption(sender, instance, raw=False, **kwargs):
+    # Edits need the old values to move them out of their rollup bucket
+    instance._previous_rollup_row = None
+    if instance.pk and not raw and not instance._state.adding:
+        instance._previous_rollup_row = MealConsumption.objects.filter(pk=instance.pk).values_list(
+            'meal_id', 'consumed_at', 'portion_consumed', 'waste_weight',
+        ).first()
+
+
+@receiver(post_save, sender=MealConsumption)
+def update_rollups_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous_rollup_row', None)
+    current = _rollup_row(instance)
+    if previous == current:
+        return
+    if previous is not None:
+        rollups.replace(previous, current)
+    else:
+        rollups.add([current])
+
+
+@receiver(post_save, sender=MealConsumption)
+def update_counters_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        counters.increment(consumptions=1, waste_weight=instance.waste_weight or 0)
+        return
+    previous = getattr(instance, '_previous_rollup_row', None)
+    if previous is not None and previous[3] != instance.waste_weight:
+        counters.increment(waste_weight=(instance.waste_weight or 0) - (previous[3] or 0))
+
+
+@receiver(post_delete, sender=MealConsumption)
+def update_rollups_on_delete(sender, instance, **kwargs):
+    rollups.remove([_rollup_row(instance)])
+    counters.increment(consumptions=-1, waste_weight=-(instance.waste_weight or 0))
+
+
+@receiver(consumptions_bulk_created, sender=MealConsumption)
+def update_rollups_on_bulk_create(sender, consumptions, **kwargs):
+    rollups.add(_rollup_row(c) for c in consumptions)
+    counters.increment(consumptions=len(consumptions), waste_weight=sum(c.waste_weight or 0 for c in consumptions))
+    reports.bump_versions(reports.CONSUMPTIONS)
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def bump_student_version(sender, raw=False, **kwargs):
+    if not raw:
+        reports.bump_versions(reports.STUDENTS)
+
+
+@receiver(post_save, sender=Meal)
+@receiver(post_delete, sender=Meal)
+def bump_meal_version(sender, raw=False, **kwargs):
+    if not raw:
+        reports.bump_versions(reports.MEALS)
+
+
+@receiver(post_save, sender=MealConsumption)
+def mark_served(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        roster.mark_served([(instance.student_id, instance.meal_id)])
+
+
+@receiver(consumptions_bulk_created, sender=MealConsumption)
+def mark_bulk_served(sender, consumptions, **kwargs):
+    roster.mark_served((c.student_id, c.meal_id) for c in consumptions)
+
+
+@receiver(post_delete, sender=MealConsumption)
+def unmark_served(sender, instance, **kwargs):
+    roster.mark_served([(instance.student_id, instance.meal_id)], served=False)
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+@receiver(post_save, sender=Meal)
+@receiver(post_delete, sender=Meal)
+def invalidate_roster(sender, raw=False, **kwargs):
+    # Rebuilt on the next check-in; other processes notice the bumped data versions
+    if not raw:
+        roster.invalidate()
+
+
+@receiver(post_delete, sender=Student)
+@receiver(post_delete, sender=Meal)
+def record_tombstone(sender, instance, **kwargs):
+    # Kiosks pulling changes since a sync token learn about deletions from these
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.pk)
+
+
+@receiver(post_save, sender=MealConsumption)
+@receiver(post_delete, sender=MealConsumption)
+def bump_consumption_version(sender, raw=False, **kwargs):
+    if not raw:
+        reports.bump_versions(reports.CONSUMPTIONS)
+
+
+@receiver(post_save, sender=Student)
+def count_created_student(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.increment(students=1)
+
+
+@receiver(post_delete, sender=Student)
+def count_deleted_student(sender, instance, **kwargs):
+    counters.increment(students=-1)
+
+
+@receiver(post_save, sender=Meal)
+def count_created_meal(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.increment(meals=1)
+
+
+@receiver(post_delete, sender=Meal)
+def count_deleted_meal(sender, instance, **kwargs):
+    counters.increment(meals=-1)
+
+
+@receiver(pre_save, sender=Student)
+def remember_previous_restrictions(sender, instance, raw=False, **kwargs):
+    instance._previous_restrictions = None
+    if instance.pk and not raw and not instance._state.adding:
+        instance._previous_restrictions = Student.objects.filter(pk=instance.pk).values_list(
+            'dietary_restrictions', flat=True,
+        ).first()
+
+
+@receiver(post_save, sender=Student)
+def sync_dietary_tags(sender, instance, created, raw=False, **kwargs):
+    if raw or instance.dietary_restrictions == getattr(instance, '_previous_restrictions', None):
+        return
+    if created and not instance.dietary_restrictions:
+        return
+    dietary.sync_student_tags([instance])
+    dietary.refresh_students([instance.pk])
+
+
+@receiver(pre_save, sender=Meal)
+def remember_previous_serving_date(sender, instance, raw=False, **kwargs):
+    instance._previous_serving_date = None
+    if instance.pk and not raw and not instance._state.adding:
+        instance._previous_serving_date = Meal.objects.filter(pk=instance.pk).values_list(
+            'serving_date', flat=True,
+        ).first()
+
+
+@receiver(post_save, sender=Meal)
+def move_meal_conflicts(sender, instance, created, raw=False, **kwargs):
+    # A meal moved to another day leaves the old day's conflict set and joins the new one's
+    previous = getattr(instance, '_previous_serving_date', None)
+    if not raw and previous is not None and previous != instance.serving_date:
+        dietary.refresh_meals([instance.pk])
+
+
+@receiver(m2m_changed, sender=Meal.allergen_tags.through)
+def refresh_meal_conflicts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        dietary.refresh_meals([instance.pk])
+    elif pk_set:
+        dietary.refresh_meals(list(pk_set))
+
+
+@receiver(m2m_changed, sender=Student.dietary_tags.through)
+def refresh_student_conflicts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        dietary.refresh_students([instance.pk])
+    elif pk_set:
+        dietary.refresh_students(list(pk_set))
+
+
+@receiver(post_save, sender=School)
+@receiver(post_delete, sender=School)
+def forget_schools(sender, **kwargs):
+    sharding.forget_schools()
@@ -0,0 +1,238 @@
+"""Delta sync for serving-line kiosks that keep working offline.
+
+``pull`` sends a kiosk the student roster and one day's menu as column
+names plus row arrays, gzip-compressed when the client accepts it, with a
+signed version token.  Given that token back, it sends only the rows changed
+since (by ``updated_at``) and the ids deleted since (``Tombstone``) or moved
+off the day.  An expired, tampered or other-day token gets a full snapshot,
+so ``prune_tombstones`` (the ``prune_tombstones`` command) deletes the
+tombstones no usable token can ask for any more.
+
+``push`` records check-ins that carry a client-generated ``key``.  Keys
+already recorded are acknowledged without writing anything, so a kiosk can
+replay its whole outbox after reconnecting without creating duplicates.
+A check-in already recorded under another key (same student, meal and
+time) is reported as an error for its record, and the others are recorded.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db import IntegrityError
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_GET, require_POST
+
+from . import dietary, reports, writebehind
+from .batch import MAX_BATCH_RECORDS, bulk_insert_consumptions, validate_consumption_records
+from .models import Meal, MealConsumption, Student, Tombstone
+
+STUDENT_FIELDS = ['id', 'student_id', 'name', 'grade', 'dietary_restrictions']
+MEAL_FIELDS = ['id', 'name', 'meal_type', 'serving_date', 'calories', 'protein', 'carbohydrates', 'fats']
+
+TOKEN_SALT = 'meals.sync'
+# Older tokens get a full snapshot, so tombstones older than this (and CLOCK_MARGIN) are no longer needed
+TOKEN_MAX_AGE = getattr(settings, 'MEALS_SYNC_TOKEN_MAX_AGE', 30 * 24 * 60 * 60)
+# Rows stamped just before a pull may not have been committed when it read them; they are sent again
+CLOCK_MARGIN = timedelta(seconds=5)
+KEY_MAX_LENGTH = MealConsumption._meta.get_field('idempotency_key').max_length
+
+
+def make_token(day, moment):
+    return signing.dumps({'day': day.isoformat(), 'at': moment.isoformat()}, salt=TOKEN_SALT)
+
+
+def read_token(token, day):
+    """The moment a token for ``day`` was issued at, or None if it cannot be used."""
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if not isinstance(data, dict) or data.get('day') != day.isoformat():
+        return None
+    return parse_datetime(data.get('at') or '')
+
+
+def prune_tombstones():
+    """Delete the tombstones older than any usable token; returns how many."""
+    cutoff = timezone.now() - timedelta(seconds=TOKEN_MAX_AGE) - CLOCK_MARGIN
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
+
+
+def changes(day, since=None):
+    """The roster and the menu of ``day``: all of it, or what changed after ``since``."""
+    # Taken before reading, so whatever changes during the reads is sent again next time
+    token = make_token(day, timezone.now() - CLOCK_MARGIN)
+    students = Student.objects.all()
+    meals = Meal.objects.filter(serving_date=day)
+    deleted_students, deleted_meals = [], []
+
+    if since is not None:
+        _, last_modified = reports.data_state([reports.STUDENTS, reports.MEALS])
+        if last_modified is not None and last_modified <= since:
+            # Neither table has changed: one query for the data versions answers the pull
+            students, meals = Student.objects.none(), Meal.objects.none()
+        else:
+            students = students.filter(updated_at__gt=since)
+            # Meals moved to another day since are removed from this day's menu
+            meals = Meal.objects.filter(updated_at__gt=since)
+            tombstones = Tombstone.objects.filter(deleted_at__gt=since).values_list('model', 'object_id')
+            for model, object_id in tombstones:
+                (deleted_students if model == 'student' else deleted_meals).append(object_id)
+
+    menu = []
+    for row in meals.values_list(*MEAL_FIELDS):
+        if row[MEAL_FIELDS.index('serving_date')] == day:
+            menu.append(row)
+        else:
+            deleted_meals.append(row[0])
+    return {
+        'token': token,
+        'full': since is None,
+        'date': day,
+        'students': {'fields': STUDENT_FIELDS, 'rows': list(students.values_list(*STUDENT_FIELDS)),
+                     'deleted': deleted_students},
+        'meals': {'fields': MEAL_FIELDS, 'rows': menu, 'deleted': deleted_meals},
+    }
+
+
+def push_records(records):
+    """Validate keyed check-ins, setting aside the keys already recorded.
+
+    Returns ``(consumptions, duplicate keys, errors)``; errors are reported
+    by the record's index in ``records``, like a check-in batch.
+    """
+    errors = []
+    keyed = []
+    for index, record in enumerate(records):
+        key = record.get('key') if isinstance(record, dict) else None
+        if not isinstance(key, str) or not key or len(key) > KEY_MAX_LENGTH:
+            errors.append({'index': index, 'errors': {
+                'key': [f'Enter a unique key of at most {KEY_MAX_LENGTH} characters.'],
+            }})
+            continue
+        keyed.append((index, key, record))
+
+    keys = {key for _, key, _ in keyed}
+    seen = set(MealConsumption.objects.filter(idempotency_key__in=keys).values_list('idempotency_key', flat=True))
+    # Checked before validation: the roster already counts queued check-ins as served
+    seen |= writebehind.queued_keys(keys)
+    duplicates = []
+    fresh = []
+    for index, key, record in keyed:
+        if key in seen:
+            duplicates.append(key)
+            continue
+        seen.add(key)
+        fresh.append((index, key, record))
+
+    consumptions, fresh_errors = validate_consumption_records([record for _, _, record in fresh])
+    for error in fresh_errors:
+        errors.append({**error, 'index': fresh[error['index']][0]})
+    rejected = {error['index'] for error in fresh_errors}
+    accepted = [key for position, (_, key, _) in enumerate(fresh) if position not in rejected]
+    for key, consumption in zip(accepted, consumptions):
+        consumption.idempotency_key = key
+    errors.sort(key=lambda error: error['index'])
+    return consumptions, duplicates, errors
+
+
+def _split_recorded(records, consumptions):
+    """(consumptions to write, errors for those whose student, meal and time are taken) of a push."""
+    indexes = {}
+    for index, record in enumerate(records):
+        indexes.setdefault(record.get('key') if isinstance(record, dict) else None, index)
+    taken = set(MealConsumption.objects.filter(
+        student_id__in={c.student_id for c in consumptions},
+        meal_id__in={c.meal_id for c in consumptions},
+        consumed_at__in={c.consumed_at for c in consumptions},
+    ).values_list('student_id', 'meal_id', 'consumed_at'))
+    kept, errors = [], []
+    for consumption in consumptions:
+        check_in = (consumption.student_id, consumption.meal_id, consumption.consumed_at)
+        if check_in in taken:
+            errors.append({'index': indexes[consumption.idempotency_key], 'errors': {
+                '__all__': ['This check-in is already recorded under another key.'],
+            }})
+            continue
+        # A later record of the same push repeating it is refused too
+        taken.add(check_in)
+        kept.append(consumption)
+    return kept, errors
+
+
+def record_pushed(records, check_recorded=False):
+    """Write (or queue) the new check-ins of a push; returns the response body and status.
+
+    With ``check_recorded``, check-ins clashing with recorded ones are
+    reported as errors instead of failing the whole insert.
+    """
+    consumptions, duplicates, errors = push_records(records)
+    clashes = []
+    if check_recorded and consumptions:
+        consumptions, clashes = _split_recorded(records, consumptions)
+        errors = sorted(errors + clashes, key=lambda error: error['index'])
+    found = dietary.find_conflicts((c.student_id, c.meal_id) for c in consumptions)
+    body = {
+        'recorded': [c.idempotency_key for c in consumptions],
+        'duplicates': duplicates,
+        'failed': len(errors),
+        'errors': errors,
+        'conflicts': [
+            {'key': c.idempotency_key, 'meal': c.meal_id, 'restrictions': found[(c.student_id, c.meal_id)]}
+            for c in consumptions if (c.student_id, c.meal_id) in found
+        ],
+    }
+    if consumptions and writebehind.is_enabled():
+        # The flusher also skips keys already written, for a replay sent to another process before the flush
+        writebehind.get_queue().enqueue(consumptions)
+        return body, 202
+    if consumptions:
+        bulk_insert_consumptions(consumptions)
+        return body, 201
+    if clashes:
+        return body, 409
+    return body, 400 if errors and not duplicates else 200
+
+
+@gzip_page
+@require_GET
+def pull(request):
+    try:
+        day = parse_date(request.GET['date']) if request.GET.get('date') else timezone.localdate()
+    except ValueError:
+        day = None
+    if day is None:
+        return JsonResponse({'error': 'date must be YYYY-MM-DD.'}, status=400)
+    payload = changes(day, read_token(request.GET.get('since'), day))
+    return JsonResponse(payload, json_dumps_params={'separators': (',', ':')})
+
+
+@csrf_exempt
+@require_POST
+def push(request):
+    try:
+        records = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'Request body must be valid JSON.'}, status=400)
+    if isinstance(records, dict):
+        records = records.get('records')
+    if not isinstance(records, list):
+        return JsonResponse({'error': 'Expected a JSON array of consumption records.'}, status=400)
+    if len(records) > MAX_BATCH_RECORDS:
+        return JsonResponse({'error': f'A batch may contain at most {MAX_BATCH_RECORDS} records.'}, status=400)
+
+    try:
+        body, status = record_pushed(records)
+    except IntegrityError:
+        # A concurrent push of the same outbox won the race, and retrying finds its keys recorded, or the same
+        # check-ins were recorded under other keys, which the retry reports record by record
+        body, status = record_pushed(records, check_recorded=True)
+    return JsonResponse(body, status=status)
@@ -1,3 +1,1679 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import pstats
+import re
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from school_lunch_system.metrics import registry
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from .models import (
+    Student, Meal, MealConsumption, MealDailyRollup, Counter, MealConflict, ServingDay, ReportJob, School, Tombstone,
+)
+from . import archive, counters, dietary, intake, jobs, parallel, reports, rollups, roster, search, sharding, sync
+from . import pagination
+from .pagination import KeysetPaginator
+from .batch import ALREADY_SERVED, bulk_insert_consumptions, validate_consumption_records
+from .forms import MealConsumptionForm
+from . import writebehind
+
+
+# Keep report caching away from the on-disk cache of the development server, and never
+# serve stale reports (the background refresh thread cannot see the test transaction).
+# The per-process serving roster would outlive each test's rolled-back rows; RosterTests enable it.
+_test_cache = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'meals-tests'}},
+    REPORT_CACHE_MAX_STALE=0,
+    MEALS_SERVING_ROSTER=False,
+)
+
+
+def setUpModule():
+    _test_cache.enable()
+
+
+def tearDownModule():
+    _test_cache.disable()
+
+
+def make_meal(**kwargs):
+    values = {
+        'name': 'Pasta',
+        'meal_type': 'lunch',
+        'serving_date': date(2025, 4, 14),
+        'protein': 10,
+        'carbohydrates': 50,
+        'fats': 5,
+    }
+    values.update(kwargs)
+    return Meal.objects.create(**values)
+
+
+class ConsumptionBatchTests(TestCase):
+    def setUp(self):
+        self.students = [
+            Student.objects.create(student_id=f'S{i:03d}', name=f'Student {i}', grade='5')
+            for i in range(3)
+        ]
+        self.meal = make_meal()
+        self.url = reverse('consumption-batch')
+
+    def post(self, payload):
+        return self.client.post(self.url, data=json.dumps(payload), content_type='application/json')
+
+    def test_creates_all_valid_records(self):
+        records = [
+            {'student_id': s.student_id, 'meal': self.meal.id, 'portion_consumed': 0.5, 'waste_weight': 20}
+            for s in self.students
+        ]
+        response = self.post(records)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 3)
+        self.assertEqual(MealConsumption.objects.count(), 3)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        students = [Student(student_id=f'B{i:03d}', name=f'Bulk {i}', grade='5') for i in range(40)]
+        Student.objects.bulk_create(students)
+
+        def post_batch(meal, batch):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post([
+                    {'student_id': s.student_id, 'meal': meal.id, 'portion_consumed': 1.0} for s in batch
+                ])
+            self.assertEqual(response.status_code, 201)
+            return len(queries)
+
+        # The first batch also creates the lazily initialised counter rows
+        post_batch(make_meal(), students[:1])
+        self.assertEqual(post_batch(make_meal(), students[1:3]), post_batch(make_meal(), students[3:]))
+
+    def test_reports_per_row_errors(self):
+        records = [
+            {'student_id': 'S000', 'meal': self.meal.id, 'portion_consumed': 1.0},
+            {'student_id': 'missing', 'meal': self.meal.id, 'portion_consumed': 0.5},
+            {'student_id': 'S001', 'meal': self.meal.id, 'portion_consumed': 1.5},
+            {'student_id': 'S000', 'meal': self.meal.id, 'portion_consumed': 0.2},
+        ]
+        response = self.post(records)
+        body = response.json()
+        self.assertEqual(body['created'], 1)
+        self.assertEqual([e['index'] for e in body['errors']], [1, 2, 3])
+        self.assertIn('student_id', body['errors'][0]['errors'])
+        self.assertIn('portion_consumed', body['errors'][1]['errors'])
+
+    def test_rejects_non_finite_numbers_and_bad_meal_ids(self):
+        records = [
+            {'student_id': 'S000', 'meal': self.meal.id, 'portion_consumed': 'nan'},
+            {'student_id': 'S001', 'meal': self.meal.id, 'portion_consumed': 0.5, 'waste_weight': 'inf'},
+            {'student_id': 'S002', 'meal': f'{self.meal.id}.7', 'portion_consumed': 0.5},
+            {'student_id': 'S002', 'portion_consumed': 0.5},
+            {'student_id': 'S002', 'meal': 'soup', 'portion_consumed': 0.5},
+        ]
+        body = self.post(records).json()
+        self.assertEqual(body['created'], 0)
+        self.assertEqual([list(e['errors']) for e in body['errors']],
+                         [['portion_consumed'], ['waste_weight'], ['meal'], ['meal'], ['meal']])
+        self.assertEqual(body['errors'][2]['errors']['meal'], ['Enter a whole number.'])
+        self.assertEqual(body['errors'][3]['errors']['meal'], ['This field is required.'])
+        self.assertFalse(MealConsumption.objects.exists())
+
+    def test_rejects_malformed_payload(self):
+        response = self.client.post(self.url, data='not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post({'student_id': 'S000'}).status_code, 400)
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.log_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        self.student = Student.objects.create(student_id='S100', name='Queued', grade='4')
+        self.meal = make_meal()
+        # The flusher thread would use its own connection; tests drain synchronously instead
+        patcher = mock.patch.object(writebehind.WriteBehindQueue, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_endpoint_queues_until_flushed(self):
+        queue = writebehind.WriteBehindQueue(self.log_dir)
+        with override_settings(MEALS_WRITE_BEHIND=True), \
+                mock.patch.object(writebehind, 'get_queue', return_value=queue):
+            response = self.client.post(
+                reverse('consumption-batch'),
+                data=json.dumps([{'student_id': 'S100', 'meal': self.meal.id, 'portion_consumed': 0.8}]),
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(MealConsumption.objects.count(), 0)
+
+        self.assertEqual(queue.flush(), 1)
+        self.assertEqual(MealConsumption.objects.count(), 1)
+
+    def test_replayed_segment_is_not_inserted_twice(self):
+        queue = writebehind.WriteBehindQueue(self.log_dir)
+        consumption = MealConsumption(student=self.student, meal=self.meal, portion_consumed=0.5)
+        queue.enqueue([consumption])
+        shutil.copy(queue.log_path, self.log_dir / 'replay.1.flushing')
+
+        self.assertEqual(writebehind.drain_directory(self.log_dir), 1)
+        self.assertEqual(MealConsumption.objects.count(), 1)
+        self.assertEqual(list(self.log_dir.iterdir()), [])
+
+
+class ImportLunchDataTests(TestCase):
+    def write_file(self, name, content):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        path = directory / name
+        path.write_text(content, encoding='utf-8')
+        return str(path)
+
+    def run_import(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_lunch_data', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_students_are_upserted_on_student_id(self):
+        Student.objects.create(student_id='S1', name='Old Name', grade='3')
+        path = self.write_file('students.csv', (
+            'student_id,name,grade,dietary_restrictions\n'
+            'S1,New Name,4,\n'
+            'S2,Second,5,Peanuts\n'
+            ',Missing Id,5,\n'
+        ))
+        out, err = self.run_import('students', path, '--chunk-size', '2')
+        self.assertIn('Imported 2 students (1 rejected)', out)
+        self.assertIn('Row 3', err)
+        self.assertEqual(Student.objects.get(student_id='S1').name, 'New Name')
+        self.assertEqual(Student.objects.count(), 2)
+        self.assertEqual(counters.get_counts()['students'], 2)
+
+    def test_meals_and_consumptions_from_ndjson(self):
+        Student.objects.create(student_id='S1', name='Eater', grade='3')
+        meals_path = self.write_file('meals.ndjson', json.dumps({
+            'name': 'Rice Bowl', 'meal_type': 'lunch', 'serving_date': '2025-04-14',
+            'protein': 10, 'carbohydrates': 40, 'fats': 5,
+        }) + '\n')
+        self.run_import('meals', meals_path)
+        meal = Meal.objects.get()
+        self.assertEqual(meal.calories, 245)
+
+        consumptions_path = self.write_file('consumptions.ndjson', json.dumps({
+            'student_id': 'S1', 'meal': meal.id, 'portion_consumed': 0.75,
+            'consumed_at': '2025-04-14T12:00:00',
+        }) + '\n')
+        self.run_import('consumptions', consumptions_path)
+        self.assertEqual(MealConsumption.objects.get().portion_consumed, 0.75)
+        self.assertEqual(counters.get_counts(), counters.current_totals())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        student = Student.objects.create(student_id='S1', name='Exporter', grade='6')
+        self.lunch = make_meal()
+        breakfast = make_meal(name='Oats', meal_type='breakfast')
+        MealConsumption.objects.create(student=student, meal=self.lunch, portion_consumed=0.5, waste_weight=30)
+        MealConsumption.objects.create(student=student, meal=breakfast, portion_consumed=1.0, waste_weight=0)
+
+    def test_consumption_csv_streams_filtered_rows(self):
+        response = self.client.get(reverse('export-consumptions'), {'meal_type': 'lunch'})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'consumed_at', 'student_id'])
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Pasta', lines[1])
+
+    def test_unfiltered_export(self):
+        response = self.client.get(reverse('export-consumptions'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 3)
+
+    def test_waste_ndjson(self):
+        response = self.client.get(reverse('export-waste'), {'format': 'ndjson'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual({row['meal_name']: row['total_waste'] for row in rows}, {'Pasta': 30.0, 'Oats': 0.0})
+
+    def test_invalid_filter_is_rejected(self):
+        response = self.client.get(reverse('export-consumptions'), {'date_from': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command_writes_csv(self):
+        out = io.StringIO()
+        call_command('export_lunch_data', 'consumptions', '--meal-type', 'breakfast', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.students = [
+            Student.objects.create(student_id=f'R{i}', name=f'Rollup {i}', grade='2') for i in range(3)
+        ]
+        self.meal = make_meal()
+
+    def rollup(self):
+        return MealDailyRollup.objects.get(meal=self.meal)
+
+    def test_create_edit_and_delete_keep_rollup_in_step(self):
+        first = MealConsumption.objects.create(
+            student=self.students[0], meal=self.meal, portion_consumed=0.5, waste_weight=10)
+        second = MealConsumption.objects.create(
+            student=self.students[1], meal=self.meal, portion_consumed=1.0, waste_weight=40)
+        rollup = self.rollup()
+        self.assertEqual((rollup.consumption_count, rollup.waste_sum), (2, 50))
+        self.assertEqual((rollup.waste_min, rollup.waste_max), (10, 40))
+
+        second.waste_weight = 20
+        second.save()
+        rollup = self.rollup()
+        self.assertEqual((rollup.waste_sum, rollup.waste_max), (30, 20))
+
+        first.delete()
+        rollup = self.rollup()
+        self.assertEqual((rollup.consumption_count, rollup.portion_sum), (1, 1.0))
+        self.assertEqual((rollup.waste_min, rollup.waste_max), (20, 20))
+
+        second.delete()
+        self.assertFalse(MealDailyRollup.objects.exists())
+
+    def test_bulk_insert_updates_rollup_and_rebuild_matches(self):
+        self.client.post(reverse('consumption-batch'), data=json.dumps([
+            {'student_id': s.student_id, 'meal': self.meal.id, 'portion_consumed': 0.5, 'waste_weight': 5 * i}
+            for i, s in enumerate(self.students)
+        ]), content_type='application/json')
+        incremental = self.rollup()
+        self.assertEqual(incremental.consumption_count, 3)
+
+        rollups.rebuild()
+        rebuilt = self.rollup()
+        for field in ('consumption_count', 'portion_sum', 'waste_count', 'waste_sum', 'waste_min', 'waste_max'):
+            self.assertEqual(getattr(rebuilt, field), getattr(incremental, field), field)
+
+    def test_reports_read_rollups(self):
+        MealConsumption.objects.create(student=self.students[0], meal=self.meal, portion_consumed=0.5, waste_weight=12)
+        response = self.client.get(reverse('meal-detail', args=[self.meal.id]))
+        self.assertEqual(response.context['total_consumptions'], 1)
+        self.assertEqual(response.context['total_waste'], 12)
+        response = self.client.get(reverse('waste-report'))
+        self.assertEqual(response.context['total_waste'], 12)
+        self.assertEqual(response.context['meals_with_waste'][0]['avg_waste'], 12)
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.student = Student.objects.create(student_id='C1', name='Counted', grade='3')
+        self.meal = make_meal()
+
+    def assertCountersMatchTables(self):
+        self.assertEqual(counters.get_counts(), counters.current_totals())
+
+    def test_signals_and_bulk_paths_keep_counters_in_step(self):
+        consumption = MealConsumption.objects.create(
+            student=self.student, meal=self.meal, portion_consumed=0.5, waste_weight=10)
+        consumption.waste_weight = 25
+        consumption.save()
+        self.assertCountersMatchTables()
+
+        other = Student.objects.create(student_id='C2', name='Other', grade='3')
+        self.client.post(reverse('consumption-batch'), data=json.dumps([
+            {'student_id': 'C2', 'meal': self.meal.id, 'portion_consumed': 1.0, 'waste_weight': 4},
+        ]), content_type='application/json')
+        self.assertCountersMatchTables()
+
+        other.delete()
+        self.meal.delete()
+        self.assertCountersMatchTables()
+        self.assertEqual(counters.get_counts()['consumptions'], 0)
+
+    def test_dashboard_reads_counters_in_constant_queries(self):
+        MealConsumption.objects.create(student=self.student, meal=self.meal, portion_consumed=0.5, waste_weight=7.5)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['total_students'], 1)
+        self.assertEqual(response.context['total_consumptions'], 1)
+        self.assertEqual(response.context['total_waste'], 7.5)
+
+    def test_recount_repairs_drift(self):
+        Counter.objects.filter(name='students').update(value=99)
+        out = io.StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('students: 99.0 -> 1', out.getvalue())
+        self.assertCountersMatchTables()
+
+
+class DietaryConflictTests(TestCase):
+    def setUp(self):
+        self.day = date(2025, 4, 14)
+        self.nutty = Student.objects.create(
+            student_id='D1', name='Nutty', grade='4', dietary_restrictions='Peanut allergy; lactose intolerant')
+        self.veggie = Student.objects.create(
+            student_id='D2', name='Veggie', grade='4', dietary_restrictions='Vegetarian')
+        self.free = Student.objects.create(student_id='D3', name='Free', grade='4', dietary_restrictions='None')
+        self.curry = make_meal(name='Chicken Curry', serving_date=self.day)
+        dietary.set_meal_tags(self.curry, ['meat', 'dairy'])
+        self.satay = make_meal(name='Satay', serving_date=self.day)
+        dietary.set_meal_tags(self.satay, ['peanuts'])
+
+    def test_restrictions_are_parsed_into_tags(self):
+        self.assertEqual(dietary.parse_tags('Peanut allergy; lactose intolerant'), ['dairy', 'peanuts'])
+        self.assertEqual(dietary.parse_tags('Vegetarian and no eggs'), ['eggs', 'fish', 'meat', 'shellfish'])
+        self.assertEqual(dietary.parse_tags('None'), [])
+        self.assertEqual(sorted(self.nutty.dietary_tags.values_list('name', flat=True)), ['dairy', 'peanuts'])
+        self.assertFalse(self.free.dietary_tags.exists())
+
+    def test_finalized_day_answers_from_the_conflict_set(self):
+        self.assertEqual(dietary.build_day(self.day), 3)
+        self.assertTrue(ServingDay.objects.filter(date=self.day).exists())
+        pairs = [(s.pk, m.pk) for s in (self.nutty, self.veggie, self.free) for m in (self.curry, self.satay)]
+        with self.assertNumQueries(2):
+            conflicts = dietary.find_conflicts(pairs)
+        self.assertEqual(conflicts, {
+            (self.nutty.pk, self.curry.pk): ['dairy'],
+            (self.nutty.pk, self.satay.pk): ['peanuts'],
+            (self.veggie.pk, self.curry.pk): ['meat'],
+        })
+
+        # Edits after finalizing keep the stored set in step
+        self.free.dietary_restrictions = 'peanuts'
+        self.free.save()
+        dietary.set_meal_tags(self.curry, ['meat'])
+        self.assertEqual(
+            set(MealConflict.objects.values_list('student_id', 'meal_id', 'tags')),
+            {(self.nutty.pk, self.satay.pk, 'peanuts'), (self.veggie.pk, self.curry.pk, 'meat'),
+             (self.free.pk, self.satay.pk, 'peanuts')},
+        )
+        self.satay.serving_date = self.day + timedelta(days=1)
+        self.satay.save()
+        self.assertFalse(MealConflict.objects.filter(meal=self.satay).exists())
+        self.assertIn((self.free.pk, self.satay.pk), dietary.find_conflicts([(self.free.pk, self.satay.pk)]))
+
+    def test_check_in_paths_flag_conflicts(self):
+        dietary.build_day(self.day)
+        response = self.client.post(reverse('consumption-batch'), data=json.dumps([
+            {'student_id': 'missing', 'meal': self.curry.pk, 'portion_consumed': 1.0},
+            {'student_id': 'D3', 'meal': self.curry.pk, 'portion_consumed': 1.0},
+            {'student_id': 'D2', 'meal': self.curry.pk, 'portion_consumed': 1.0},
+        ]), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['conflicts'], [
+            {'index': 2, 'student_id': 'D2', 'meal': self.curry.pk, 'restrictions': ['meat']},
+        ])
+
+        response = self.client.post(reverse('consumption-create'), {
+            'student': self.nutty.pk, 'meal': self.satay.pk, 'portion_consumed': 0.5,
+        }, follow=True)
+        self.assertTrue(MealConsumption.objects.filter(student=self.nutty, meal=self.satay).exists())
+        self.assertIn('restricted from peanuts', ' '.join(str(m) for m in response.context['messages']))
+
+    def test_meal_form_and_finalize_command(self):
+        response = self.client.post(reverse('meal-create'), {
+            'name': 'Pancakes', 'meal_type': 'breakfast', 'serving_date': '2025-04-14',
+            'protein': 5, 'carbohydrates': 40, 'fats': 8, 'allergens': 'Milk, egg',
+        })
+        self.assertEqual(response.status_code, 302)
+        pancakes = Meal.objects.get(name='Pancakes')
+        self.assertEqual(sorted(pancakes.allergen_tags.values_list('name', flat=True)), ['dairy', 'eggs'])
+
+        out = io.StringIO()
+        call_command('finalize_menu', '2025-04-14', stdout=out)
+        self.assertIn('2025-04-14: 4 dietary conflicts', out.getvalue())
+        self.assertEqual(MealConflict.objects.get(meal=pancakes).student, self.nutty)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        Student.objects.bulk_create([
+            Student(student_id='S0101', name='Maya Patel', grade='5'),
+            Student(student_id='S0102', name='Mayank Rao', grade='5'),
+            Student(student_id='S0201', name='Liam Chen', grade='7'),
+        ])
+        self.pasta = make_meal(name='Pasta', description='Whole wheat penne with tomato sauce')
+        self.curry = make_meal(name='Tomato Curry', description='Mild curry')
+
+    def names(self, queryset):
+        return [obj.name for obj in queryset]
+
+    def test_prefix_search_is_ranked_and_follows_writes(self):
+        self.assertEqual(self.names(search.search(Student.objects.all(), 'may pat')), ['Maya Patel'])
+        self.assertEqual(self.names(search.search(Student.objects.all(), 's02')), ['Liam Chen'])
+        # A name match ranks above a description match
+        self.assertEqual(self.names(search.ranked(search.search(Meal.objects.all(), 'tomato'))),
+                         ['Tomato Curry', 'Pasta'])
+        # FTS5 syntax typed by a user is not parsed as a query
+        self.assertEqual(self.names(search.search(Meal.objects.all(), 'curry* ("')), ['Tomato Curry'])
+
+        self.curry.name = 'Lentil Stew'
+        self.curry.save()
+        Student.objects.filter(name='Liam Chen').delete()
+        self.assertEqual(self.names(search.search(Meal.objects.all(), 'curry')), ['Lentil Stew'])
+        self.assertFalse(search.search(Meal.objects.all(), 'tomato curry').exists())
+        self.assertFalse(search.search(Student.objects.all(), 'liam').exists())
+
+    def test_fallback_without_full_text_index(self):
+        with override_settings(MEALS_FULL_TEXT_SEARCH=False):
+            results = search.search(Student.objects.all(), 'patel')
+            self.assertNotIn('search_rank', results.query.extra)
+            self.assertEqual(sorted(self.names(results)), ['Maya Patel'])
+            self.assertEqual(self.names(search.search(Meal.objects.all(), 'penne tomato')), ['Pasta'])
+
+    def test_list_views_and_admin_use_the_index(self):
+        response = self.client.get(reverse('student-list'), {'name': 'may', 'grade': '5'})
+        self.assertEqual(self.names(response.context['students']), ['Maya Patel', 'Mayank Rao'])
+        response = self.client.get(reverse('meal-list'), {'q': 'whole wheat'})
+        self.assertEqual(self.names(response.context['meal_list']), ['Pasta'])
+
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/meals/student/', {'q': 'rao'})
+        self.assertEqual(self.names(response.context['cl'].result_list), ['Mayank Rao'])
+        self.assertFalse(any('LIKE' in query['sql'] for query in queries.captured_queries))
+
+
+class MealEnergyTests(TestCase):
+    def test_calories_and_shares_follow_every_write_path(self):
+        meal = make_meal(protein=10, carbohydrates=50, fats=5)
+        meal.refresh_from_db()
+        self.assertEqual(meal.calories, 285)
+        self.assertAlmostEqual(meal.protein_pct + meal.carbohydrates_pct + meal.fats_pct, 100)
+        self.assertAlmostEqual(meal.fats_pct, 45 / 285 * 100)
+
+        # The update view used to leave calories stale
+        self.client.post(reverse('meal-update', args=[meal.pk]), {
+            'name': meal.name, 'meal_type': meal.meal_type, 'serving_date': meal.serving_date,
+            'protein': 20, 'carbohydrates': 50, 'fats': 5,
+        })
+        Meal.objects.filter(pk=meal.pk).update(fats=10)
+        meal.refresh_from_db()
+        self.assertEqual((meal.protein, meal.calories), (20, 370))
+
+        empty = make_meal(name='Water', protein=0, carbohydrates=0, fats=0)
+        empty.refresh_from_db()
+        self.assertEqual(empty.calories, 0)
+        self.assertIsNone(empty.protein_pct)
+
+    def test_list_filters_sorts_and_pages_in_the_database(self):
+        Meal.objects.bulk_create([
+            Meal(name=f'Meal {i}', meal_type='lunch', serving_date=date(2025, 4, 14), protein=i, carbohydrates=40,
+                 fats=5)
+            for i in range(60)
+        ])
+        url = reverse('meal-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'calories_min': 300, 'sort': '-calories'})
+        self.assertEqual(len(queries), 2)
+        meals = response.context['meal_list']
+        # 4 * (i + 40) + 45 >= 300 from i = 24 on
+        self.assertEqual(response.context['paginator'].count, 36)
+        self.assertEqual([m.name for m in meals[:2]], ['Meal 59', 'Meal 58'])
+
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(len(response.context['meal_list']), 10)
+
+        response = self.client.get(url, {'protein_pct_min': 20, 'fats_pct_max': 15, 'sort': 'calories'})
+        names = [m.name for m in response.context['meal_list']]
+        self.assertTrue(names)
+        self.assertTrue(all(20 <= m.protein_pct and m.fats_pct <= 15 for m in response.context['meal_list']))
+        self.assertEqual(names, sorted(names, key=lambda name: int(name.split()[1])))
+
+        response = self.client.get(url, {'calories_min': 500, 'calories_max': 100})
+        self.assertIn('calories_max', response.context['search_form'].errors)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.students = [
+            Student.objects.create(student_id=f'P{i:03d}', name=f'Pupil {i}', grade='3' if i % 2 else '4')
+            for i in range(5)
+        ]
+        self.meal = make_meal()
+        for i, student in enumerate(self.students):
+            MealConsumption.objects.create(student=student, meal=self.meal, portion_consumed=0.5, waste_weight=i)
+
+    def get(self, name, params=None, **headers):
+        return self.client.get(reverse(name), params or {}, headers=headers)
+
+    def test_fields_filters_and_cursor_pagination(self):
+        body = self.get('api-students', {'grade': '3', 'fields': 'student_id,name'}).json()
+        self.assertEqual(body['results'], [
+            {'student_id': 'P001', 'name': 'Pupil 1'}, {'student_id': 'P003', 'name': 'Pupil 3'},
+        ])
+        self.assertIsNone(body['next'])
+
+        seen = []
+        url = reverse('api-consumptions') + '?limit=2&fields=student_id,waste_weight'
+        while url:
+            with self.assertNumQueries(2):
+                body = self.client.get(url).json()
+            seen.extend(body['results'])
+            url = body['next']
+        self.assertEqual([row['waste_weight'] for row in seen], [4, 3, 2, 1, 0])
+        self.assertEqual(seen[0], {'student_id': 'P004', 'waste_weight': 4})
+
+        meals = self.get('api-meals', {'meal_type': 'lunch', 'fields': 'name,calories'}).json()['results']
+        self.assertEqual(meals, [{'name': 'Pasta', 'calories': 285}])
+
+    def test_invalid_parameters_are_rejected(self):
+        self.assertEqual(self.get('api-students', {'fields': 'name,password'}).status_code, 400)
+        self.assertEqual(self.get('api-meals', {'date_from': 'soon'}).status_code, 400)
+        self.assertEqual(self.get('api-consumptions', {'after': 'garbage'}).status_code, 400)
+        self.assertEqual(self.client.post(reverse('api-students')).status_code, 405)
+
+    def test_conditional_get_returns_304_until_data_changes(self):
+        response = self.get('api-students')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get('api-students', If_None_Match=etag).status_code, 304)
+        self.assertEqual(self.get('api-students', If_Modified_Since=last_modified).status_code, 304)
+        # Other parameters, or other tables changing, leave the ETag alone
+        self.assertNotEqual(self.get('api-students', {'grade': '3'})['ETag'], etag)
+        make_meal(name='Soup')
+        self.assertEqual(self.get('api-students', If_None_Match=etag).status_code, 304)
+
+        self.students[0].name = 'Renamed'
+        self.students[0].save()
+        response = self.get('api-students', If_None_Match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['name'], 'Renamed')
+
+    def test_reports(self):
+        body = self.get('api-report-waste', {'grade': '4'}).json()
+        self.assertEqual(body['total_servings'], 3)
+        self.assertEqual(body['total_waste'], 6)
+        response = self.get('api-report-nutrition')
+        self.assertEqual(response.json()['avg_calories'], 285)
+        self.assertEqual(self.get('api-report-nutrition', If_None_Match=response['ETag']).status_code, 304)
+
+
+class SyncTests(TestCase):
+    day = date(2025, 4, 14)
+
+    def setUp(self):
+        self.student = Student.objects.create(student_id='K001', name='Kiosk Kid', grade='2',
+                                              dietary_restrictions='peanut allergy')
+        self.other = Student.objects.create(student_id='K002', name='Other Kid', grade='2')
+        self.meal = make_meal()
+        self.later = make_meal(name='Stew', serving_date=self.day + timedelta(days=1))
+        # Nothing else writes during a test, so deltas can start exactly at the token
+        patcher = mock.patch.object(sync, 'CLOCK_MARGIN', timedelta(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pull(self, since=None, day=None):
+        params = {'date': (day or self.day).isoformat()}
+        if since:
+            params['since'] = since
+        response = self.client.get(reverse('sync-pull'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def push(self, records):
+        return self.client.post(reverse('sync-push'), data=json.dumps({'records': records}),
+                                content_type='application/json')
+
+    def test_full_pull_then_deltas(self):
+        body = self.pull()
+        self.assertTrue(body['full'])
+        self.assertEqual(body['students']['fields'][:3], ['id', 'student_id', 'name'])
+        self.assertEqual([row[1] for row in body['students']['rows']], ['K001', 'K002'])
+        self.assertEqual([row[1] for row in body['meals']['rows']], ['Pasta'])
+
+        # Nothing changed: the data versions alone answer the pull
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('sync-pull'), {'date': self.day.isoformat(), 'since': body['token']})
+        unchanged = response.json()
+        self.assertFalse(unchanged['full'])
+        self.assertEqual(unchanged['students']['rows'], [])
+        self.assertEqual(unchanged['meals']['rows'], [])
+
+        self.student.name = 'Renamed Kid'
+        self.student.save()
+        other_pk, pasta_pk = self.other.pk, self.meal.pk
+        self.other.delete()
+        self.meal.serving_date = self.day + timedelta(days=2)
+        self.meal.save()
+        soup = make_meal(name='Soup')
+        self.later.name = 'Tomorrow only'
+        self.later.save()
+
+        delta = self.pull(unchanged['token'])
+        self.assertEqual([row[2] for row in delta['students']['rows']], ['Renamed Kid'])
+        self.assertEqual(delta['students']['deleted'], [other_pk])
+        self.assertEqual([row[0] for row in delta['meals']['rows']], [soup.pk])
+        # Moved away from the day; the other day's meal is not part of this menu at all
+        self.assertIn(pasta_pk, delta['meals']['deleted'])
+
+        self.assertEqual(self.pull(delta['token'])['students']['rows'], [])
+
+    def test_tombstones_are_pruned_once_no_token_needs_them(self):
+        token = self.pull()['token']
+        other_pk = self.other.pk
+        self.other.delete()
+        Tombstone.objects.create(model='meal', object_id=2 ** 40,
+                                 deleted_at=timezone.now() - timedelta(seconds=sync.TOKEN_MAX_AGE + 60))
+        out = io.StringIO()
+        call_command('prune_tombstones', stdout=out)
+        self.assertIn('Pruned 1 tombstone(s)', out.getvalue())
+        self.assertEqual(self.pull(token)['students']['deleted'], [other_pk])
+
+    def test_unusable_tokens_get_a_full_snapshot(self):
+        token = self.pull()['token']
+        self.assertTrue(self.pull(token, day=self.day + timedelta(days=1))['full'])
+        self.assertTrue(self.pull(token[:-2] + 'xx')['full'])
+        self.assertEqual(self.client.get(reverse('sync-pull'), {'date': 'monday'}).status_code, 400)
+
+    def test_pull_is_compressed(self):
+        response = self.client.get(reverse('sync-pull'), {'date': self.day.isoformat()},
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['meals']['rows'][0][1], 'Pasta')
+
+    def test_replayed_push_records_nothing_new(self):
+        dietary.set_meal_tags(self.meal, ['peanuts'])
+        records = [
+            {'key': 'tablet-1:1', 'student_id': 'K001', 'meal': self.meal.pk, 'portion_consumed': 1},
+            {'key': 'tablet-1:2', 'student_id': 'K002', 'meal': self.meal.pk, 'portion_consumed': 0.5},
+            {'student_id': 'K002', 'meal': self.later.pk, 'portion_consumed': 0.5},
+        ]
+        response = self.push(records)
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual(body['recorded'], ['tablet-1:1', 'tablet-1:2'])
+        self.assertEqual([error['index'] for error in body['errors']], [2])
+        self.assertEqual(body['conflicts'], [{'key': 'tablet-1:1', 'meal': self.meal.pk, 'restrictions': ['peanuts']}])
+
+        with self.assertNumQueries(1):
+            replay = self.push(records[:2])
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.json()['duplicates'], ['tablet-1:1', 'tablet-1:2'])
+        self.assertEqual(MealConsumption.objects.count(), 2)
+        self.assertEqual(Counter.objects.get(name=counters.CONSUMPTIONS).value, 2)
+
+    def test_check_in_pushed_again_under_another_key_is_an_error(self):
+        check_in = {'key': 'tablet-5:1', 'student_id': 'K001', 'meal': self.meal.pk, 'portion_consumed': 1,
+                    'consumed_at': '2025-04-14T12:00:00Z'}
+        other = {**check_in, 'key': 'tablet-5:2', 'student_id': 'K002'}
+        # Repeated in one push: the insert fails on (student, meal, consumed_at) and the retry reports it
+        response = self.push([check_in, {**check_in, 'key': 'tablet-6:1'}, other])
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual(body['recorded'], ['tablet-5:1', 'tablet-5:2'])
+        self.assertEqual(body['errors'][0]['index'], 1)
+        self.assertEqual(MealConsumption.objects.count(), 2)
+
+        # Recorded by a concurrent push after this one was validated
+        late = {**check_in, 'key': 'tablet-7:1', 'meal': self.later.pk}
+        validated = sync.push_records([late])
+        self.push([{**late, 'key': 'tablet-8:1'}])
+        with mock.patch.object(sync, 'push_records', return_value=validated):
+            response = self.push([late])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['errors'][0]['errors']['__all__'],
+                         ['This check-in is already recorded under another key.'])
+        self.assertEqual(MealConsumption.objects.count(), 3)
+
+    def test_push_replayed_before_write_behind_flush_is_written_once(self):
+        log_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, log_dir)
+        queue = writebehind.WriteBehindQueue(log_dir)
+        records = [{'key': 'tablet-2:1', 'student_id': 'K001', 'meal': self.meal.pk, 'portion_consumed': 1}]
+        with override_settings(MEALS_WRITE_BEHIND=True), \
+                mock.patch.object(writebehind, 'get_queue', return_value=queue), \
+                mock.patch.object(writebehind.WriteBehindQueue, 'start'):
+            self.assertEqual(self.push(records).status_code, 202)
+            replay = self.push(records)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.json()['duplicates'], ['tablet-2:1'])
+        self.assertEqual(queue.flush(), 1)
+        self.assertEqual(MealConsumption.objects.get().idempotency_key, 'tablet-2:1')
+
+    @override_settings(MEALS_SERVING_ROSTER=True, MEALS_ROSTER_RECHECK_INTERVAL=60)
+    def test_push_replayed_before_flush_is_a_duplicate_for_the_roster(self):
+        roster._clear()
+        self.addCleanup(roster._clear)
+        log_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, log_dir)
+        queue = writebehind.WriteBehindQueue(log_dir)
+        today = make_meal(name='Today', serving_date=timezone.localdate())
+        records = [{'key': 'tablet-3:1', 'student_id': 'K001', 'meal': today.pk, 'portion_consumed': 1}]
+        with override_settings(MEALS_WRITE_BEHIND=True), \
+                mock.patch.object(writebehind, 'get_queue', return_value=queue), \
+                mock.patch.object(writebehind.WriteBehindQueue, 'start'):
+            # Queued check-ins are marked served once the request's transaction commits
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.push(records).status_code, 202)
+            replay = self.push(records).json()
+            self.assertEqual((replay['duplicates'], replay['errors']), (['tablet-3:1'], []))
+            # Another key for the same tray is still refused by the roster
+            again = self.push([{**records[0], 'key': 'tablet-4:1'}]).json()
+            self.assertEqual(again['errors'][0]['errors'], {'__all__': [ALREADY_SERVED]})
+            self.assertEqual(queue.flush(), 1)
+            replay = self.push(records).json()
+        self.assertEqual((replay['duplicates'], replay['errors']), (['tablet-3:1'], []))
+        self.assertEqual(queue.queued_keys(['tablet-3:1']), set())
+
+
+@override_settings(MEALS_SERVING_ROSTER=True, MEALS_ROSTER_RECHECK_INTERVAL=60)
+class RosterTests(TestCase):
+    def setUp(self):
+        roster._clear()
+        self.addCleanup(roster._clear)
+        self.students = [Student.objects.create(student_id=f'R{i:03d}', name=f'Roster {i}', grade='1')
+                         for i in range(3)]
+        self.meal = make_meal(serving_date=timezone.localdate())
+        self.past = make_meal(name='Old stew')
+        self.service = roster.get_roster()
+
+    def checkin(self, student, meal):
+        return {'student_id': student.student_id, 'meal': meal.pk, 'portion_consumed': 1.0}
+
+    def post(self, records):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('consumption-batch'), data=json.dumps(records),
+                                    content_type='application/json')
+
+    def test_todays_checkins_are_validated_without_queries(self):
+        with self.assertNumQueries(0):
+            consumptions, errors = validate_consumption_records([self.checkin(s, self.meal) for s in self.students])
+        self.assertEqual((len(consumptions), errors), (3, []))
+        # Meals of other days still come from the database
+        with self.assertNumQueries(2):
+            validate_consumption_records([self.checkin(self.students[0], self.past)])
+
+    def test_second_serving_is_rejected(self):
+        self.assertEqual(self.post([self.checkin(self.students[0], self.meal)]).status_code, 201)
+        self.assertTrue(self.service.is_served(self.students[0].pk, self.meal.pk))
+        body = self.post([self.checkin(s, self.meal) for s in self.students[:2]]).json()
+        self.assertEqual(body['created'], 1)
+        self.assertEqual(body['errors'], [{'index': 0, 'errors': {'__all__': [ALREADY_SERVED]}}])
+
+        # The same rule holds off the roster, and in the check-in form
+        self.post([self.checkin(self.students[0], self.past)])
+        body = self.post([self.checkin(self.students[0], self.past)]).json()
+        self.assertEqual(body['errors'][0]['errors'], {'__all__': [ALREADY_SERVED]})
+        form = MealConsumptionForm({'student': self.students[1].pk, 'meal': self.meal.pk, 'portion_consumed': 1})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), [ALREADY_SERVED])
+
+    def test_rolled_back_or_deleted_consumptions_are_not_served(self):
+        consumption = MealConsumption(student=self.students[2], meal=self.meal, portion_consumed=1)
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                bulk_insert_consumptions([consumption])
+                raise RuntimeError('the surrounding transaction fails')
+        self.assertFalse(self.service.is_served(self.students[2].pk, self.meal.pk))
+
+        self.post([self.checkin(self.students[2], self.meal)])
+        with self.captureOnCommitCallbacks(execute=True):
+            MealConsumption.objects.get().delete()
+        self.assertFalse(self.service.is_served(self.students[2].pk, self.meal.pk))
+
+    def test_roster_changes_rebuild_it(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            newcomer = Student.objects.create(student_id='R100', name='Newcomer', grade='1')
+        service = roster.get_roster()
+        self.assertIsNot(service, self.service)
+        self.assertEqual(service.student_pk('R100'), newcomer.pk)
+
+    def test_writes_of_other_processes_are_picked_up(self):
+        # Rows written elsewhere reach this process only through the bumped data versions
+        MealConsumption.objects.bulk_create([
+            MealConsumption(student=self.students[1], meal=self.meal, portion_consumed=1),
+        ])
+        reports.bump_versions(reports.CONSUMPTIONS)
+        self.assertFalse(self.service.is_served(self.students[1].pk, self.meal.pk))
+        with override_settings(MEALS_ROSTER_RECHECK_INTERVAL=0):
+            self.assertIs(roster.get_roster(), self.service)
+        self.assertTrue(self.service.is_served(self.students[1].pk, self.meal.pk))
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_checkins', checkins=5, repeat=1, stdout=out)
+        self.assertIn('Speed-up', out.getvalue())
+        self.assertIn('0.00 queries/check-in', out.getvalue())
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.student = Student.objects.create(student_id='A1', name='Async', grade='6')
+        self.meal = make_meal()
+        MealConsumption.objects.create(student=self.student, meal=self.meal, portion_consumed=0.5, waste_weight=4)
+
+    async def test_meal_detail(self):
+        response = await self.async_client.get(reverse('meal-detail', args=[self.meal.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['meal'], self.meal)
+        self.assertEqual(response.context['total_consumptions'], 1)
+        self.assertEqual(response.context['avg_portion'], 0.5)
+        self.assertEqual(len(response.context['consumptions']), 1)
+        missing = await self.async_client.get(reverse('meal-detail', args=[self.meal.pk + 100]))
+        self.assertEqual(missing.status_code, 404)
+
+    async def test_nutrition_report(self):
+        response = await self.async_client.get(reverse('nutrition-report'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['avg_calories'], 285)
+        self.assertEqual(response.context['meal_type_analysis'][0]['total_meals'], 1)
+
+
+class ParallelQueryTests(TransactionTestCase):
+    def test_independent_queries_run_on_the_pool(self):
+        make_meal()
+        make_meal(name='Soup', meal_type='snack')
+        executed = []
+
+        def record(execute, sql, params, many, context):
+            executed.append(threading.current_thread().name)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            count, names = parallel.gather(
+                lambda: Meal.objects.count(),
+                lambda: sorted(Meal.objects.values_list('name', flat=True)),
+            )
+        self.assertEqual((count, names), (2, ['Pasta', 'Soup']))
+        # The caller's hooks (request metrics, benchmarks) see the workers' queries
+        self.assertEqual(len(executed), 2)
+        self.assertTrue(all(name.startswith('meals-query') for name in executed))
+
+        summary = reports.nutrition_summary()
+        self.assertEqual([row['meal_type'] for row in summary['meal_type_analysis']], ['lunch', 'snack'])
+
+    def test_workers_drop_old_connections_around_each_call(self):
+        threads = []
+        with mock.patch.object(parallel, 'close_old_connections',
+                               side_effect=lambda: threads.append(threading.current_thread().name)):
+            self.assertEqual(parallel.gather(lambda: Meal.objects.count(), lambda: 2), [0, 2])
+        self.assertEqual(len(threads), 4)
+        self.assertTrue(all(name.startswith('meals-query') for name in threads))
+
+    @override_settings(PROFILE_DIR=Path(tempfile.gettempdir()) / 'meals-test-profiles')
+    def test_profiles_include_the_queries_run_on_the_pool(self):
+        self.addCleanup(shutil.rmtree, settings.PROFILE_DIR, ignore_errors=True)
+        meal = make_meal()
+        self.client.force_login(User.objects.create_user('staff', password='pw', is_staff=True))
+        for url in (reverse('meal-detail', args=[meal.pk]), reverse('nutrition-report')):
+            response = self.client.get(url, {'profile': '1'})
+            stats = pstats.Stats(str(settings.PROFILE_DIR / f'{response["X-Profile-Id"]}.prof'))
+            self.assertTrue(any(filename.endswith(os.path.join('sqlite3', 'base.py')) and name == 'execute'
+                                for filename, _, name in stats.stats), url)
+
+    def test_callers_in_a_transaction_run_inline(self):
+        with transaction.atomic():
+            make_meal()
+            threads = parallel.gather(lambda: threading.current_thread(), lambda: Meal.objects.count())
+        self.assertEqual(threads, [threading.current_thread(), 1])
+
+
+class ReportJobTests(TestCase):
+    def setUp(self):
+        self.alice = Student.objects.create(student_id='J1', name='Alice', grade='4')
+        self.bob = Student.objects.create(student_id='J2', name='Bob', grade='4')
+        self.lunch = make_meal(calories=285)
+        monday = datetime(2025, 4, 14, 12, tzinfo=dt_timezone.utc)
+        MealConsumption.objects.create(student=self.alice, meal=self.lunch, consumed_at=monday, portion_consumed=1.0)
+        MealConsumption.objects.create(student=self.bob, meal=self.lunch, consumed_at=monday, portion_consumed=0.5)
+        self.period = {'date_from': '2025-04-14', 'date_to': '2025-04-20'}
+        cache.clear()
+        # The worker's heartbeat would make the report pages of later tests queue jobs
+        self.addCleanup(cache.delete, jobs.WORKER_HEARTBEAT_KEY)
+
+    def enqueue(self, name, params=None):
+        return self.client.post(reverse('report-job-create', args=[name]), params or {})
+
+    def work(self):
+        call_command('run_report_worker', processes=0, once=True, stdout=io.StringIO())
+
+    def test_job_is_queued_computed_and_reused_until_the_data_changes(self):
+        response = self.enqueue('intake', self.period)
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job['status'], job['position']), ('queued', 0))
+        self.assertEqual(response['Location'], job['url'])
+
+        self.work()
+        done = self.client.get(job['url']).json()
+        self.assertEqual(done['status'], 'done')
+        self.assertFalse(done['outdated'])
+        self.assertEqual([row['name'] for row in done['result']['lowest_intake']], ['Bob', 'Alice'])
+        self.assertEqual(done['result']['school_average']['calories'], 213.75)
+
+        # Same report and parameters: the stored result is handed back without queueing anything
+        again = self.enqueue('intake', self.period)
+        self.assertEqual((again.status_code, again.json()['id']), (200, job['id']))
+
+        MealConsumption.objects.create(student=self.bob, meal=make_meal(name='Soup'), portion_consumed=1.0)
+        self.assertTrue(self.client.get(job['url']).json()['outdated'])
+        fresh = self.enqueue('intake', self.period)
+        self.assertEqual(fresh.status_code, 202)
+        self.assertNotEqual(fresh.json()['id'], job['id'])
+
+    def test_intake_jobs_store_the_default_period(self):
+        with mock.patch.object(timezone, 'localdate', return_value=date(2025, 4, 20)):
+            job = self.enqueue('intake').json()
+        self.assertEqual(job['params'], {'date_from': '2025-03-24', 'date_to': '2025-04-20'})
+        self.assertEqual(self.enqueue('waste', {'grade': '4'}).json()['params'], {'grade': '4'})
+
+    def test_invalid_and_failing_jobs(self):
+        self.assertEqual(self.enqueue('waste', {'date_from': 'soon'}).status_code, 400)
+        self.assertEqual(self.enqueue('payroll').status_code, 404)
+        self.assertEqual(self.client.get(reverse('report-job-create', args=['waste'])).status_code, 405)
+
+        job = self.enqueue('nutrition').json()
+        with mock.patch.dict(reports.REPORTS, nutrition=(mock.Mock(side_effect=ZeroDivisionError), [])):
+            self.work()
+        failed = self.client.get(job['url']).json()
+        self.assertEqual((failed['status'], failed['error']), ('failed', 'ZeroDivisionError'))
+        # A failed job is not reused
+        self.assertNotEqual(self.enqueue('nutrition').json()['id'], job['id'])
+
+    def test_stale_running_jobs_are_requeued_and_old_jobs_pruned(self):
+        hour_ago = timezone.now() - timedelta(hours=1)
+        stale = ReportJob.objects.create(name='nutrition', params_key='a', version='[]',
+                                         status=ReportJob.RUNNING, started_at=hour_ago)
+        old = ReportJob.objects.create(name='nutrition', params_key='b', version='[]', status=ReportJob.DONE,
+                                       finished_at=timezone.now() - timedelta(days=30))
+        with override_settings(MEALS_REPORT_JOB_TIMEOUT=60):
+            self.work()
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ReportJob.DONE)
+        self.assertFalse(ReportJob.objects.filter(pk=old.pk).exists())
+        self.assertIsNone(jobs.claim_next())
+
+    def test_report_pages_queue_jobs_while_a_worker_runs(self):
+        # Without a worker the page is computed in the request
+        response = self.client.get(reverse('intake-report'), self.period)
+        self.assertEqual([row['name'] for row in response.context['rows']], ['Bob', 'Alice'])
+        self.assertFalse(ReportJob.objects.exists())
+
+        jobs.heartbeat()
+        response = self.client.get(reverse('intake-report'), self.period)
+        self.assertContains(response, 'being computed', status_code=202)
+        self.assertContains(self.client.get(reverse('nutrition-report')), 'being computed', status_code=202)
+        self.assertEqual(ReportJob.objects.filter(status=ReportJob.QUEUED).count(), 2)
+        self.work()
+        response = self.client.get(reverse('intake-report'), self.period)
+        self.assertEqual([row['name'] for row in response.context['rows']], ['Bob', 'Alice'])
+        self.assertIsNone(response.context['updating'])
+        self.assertEqual(self.client.get(reverse('nutrition-report')).context['avg_calories'], 285)
+
+        # Until the job for the changed data is done, the earlier result is shown
+        MealConsumption.objects.create(student=self.alice, meal=self.lunch, portion_consumed=1.0)
+        response = self.client.get(reverse('intake-report'), self.period)
+        self.assertContains(response, 'being brought up to date')
+        self.work()
+        self.assertIsNone(self.client.get(reverse('intake-report'), self.period).context['updating'])
+
+
+class ShardingTests(TestCase):
+    # Resolved when the class is set up, so it includes the school databases added below
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # In-memory school databases, migrated like a real shard and kept open like the test 'default'
+        for alias in ('school_north', 'school_south'):
+            name = f'file:memorydb_{alias}?mode=memory&cache=shared'
+            connections.settings[alias] = {**connections.settings['default'], 'NAME': name}
+            call_command('migrate', 'meals', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in ('school_north', 'school_south'):
+            connections[alias].connection.close()
+            del connections[alias]
+            del connections.settings[alias]
+
+    def setUp(self):
+        cache.clear()
+        # Rolling the schools back skips the signal that forgets them
+        self.addCleanup(sharding.forget_schools)
+        self.addCleanup(cache.delete, jobs.WORKER_HEARTBEAT_KEY)
+        self.north = School.objects.create(code='north', name='North Elementary')
+        self.south = School.objects.create(code='south', name='South Middle')
+        with sharding.use_database('school_north'):
+            pupil = Student.objects.create(student_id='N1', name='Nia', grade='3')
+            # 285 kcal
+            self.north_lunch = make_meal()
+            MealConsumption.objects.create(student=pupil, meal=self.north_lunch, portion_consumed=1, waste_weight=10)
+        with sharding.use_database('school_south'):
+            pupils = [Student.objects.create(student_id=f'S{i}', name=f'Sam {i}', grade='7') for i in range(2)]
+            fruit = make_meal(name='Fruit', meal_type='snack', protein=0, carbohydrates=25, fats=0)
+            stew = make_meal(name='Stew', protein=50, carbohydrates=25, fats=10)
+            for pupil, meal, waste in [(pupils[0], fruit, 40), (pupils[1], fruit, 20), (pupils[1], stew, None)]:
+                MealConsumption.objects.create(student=pupil, meal=meal, portion_consumed=0.5, waste_weight=waste)
+
+    def test_each_school_is_kept_in_its_own_database(self):
+        self.assertEqual(Student.objects.using('school_north').count(), 1)
+        self.assertEqual(Student.objects.using('school_south').count(), 2)
+        self.assertFalse(Student.objects.using('default').exists())
+        # Counters and data versions follow the rows they count
+        with sharding.use_database('school_south'):
+            self.assertEqual(counters.get_counts()[counters.CONSUMPTIONS], 3)
+        # The directory tables exist only in the default database
+        self.assertNotIn('meals_school', connections['school_north'].introspection.table_names())
+        self.assertEqual(sharding.current_database(), 'default')
+
+    def test_district_reports_merge_every_school(self):
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual((response.context['total_students'], response.context['total_consumptions']), (3, 4))
+        self.assertEqual(response.context['total_waste'], 70)
+
+        nutrition = self.client.get(reverse('nutrition-report')).context
+        # (285 + 100 + 390) / 3 meals, not the mean of the two school averages
+        self.assertEqual(nutrition['avg_calories'], 258.3)
+        lunch = nutrition['meal_type_analysis'][0]
+        self.assertEqual((lunch['meal_type'], lunch['total_meals'], lunch['avg_calories']), ('lunch', 2, 337.5))
+        self.assertEqual({meal['school'] for meal in nutrition['meals']}, {'north', 'south'})
+
+        waste = self.client.get(reverse('waste-report'))
+        self.assertEqual((waste.context['total_waste'], waste.context['total_servings']), (70, 4))
+        self.assertEqual([(item['meal_name'], item['school']) for item in waste.context['meals_with_waste']],
+                         [('Fruit', 'south'), ('Pasta', 'north'), ('Stew', 'south')])
+        self.assertContains(waste, f'/meals/meals/{self.north_lunch.pk}/?school=north')
+
+    def test_selected_school_is_served_alone(self):
+        response = self.client.get(reverse('dashboard'), {'school': 'north'})
+        self.assertEqual(response.context['total_students'], 1)
+        # Remembered in the session, until cleared
+        response = self.client.get(reverse('waste-report'))
+        self.assertEqual(response.context['total_servings'], 1)
+        self.assertEqual(self.client.get(reverse('dashboard'), {'school': ''}).context['total_students'], 3)
+        # An unknown code is refused without being remembered
+        self.client.get(reverse('dashboard'), {'school': 'north'})
+        self.assertEqual(self.client.get(reverse('dashboard'), {'school': 'nowhere'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('dashboard')).context['total_students'], 1)
+
+        response = self.client.get(reverse('api-students'), headers={'X-School': 'south'})
+        self.assertEqual([row['student_id'] for row in response.json()['results']], ['S0', 'S1'])
+        self.assertEqual(self.client.get(reverse('api-students'), headers={'X-School': 'west'}).status_code, 404)
+
+    def test_report_jobs_run_in_the_school_they_were_queued_for(self):
+        job = self.client.post(reverse('report-job-create', args=['nutrition']), headers={'X-School': 'south'}).json()
+        self.assertEqual(ReportJob.objects.get().database, 'school_south')
+        call_command('run_report_worker', processes=0, once=True, stdout=io.StringIO())
+        self.assertEqual(self.client.get(job['url']).json()['result']['avg_calories'], 245.0)
+
+    def test_district_jobs_and_api_merge_every_school(self):
+        job = self.client.post(reverse('report-job-create', args=['nutrition'])).json()
+        self.assertEqual(ReportJob.objects.get().database, 'default')
+        call_command('run_report_worker', processes=0, once=True, stdout=io.StringIO())
+        state = self.client.get(job['url']).json()
+        self.assertEqual((state['result']['avg_calories'], state['outdated']), (258.3, False))
+        job = self.client.post(reverse('report-job-create', args=['intake'])).json()
+        call_command('run_report_worker', processes=0, once=True, stdout=io.StringIO())
+        result = self.client.get(job['url']).json()['result']
+        self.assertEqual((result['student_count'], result['student_days']), (3, 3))
+        self.assertEqual([row['school'] for row in result['lowest_intake']], ['south', 'south', 'north'])
+
+        waste = self.client.get(reverse('api-report-waste'))
+        self.assertEqual(waste.json()['total_waste'], 70)
+        with sharding.use_database('school_south'):
+            make_meal(name='Soup')
+        # A change in any school outdates the district job and the district ETag
+        self.assertTrue(self.client.get(job['url']).json()['outdated'])
+        self.assertEqual(self.client.get(reverse('api-report-waste'), headers={'If-None-Match': waste['ETag']})
+                         .status_code, 200)
+
+    def test_district_lists_merge_every_schools_rows(self):
+        def walk(name, **params):
+            rows = []
+            url, params = reverse(name), {'limit': 1, **params}
+            while url:
+                body = self.client.get(url, params).json()
+                rows += body['results']
+                url, params = body['next'], {}
+            return rows
+
+        # Student ids repeat across schools, so the cursor carries the school too
+        self.assertEqual([(row['school'], row['id'], row['student_id']) for row in walk('api-students')],
+                         [('north', 1, 'N1'), ('south', 1, 'S0'), ('south', 2, 'S1')])
+        consumptions = walk('api-consumptions', fields='student_id,consumed_at')
+        self.assertEqual(len(consumptions), 4)
+        self.assertEqual(consumptions, sorted(consumptions, key=lambda row: row['consumed_at'], reverse=True))
+        self.assertEqual(self.client.get(reverse('api-students'), {'after': 'junk'}).status_code, 400)
+
+    def test_school_pages_and_writes_need_a_school_in_the_district_view(self):
+        # Pages that list or change one school's rows send browsers to the picker, and come back after it
+        url = reverse('student-list') + '?grade=3'
+        response = self.client.get(url, headers={'Accept': 'text/html'})
+        self.assertRedirects(response, f"{reverse('school-select')}?{urlencode({'next': url})}")
+        choices = [link for _, link in self.client.get(response['Location']).context['choices']]
+        self.assertEqual(choices, [f"{reverse('student-list')}?grade=3&school={code}" for code in ('north', 'south')])
+
+        student = {'student_id': 'D1', 'name': 'Dee', 'grade': '4', 'dietary_restrictions': ''}
+        record = {'student_id': 'N1', 'meal_id': self.north_lunch.pk, 'portion_consumed': 1}
+        for response in [
+            self.client.post(reverse('student-create'), student),
+            self.client.post(reverse('consumption-batch'), json.dumps([record]), content_type='application/json'),
+            self.client.post(reverse('sync-push'), json.dumps({'records': []}), content_type='application/json'),
+            self.client.get(reverse('meal-autocomplete'), {'q': 'Pa'}),
+        ]:
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['schools'], ['north', 'south'])
+        self.assertFalse(Student.objects.using('default').exists())
+        self.assertFalse(MealConsumption.objects.using('default').exists())
+        # The district dashboard and reports are still served
+        self.assertEqual(self.client.get(reverse('waste-report')).status_code, 200)
+
+    def test_selected_school_pages_and_writes_use_its_database(self):
+        response = self.client.get(reverse('student-list'), {'school': 'north'})
+        self.assertEqual([student.student_id for student in response.context['students']], ['N1'])
+        student = {'student_id': 'N2', 'name': 'Ned', 'grade': '3', 'dietary_restrictions': ''}
+        self.assertEqual(self.client.post(reverse('student-create'), student).status_code, 302)
+        self.assertTrue(Student.objects.using('school_north').filter(student_id='N2').exists())
+        self.assertFalse(Student.objects.using('default').exists())
+        response = self.client.get(reverse('meal-list'), headers={'X-School': 'south'})
+        self.assertEqual(sorted(meal.name for meal in response.context['meal_list']), ['Fruit', 'Stew'])
+
+    def test_flush_drains_every_schools_write_behind_log(self):
+        log_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        with self.settings(MEALS_WRITE_BEHIND_DIR=log_dir), \
+                mock.patch.object(writebehind.WriteBehindQueue, 'start'):
+            for database in ('school_north', 'school_south'):
+                with sharding.use_database(database):
+                    queue = writebehind.WriteBehindQueue(writebehind.get_log_dir(), database=database)
+                    queue.enqueue([MealConsumption(student=Student.objects.first(), meal=Meal.objects.first(),
+                                                   portion_consumed=1)])
+            out = io.StringIO()
+            call_command('flush_consumptions', stdout=out)
+        self.assertIn('Flushed 2 queued', out.getvalue())
+        self.assertEqual(MealConsumption.objects.using('school_north').count(), 2)
+        self.assertEqual(MealConsumption.objects.using('school_south').count(), 4)
+        self.assertFalse(MealConsumption.objects.using('default').exists())
+
+    def test_each_school_archives_its_own_consumptions(self):
+        archive_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        tomorrow = (timezone.localdate() + timedelta(days=1)).isoformat()
+        with self.settings(MEALS_ARCHIVE_DIR=archive_dir):
+            for database, archived in [('school_north', 1), ('school_south', 3)]:
+                out = io.StringIO()
+                with sharding.use_database(database):
+                    call_command('archive_term', '--before', tomorrow, '--name', 'term', stdout=out)
+                    self.assertIn(f'Wrote {archived} consumptions', out.getvalue())
+                    self.assertFalse(MealConsumption.objects.exists())
+                    self.assertEqual(archive.totals()[0], archived)
+            self.assertEqual(self.client.get(reverse('waste-report'), {'school': 'south'}).context['total_waste'], 60)
+            self.assertEqual(self.client.get(reverse('waste-report'), {'school': ''}).context['total_waste'], 70)
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        Student.objects.bulk_create([
+            Student(student_id=f'A{i:04d}', name=f'Pupil {i}', grade='6') for i in range(200)
+        ] + [Student(student_id='Z0001', name='Zara Khan', grade='6')])
+        self.today = make_meal(name='Rice Bowl', serving_date=timezone.localdate())
+        self.yesterday = make_meal(name='Rice Pudding', serving_date=timezone.localdate() - timedelta(days=1))
+
+    def test_form_page_does_not_load_the_tables(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('consumption-create'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('meals_student' in q['sql'] or 'meals_meal' in q['sql'] for q in queries.captured_queries))
+        self.assertNotIn('Pupil 1', response.content.decode())
+        self.assertContains(response, reverse('student-autocomplete'))
+
+    def test_endpoints_search_by_prefix_and_day(self):
+        results = self.client.get(reverse('student-autocomplete'), {'q': 'zar'}).json()['results']
+        self.assertEqual(results, [{'id': Student.objects.get(student_id='Z0001').pk, 'text': 'Zara Khan (Z0001)'}])
+        self.assertEqual(len(self.client.get(reverse('student-autocomplete'), {'q': 'pupil'}).json()['results']), 20)
+        self.assertEqual(self.client.get(reverse('student-autocomplete')).json()['results'], [])
+
+        url = reverse('meal-autocomplete')
+        self.assertEqual([r['id'] for r in self.client.get(url, {'q': 'rice'}).json()['results']], [self.today.pk])
+        yesterday = self.client.get(url, {'date': self.yesterday.serving_date.isoformat()}).json()['results']
+        self.assertEqual([r['id'] for r in yesterday], [self.yesterday.pk])
+        self.assertEqual(self.client.get(url, {'date': '2025-13-40'}).status_code, 400)
+
+    def test_submitted_ids_are_validated_and_redisplayed(self):
+        student = Student.objects.get(student_id='Z0001')
+        response = self.client.post(reverse('consumption-create'), {
+            'student': student.pk, 'meal': 999999, 'portion_consumed': 0.5,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('meal', response.context['form'].errors)
+        self.assertContains(response, 'value="Zara Khan (Z0001)"')
+
+        response = self.client.post(reverse('consumption-create'), {
+            'student': student.pk, 'meal': self.today.pk, 'portion_consumed': 0.5,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(MealConsumption.objects.filter(student=student, meal=self.today).exists())
+
+
+class IntakeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = Student.objects.create(student_id='I1', name='Alice', grade='4')
+        self.bob = Student.objects.create(student_id='I2', name='Bob', grade='5')
+        # 10*4 + 50*4 + 5*9 = 285 kcal
+        self.lunch = make_meal(protein=10, carbohydrates=50, fats=5, calories=285)
+        self.snack = make_meal(name='Fruit', meal_type='snack', protein=0, carbohydrates=25, fats=0, calories=100)
+        self.monday = datetime(2025, 4, 14, 12, tzinfo=dt_timezone.utc)
+        for student, meal, at, portion in [
+            (self.alice, self.lunch, self.monday, 1.0),
+            (self.alice, self.snack, self.monday + timedelta(hours=3), 0.5),
+            (self.alice, self.lunch, self.monday + timedelta(days=7), 0.5),
+            (self.bob, self.lunch, self.monday + timedelta(days=1), 0.25),
+        ]:
+            MealConsumption.objects.create(student=student, meal=meal, consumed_at=at, portion_consumed=portion)
+
+    def test_daily_weekly_and_summary_intake(self):
+        result = intake.compute_intake(date(2025, 4, 14), date(2025, 4, 27))
+        self.assertEqual(result.daily_rows(self.alice.pk), [
+            (date(2025, 4, 14), {'calories': 335.0, 'protein': 10.0, 'carbohydrates': 62.5, 'fats': 5.0}),
+            (date(2025, 4, 21), {'calories': 142.5, 'protein': 5.0, 'carbohydrates': 25.0, 'fats': 2.5}),
+        ])
+        self.assertEqual(result.matrix(self.bob.pk, 3)[:, 0].tolist(), [0.0, 71.25, 0.0])
+        # Rows are converted to arrays a chunk at a time
+        chunked = intake.compute_intake(date(2025, 4, 14), date(2025, 4, 27), chunk_size=1)
+        self.assertEqual(chunked.daily.tolist(), result.daily.tolist())
+
+        students, week_starts, totals = result.weekly()
+        self.assertEqual(students.tolist(), [0, 0, 1])
+        self.assertEqual(week_starts, [date(2025, 4, 14), date(2025, 4, 21), date(2025, 4, 14)])
+        self.assertEqual(totals[:, 0].tolist(), [335.0, 142.5, 71.25])
+
+        days_eaten, day_totals, averages = result.summary()
+        self.assertEqual(days_eaten.tolist(), [2, 1])
+        self.assertEqual(day_totals[:, 0].tolist(), [477.5, 71.25])
+        self.assertEqual(averages[:, 0].tolist(), [238.75, 71.25])
+        self.assertEqual(intake.compute_intake(date(2025, 4, 14), date(2025, 4, 20), grade='5').daily_rows(
+            self.alice.pk), [])
+
+    def test_intake_report_and_student_section(self):
+        response = self.client.get(reverse('intake-report'), {'date_from': '2025-04-14', 'date_to': '2025-04-27'})
+        self.assertEqual([row['id'] for row in response.context['rows']], [self.bob.pk, self.alice.pk])
+        self.assertEqual(response.context['student_days'], 3)
+
+        with mock.patch.object(timezone, 'localdate', return_value=date(2025, 4, 22)):
+            response = self.client.get(reverse('student-detail', args=[self.alice.pk]))
+        self.assertEqual(len(response.context['intake_days']), 2)
+        self.assertEqual(response.context['intake_weeks'][1][1]['calories'], 142.5)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        archive_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        overrides = self.settings(MEALS_ARCHIVE_DIR=archive_dir)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.fourth = Student.objects.create(student_id='A1', name='Fourth', grade='4')
+        self.fifth = Student.objects.create(student_id='A2', name='Fifth', grade='5')
+        self.old_meal = make_meal(name='Old Stew', serving_date=date(2024, 9, 2))
+        self.new_meal = make_meal(name='New Soup', meal_type='snack', serving_date=date(2025, 4, 14))
+        for student, meal, at, waste in [
+            (self.fourth, self.old_meal, datetime(2024, 9, 2, 12, tzinfo=dt_timezone.utc), 30),
+            (self.fifth, self.old_meal, datetime(2024, 9, 2, 12, 5, tzinfo=dt_timezone.utc), None),
+            (self.fourth, self.new_meal, datetime(2025, 4, 14, 12, tzinfo=dt_timezone.utc), 10),
+        ]:
+            MealConsumption.objects.create(student=student, meal=meal, consumed_at=at, portion_consumed=0.5,
+                                           waste_weight=waste)
+
+    def reports(self):
+        waste = self.client.get(reverse('waste-report'), {'grade': '4'}).context
+        overall = self.client.get(reverse('waste-report')).context
+        result = intake.compute_intake(date(2024, 9, 1), date(2025, 4, 30), grade='4')
+        rollup_rows = list(MealDailyRollup.objects.order_by('meal', 'day').values(
+            'meal', 'day', 'consumption_count', 'waste_count', 'waste_sum', 'waste_min', 'waste_max'))
+        return (waste['total_waste'], waste['meals_with_waste'], overall['total_servings'],
+                result.daily_rows(self.fourth.pk), rollup_rows)
+
+    def test_archived_consumptions_are_still_reported(self):
+        before = self.reports()
+        out = io.StringIO()
+        call_command('archive_term', '--before', '2025-01-01', stdout=out)
+        self.assertIn('Wrote 2 consumptions', out.getvalue())
+        self.assertEqual(MealConsumption.objects.count(), 1)
+        segment, = archive.segments()
+        self.assertEqual(segment.column('waste_weight').tolist()[0], 30)
+        self.assertIsInstance(segment.column('id'), np.memmap)
+
+        self.assertEqual(self.reports(), before)
+        self.assertEqual(counters.recount(), {})
+        rollups.rebuild()
+        self.assertEqual(self.reports(), before)
+
+    def test_exports_include_archived_consumptions(self):
+        def export(name, **params):
+            response = self.client.get(reverse(name), params)
+            return b''.join(response.streaming_content).decode()
+
+        before = [export(name, **params) for name in ('export-consumptions', 'export-waste')
+                  for params in ({}, {'date_from': '2024-09-02', 'date_to': '2024-09-02'}, {'meal_type': 'snack'})]
+        call_command('archive_term', '--before', '2025-01-01', stdout=io.StringIO())
+        after = [export(name, **params) for name in ('export-consumptions', 'export-waste')
+                 for params in ({}, {'date_from': '2024-09-02', 'date_to': '2024-09-02'}, {'meal_type': 'snack'})]
+        self.assertEqual(after, before)
+        self.assertEqual(len(after[0].splitlines()), 4)
+        self.assertIn('Old Stew,lunch,2024-09-02,2,30.0,30.0', after[3])
+
+    def test_rerun_finishes_deleting_and_empty_archives_are_skipped(self):
+        call_command('archive_term', '--before', '2025-01-01', stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('archive_term', '--before', '2025-01-01', stdout=out)
+        self.assertIn('Deleted 0 archived', out.getvalue())
+        out = io.StringIO()
+        call_command('archive_term', '--before', '2024-01-01', stdout=out)
+        self.assertIn('nothing archived', out.getvalue())
+        self.assertEqual(len(archive.read_index()), 1)
+
+    def test_recomputed_bucket_keeps_archived_rows(self):
+        # Archive the first of the two 2 September rows, so their bucket spans the cutoff
+        archive.archive_before(datetime(2024, 9, 2, 12, 3, tzinfo=dt_timezone.utc), 'midday')
+        archive.delete_archived('midday')
+        bucket = MealDailyRollup.objects.filter(meal=self.old_meal)
+
+        live = MealConsumption.objects.get(meal=self.old_meal)
+        live.waste_weight = 50
+        live.save()
+        self.assertEqual(list(bucket.values_list('consumption_count', 'waste_count', 'waste_sum', 'waste_min',
+                                                 'waste_max')), [(2, 2, 80.0, 30.0, 50.0)])
+        # Removing the maximum recomputes the bucket too
+        live.delete()
+        self.assertEqual(list(bucket.values_list('consumption_count', 'waste_count', 'waste_sum', 'waste_min',
+                                                 'waste_max')), [(1, 1, 30.0, 30.0, 30.0)])
+
+
+class WasteReportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('waste-report')
+        self.fifth = [Student.objects.create(student_id=f'F{i}', name=f'Fifth {i}', grade='5') for i in range(3)]
+        self.sixth = [Student.objects.create(student_id=f'X{i}', name=f'Sixth {i}', grade='6') for i in range(3)]
+
+    def seed(self, meals):
+        for meal_index in range(meals):
+            meal = make_meal(name=f'Meal {meal_index}', meal_type='lunch' if meal_index % 2 else 'snack')
+            for student in self.fifth + self.sixth:
+                MealConsumption.objects.create(
+                    student=student, meal=meal, portion_consumed=0.5, waste_weight=10 if student.grade == '5' else 30,
+                )
+
+    def test_query_count_is_constant(self):
+        self.seed(1)
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+        self.seed(8)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'grade': '5'})
+        self.assertEqual(len(response.context['meals_with_waste']), 9)
+        # Served from the cache: only the data version and the records page are queried
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'grade': '5'})
+
+    def test_cached_summary_is_invalidated_by_writes(self):
+        self.seed(1)
+        self.assertEqual(self.client.get(self.url).context['total_servings'], 6)
+        self.seed(1)
+        self.assertEqual(self.client.get(self.url).context['total_servings'], 12)
+        self.fifth[0].grade = '6'
+        self.fifth[0].save()
+        self.assertEqual(self.client.get(self.url, {'grade': '6'}).context['total_servings'], 8)
+
+    def test_stale_summary_is_served_while_refreshing(self):
+        self.seed(1)
+        call_command('warm_report_cache', stdout=io.StringIO())
+        self.seed(1)
+        with self.settings(REPORT_CACHE_MAX_STALE=60), mock.patch.object(reports, 'schedule_refresh') as refresh:
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['total_servings'], 6)
+        refresh.assert_called_once_with('waste', mock.ANY)
+        reports.refresh(*refresh.call_args.args)
+        self.assertEqual(self.client.get(self.url).context['total_servings'], 12)
+
+    def test_grace_period_starts_when_the_entry_goes_stale(self):
+        self.seed(1)
+        call_command('warm_report_cache', stdout=io.StringIO())
+        key = reports.cache_key('waste', {})
+        entry = cache.get(key)
+        # Computed long before the data changed
+        entry['computed_at'] -= 3600
+        cache.set(key, entry)
+        self.seed(1)
+        with self.settings(REPORT_CACHE_MAX_STALE=60), mock.patch.object(reports, 'schedule_refresh') as refresh:
+            self.assertEqual(self.client.get(self.url).context['total_servings'], 6)
+            refresh.assert_called_once()
+
+            entry = cache.get(key)
+            entry['stale_since'] -= 120
+            cache.set(key, entry)
+            self.assertEqual(self.client.get(self.url).context['total_servings'], 12)
+            refresh.assert_called_once()
+
+    def test_filters_apply_to_totals_and_detail_rows(self):
+        self.seed(2)
+        response = self.client.get(self.url, {'grade': '6', 'meal_type': 'lunch'})
+        self.assertEqual(response.context['total_waste'], 90)
+        self.assertEqual(response.context['total_servings'], 3)
+        self.assertEqual({c.student.grade for c in response.context['consumptions']}, {'6'})
+
+        response = self.client.get(self.url, {'meal_type': 'snack'})
+        self.assertEqual(response.context['total_waste'], 120)
+        self.assertEqual(response.context['meals_with_waste'][0]['avg_waste'], 20)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.student = Student.objects.create(student_id='K1', name='Keyset', grade='3')
+        start = datetime(2025, 4, 14, 12, tzinfo=dt_timezone.utc)
+        self.meals = [make_meal(name=f'Meal {i}') for i in range(7)]
+        # Two rows share a timestamp so the id tie-breaker is exercised
+        times = [start + timedelta(minutes=i) for i in range(6)] + [start + timedelta(minutes=5)]
+        self.consumptions = [
+            MealConsumption.objects.create(student=self.student, meal=meal, consumed_at=when, portion_consumed=1)
+            for meal, when in zip(self.meals, times)
+        ]
+        self.newest_first = sorted(self.consumptions, key=lambda c: (c.consumed_at, c.id), reverse=True)
+
+    def test_walks_forward_and_back(self):
+        paginator = KeysetPaginator(MealConsumption.objects.all(), per_page=3)
+        seen = []
+        page = paginator.get_page()
+        self.assertFalse(page.has_previous)
+        pages = [page]
+        while True:
+            seen.extend(page.object_list)
+            if not page.has_next:
+                break
+            page = paginator.get_page(after=page.next_cursor)
+            pages.append(page)
+        self.assertEqual(seen, self.newest_first)
+
+        back = paginator.get_page(before=pages[-1].previous_cursor)
+        self.assertEqual(back.object_list, pages[-2].object_list)
+        back = paginator.get_page(before=back.previous_cursor)
+        self.assertEqual(back.object_list, pages[0].object_list)
+        self.assertFalse(back.has_previous)
+
+    def test_bad_cursor_falls_back_to_first_page(self):
+        page = KeysetPaginator(MealConsumption.objects.all(), per_page=3).get_page(after='garbage')
+        self.assertEqual(page.object_list, self.newest_first[:3])
+
+    def test_history_views_page_with_cursors(self):
+        url = reverse('student-detail', args=[self.student.id])
+        first = self.client.get(url)
+        self.assertEqual(len(first.context['consumptions']), 7)
+
+        response = self.client.get(reverse('consumption-list'))
+        self.assertEqual(list(response.context['consumptions']), self.newest_first)
+        cursor = KeysetPaginator(MealConsumption.objects.all(), per_page=2).get_page().next_cursor
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('consumption-list'), {'after': cursor})
+        self.assertEqual(list(response.context['consumptions']), self.newest_first[2:])
+
+
+class QueryPlanTests(TestCase):
+    """Every SELECT issued by the hot views must be answered through an index."""
+
+    FULL_SCAN = re.compile(r'^SCAN (meals_\w+)$')
+
+    def setUp(self):
+        self.student = Student.objects.create(student_id='Q1', name='Planner', grade='5')
+        self.meal = make_meal()
+        MealConsumption.objects.create(student=self.student, meal=self.meal, portion_consumed=1, waste_weight=3)
+
+    def assert_indexed(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, params or {})
+        for query in queries.captured_queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plan = [row[3] for row in cursor.fetchall()]
+            scans = [step for step in plan if self.FULL_SCAN.match(step)]
+            self.assertFalse(scans, f'{url} {params} does a full table scan:\n{query["sql"]}\n' + '\n'.join(plan))
+
+    def test_meal_list(self):
+        self.assert_indexed(reverse('meal-list'))
+        self.assert_indexed(reverse('meal-list'), {'meal_type': 'lunch', 'date_from': '2025-01-01'})
+
+    def test_consumption_history(self):
+        cursor = KeysetPaginator(MealConsumption.objects.all(), per_page=1).get_page().object_list[0]
+        self.assert_indexed(reverse('consumption-list'))
+        self.assert_indexed(reverse('consumption-list'), {
+            'after': pagination.encode_cursor(cursor.consumed_at, cursor.pk),
+        })
+        self.assert_indexed(reverse('student-detail', args=[self.student.id]))
+        self.assert_indexed(reverse('meal-detail', args=[self.meal.id]))
+
+    def test_waste_report(self):
+        self.assert_indexed(reverse('waste-report'), {'date_from': '2025-01-01'})
+        self.assert_indexed(reverse('waste-report'), {'grade': '5'})
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_generate_then_benchmark(self):
+        call_command('generate_fake_lunch_data', students=20, meals=6, consumptions=200, days=3,
+                     chunk_size=50, stdout=io.StringIO())
+        self.assertEqual(MealConsumption.objects.count(), 200)
+        self.assertEqual(sum(MealDailyRollup.objects.values_list('consumption_count', flat=True)), 200)
+
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        output = directory / 'baseline.json'
+        call_command('benchmark_views', repeat=1, output=str(output),
+                     only=['dashboard', 'waste-report', 'meal-detail'], stdout=io.StringIO())
+        results = json.loads(output.read_text())
+        self.assertEqual(sorted(results), ['dashboard', 'meal-detail', 'waste-report'])
+        self.assertEqual(results['waste-report']['status'], 200)
+        self.assertGreater(results['waste-report']['queries'], 0)
+
+        out = io.StringIO()
+        call_command('benchmark_views', repeat=1, baseline=str(output), only=['dashboard'], asgi=True, stdout=out)
+        self.assertIn('dashboard', out.getvalue())
+        self.assertIn('| asgi', out.getvalue())
+
+    def test_clear_regenerates_the_same_dataset_without_tombstones(self):
+        def generate(**options):
+            call_command('generate_fake_lunch_data', students=20, meals=6, consumptions=200, days=3, seed=7,
+                         stdout=io.StringIO(), **options)
+            return list(MealConsumption.objects.order_by('consumed_at', 'student__student_id').values_list(
+                'student__student_id', 'meal__name', 'consumed_at', 'portion_consumed', 'waste_weight'))
+
+        first = generate()
+        self.assertEqual(Meal.objects.order_by('serving_date').first().serving_date, date(2025, 1, 6))
+        with mock.patch.object(timezone, 'localdate', return_value=date(2031, 1, 1)):
+            self.assertEqual(generate(clear=True), first)
+        self.assertFalse(Tombstone.objects.exists())
+        self.assertEqual(counters.get_counts()[counters.STUDENTS], 20)
+        self.assertEqual(generate(clear=True, start_date=date(2025, 9, 1))[0][2].date(), date(2025, 9, 1))
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+    def test_records_latency_queries_and_size_per_view(self):
+        make_meal()
+        self.client.get(reverse('meal-list'))
+        self.client.get(reverse('meal-list'))
+        stats = registry.snapshot()['meal-list']
+        self.assertEqual(stats['count'], 2)
+        # Each paginated list request runs a count and a page query
+        self.assertEqual(stats['query_count'], 4)
+        self.assertGreater(stats['response_bytes'], 0)
+        self.assertEqual(stats['statuses'], {'2xx': 2})
+
+    def test_prometheus_endpoint(self):
+        self.client.get(reverse('dashboard'))
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1')
+        body = response.content.decode()
+        self.assertIn('http_request_duration_seconds_count{view="dashboard"} 1', body)
+        self.assertIn('db_queries_total{view="dashboard"}', body)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.9').status_code, 403)
+
+    def test_slow_requests_are_logged_with_sql(self):
+        with self.settings(SLOW_REQUEST_THRESHOLD_MS=0), self.assertLogs('school_lunch_system.slow_requests') as logs:
+            self.client.get(reverse('student-list'))
+        self.assertIn('SELECT', logs.output[0])
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.profile_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.profile_dir, ignore_errors=True)
+        overrides = self.settings(PROFILE_DIR=self.profile_dir)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+
+    def test_staff_request_is_profiled_and_listed(self):
+        make_meal()
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('meal-list'), {'profile': '1'})
+        profile_id = response['X-Profile-Id']
+        self.assertTrue((self.profile_dir / f'{profile_id}.prof').exists())
+
+        response = self.client.get(reverse('meal-list'), HTTP_X_PROFILE='1')
+        self.assertIn('X-Profile-Id', response)
+
+        index = self.client.get(reverse('profile-index'))
+        self.assertEqual(len(index.context['profiles']), 2)
+        self.assertEqual(index.context['profiles'][0]['view'], 'meal-list')
+        detail = self.client.get(reverse('profile-detail', args=[profile_id]), {'sort': 'tottime'})
+        self.assertContains(detail, 'function calls')
+
+    def test_non_staff_requests_are_not_profiled(self):
+        self.client.get(reverse('meal-list'), {'profile': '1'})
+        self.client.force_login(User.objects.create_user('teacher', password='pw'))
+        response = self.client.get(reverse('meal-list'), {'profile': '1'})
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(list(self.profile_dir.iterdir()), [])
+        self.assertEqual(self.client.get(reverse('profile-index')).status_code, 302)
+
+    def test_old_profiles_are_pruned(self):
+        self.client.force_login(self.staff)
+        with self.settings(PROFILE_MAX_FILES=1):
+            self.client.get(reverse('dashboard'), {'profile': '1'})
+            self.client.get(reverse('dashboard'), {'profile': '1'})
+        self.assertEqual(len(list(self.profile_dir.glob('*.prof'))), 1)
@@ -1,9 +1,10 @@
 from django.urls import path
-from . import views
+from . import api, jobs, sync, views
 
 urlpatterns = [
     # Dashboard
     path('', views.dashboard, name='dashboard'),
+    path('schools/', views.school_select, name='school-select'),
     
     # Student URLs
     path('students/', views.StudentListView.as_view(), name='student-list'),
@@ -22,11 +23,32 @@ urlpatterns = [
     # Consumption URLs
     path('consumptions/', views.MealConsumptionListView.as_view(), name='consumption-list'),
     path('consumptions/create/', views.MealConsumptionCreateView.as_view(), name='consumption-create'),
+    path('consumptions/batch/', views.consumption_batch, name='consumption-batch'),
+    path('autocomplete/students/', views.student_autocomplete, name='student-autocomplete'),
+    path('autocomplete/meals/', views.meal_autocomplete, name='meal-autocomplete'),
     
 
     
     # Reports URLs
     path('reports/nutrition/', views.nutrition_report, name='nutrition-report'),
     path('reports/waste/', views.waste_report, name='waste-report'),
+    path('reports/intake/', views.intake_report, name='intake-report'),
+    path('reports/<str:name>/jobs/', jobs.create, name='report-job-create'),
+    path('reports/jobs/<int:pk>/', jobs.detail, name='report-job-detail'),
+
+    # Export URLs
+    path('exports/consumptions/', views.export_data, {'dataset': 'consumptions'}, name='export-consumptions'),
+    path('exports/waste/', views.export_data, {'dataset': 'waste'}, name='export-waste'),
+
+    # Read-only JSON API
+    path('api/v1/students/', api.resource_list, {'resource': 'students'}, name='api-students'),
+    path('api/v1/meals/', api.resource_list, {'resource': 'meals'}, name='api-meals'),
+    path('api/v1/consumptions/', api.resource_list, {'resource': 'consumptions'}, name='api-consumptions'),
+    path('api/v1/reports/nutrition/', api.report, {'name': 'nutrition'}, name='api-report-nutrition'),
+    path('api/v1/reports/waste/', api.report, {'name': 'waste'}, name='api-report-waste'),
+
+    # Offline kiosk sync
+    path('sync/pull/', sync.pull, name='sync-pull'),
+    path('sync/push/', sync.push, name='sync-push'),
 
 ]
\ No newline at end of file
@@ -1,39 +1,67 @@
+import json
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
-from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
-from django.urls import reverse_lazy
-from django.db.models import Avg, Sum, Count
+from django.core.paginator import Paginator
+from django.http import JsonResponse, QueryDict, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, View
+from django.urls import reverse, reverse_lazy
+from django.db.models import Sum
 from django.contrib import messages
 from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.http import url_has_allowed_host_and_scheme
+from urllib.parse import urlsplit, urlunsplit
 from datetime import timedelta
 
-from .models import Student, Meal, MealConsumption
-from .forms import StudentForm, MealForm, MealConsumptionForm, MealSearchForm, StudentSearchForm
+from .models import Student, Meal, MealConsumption, MealDailyRollup
+from .forms import (
+    StudentForm, MealForm, MealConsumptionForm, MealSearchForm, StudentSearchForm, ExportForm, WasteReportForm,
+    IntakeReportForm,
+)
+from . import counters, dietary, exports, intake, jobs, parallel, search, sharding
+from .batch import MAX_BATCH_RECORDS, bulk_insert_consumptions, validate_consumption_records
+from . import writebehind
+from .pagination import KeysetPaginationMixin, paginate_consumptions
 
 # Dashboard Views
+@sharding.district_view
 def dashboard(request):
-    # Get counts for summary statistics
-    total_students = Student.objects.count()
-    total_meals = Meal.objects.count()
-    total_consumptions = MealConsumption.objects.count()
-    
-    # Calculate total waste
-    total_waste = MealConsumption.objects.aggregate(Sum('waste_weight'))['waste_weight__sum'] or 0
-    
     # Get recent meals (last 7 days)
     recent_date = timezone.now().date() - timedelta(days=7)
     recent_meals = Meal.objects.filter(serving_date__gte=recent_date).order_by('-serving_date')
+
+    # Summary statistics come from the running counters, not table scans
+    if sharding.is_district():
+        # Every school's counters and recent menu, read concurrently; counts add up across schools
+        counts = {}
+        district_meals = []
+        per_school = sharding.fan_out(lambda: (counters.get_counts(), list(recent_meals.all())))
+        for school, (school_counts, meals) in per_school:
+            for name, value in school_counts.items():
+                counts[name] = counts.get(name, 0) + value
+            for meal in meals:
+                meal.school = school
+            district_meals.extend(meals)
+        recent_meals = sorted(district_meals, key=lambda meal: meal.serving_date, reverse=True)
+    else:
+        counts = counters.get_counts()
     
     context = {
-        'total_students': total_students,
-        'total_meals': total_meals,
-        'total_consumptions': total_consumptions,
-        'total_waste': round(total_waste, 2),
+        'total_students': int(counts[counters.STUDENTS]),
+        'total_meals': int(counts[counters.MEALS]),
+        'total_consumptions': int(counts[counters.CONSUMPTIONS]),
+        'total_waste': round(counts[counters.WASTE_WEIGHT], 2),
         'recent_meals': recent_meals,
     }
     
     return render(request, 'meals/dashboard.html', context)
 
 # Student Views
+STUDENT_INTAKE_DAYS = 28
+
 class StudentListView(ListView):
     model = Student
     template_name = 'meals/student_list.html'
@@ -53,9 +81,10 @@ class StudentListView(ListView):
             grade = form.cleaned_data.get('grade')
             
             if name:
-                queryset = queryset.filter(name__icontains=name)
+                # Full-text, prefix-aware search over name, student id and grade
+                queryset = search.ranked(search.search(queryset, name), 'name')
             if grade:
-                queryset = queryset.filter(grade__icontains=grade)
+                queryset = queryset.filter(grade=grade)
                 
         return queryset
 
@@ -66,10 +95,25 @@ class StudentDetailView(DetailView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        student = self.get_object()
+        student = self.object
         
-        # Get student's meal consumption history
-        context['consumptions'] = MealConsumption.objects.filter(student=student).order_by('-consumed_at')
+        # Get student's meal consumption history, one page at a time
+        page = paginate_consumptions(self.request, MealConsumption.objects.filter(student=student))
+        context['consumptions'] = page.object_list
+        context['page'] = page
+
+        # Nutrient intake over the last few weeks
+        context['intake_available'] = intake.is_available()
+        if context['intake_available']:
+            date_to = timezone.localdate()
+            date_from = date_to - timedelta(days=STUDENT_INTAKE_DAYS - 1)
+            student_intake = intake.compute_intake(date_from, date_to, student_ids=[student.pk])
+            context['intake_days'] = student_intake.daily_rows(student.pk)
+            _, week_starts, week_totals = student_intake.weekly()
+            context['intake_weeks'] = [
+                (week_start, dict(zip(intake.NUTRIENTS, totals)))
+                for week_start, totals in zip(week_starts, week_totals.tolist())
+            ]
         
         return context
 
@@ -103,70 +147,83 @@ class StudentDeleteView(DeleteView):
         return super().delete(request, *args, **kwargs)
 
 # Meal Views
+MEAL_LIST_PAGE_SIZE = 50
+
 class MealListView(ListView):
     model = Meal
     template_name = 'meals/meal_list.html'
     context_object_name = 'meal_list'
+    paginate_by = MEAL_LIST_PAGE_SIZE
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['search_form'] = MealSearchForm(self.request.GET or None)
-        
-        # Calculate calories for each meal (4cal/g protein & carbs, 9cal/g fat)
-        for meal in context['meal_list']:
-            meal.calories = 4 * (meal.protein + meal.carbohydrates) + 9 * meal.fats
-        
+        form = context['search_form'] = self.search_form
+        context['range_filters'] = [
+            (label, form[f'{field}_min'], form[f'{field}_max'])
+            for label, field in zip(['Calories (kcal)', 'Protein (%)', 'Carbs (%)', 'Fat (%)'], form.RANGE_FIELDS)
+        ]
         return context
     
     def get_queryset(self):
         queryset = super().get_queryset()
-        form = MealSearchForm(self.request.GET or None)
+        form = self.search_form = MealSearchForm(self.request.GET or None)
+        sort = None
         
         if form.is_valid():
+            q = form.cleaned_data.get('q')
             meal_type = form.cleaned_data.get('meal_type')
             date_from = form.cleaned_data.get('date_from')
             date_to = form.cleaned_data.get('date_to')
+            sort = form.cleaned_data.get('sort')
             
+            if q:
+                queryset = search.search(queryset, q)
             if meal_type:
                 queryset = queryset.filter(meal_type=meal_type)
             if date_from:
                 queryset = queryset.filter(serving_date__gte=date_from)
             if date_to:
                 queryset = queryset.filter(serving_date__lte=date_to)
+            # Calories and macro shares are stored columns, so ranges and sorts run in the database
+            for field in form.RANGE_FIELDS:
+                if form.cleaned_data.get(f'{field}_min') is not None:
+                    queryset = queryset.filter(**{f'{field}__gte': form.cleaned_data[f'{field}_min']})
+                if form.cleaned_data.get(f'{field}_max') is not None:
+                    queryset = queryset.filter(**{f'{field}__lte': form.cleaned_data[f'{field}_max']})
                 
-        return queryset.order_by('-serving_date')
+        if sort:
+            return queryset.order_by(sort, '-serving_date', '-id')
+        return search.ranked(queryset, '-serving_date', '-id')
 
-class MealDetailView(DetailView):
-    model = Meal
+class MealDetailView(View):
+    # Async: the meal, its rollup totals and its consumption page are fetched side by side
     template_name = 'meals/meal_detail.html'
-    context_object_name = 'meal'
-    
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        meal = self.get_object()
-        
-        # Get consumption data for this meal
-        consumptions = MealConsumption.objects.filter(meal=meal)
-        context['consumptions'] = consumptions
-        
-        # Calculate consumption statistics
-        total_consumptions = consumptions.count()
-        if total_consumptions > 0:
-            avg_portion = consumptions.aggregate(Avg('portion_consumed'))['portion_consumed__avg']
-            total_waste = consumptions.aggregate(Sum('waste_weight'))['waste_weight__sum'] or 0
-        else:
-            avg_portion = 0
-            total_waste = 0
-            
-        context['total_consumptions'] = total_consumptions
-        context['avg_portion'] = round(avg_portion, 2) if avg_portion else 0
-        context['total_waste'] = round(total_waste, 2)
-        
-        # Get consumption statistics for this meal
-        consumptions = MealConsumption.objects.filter(meal=meal)
-        context['consumptions'] = consumptions
-        
-        return context
+
+    async def get(self, request, pk):
+        meal, totals, page = await parallel.agather(
+            lambda: get_object_or_404(Meal, pk=pk),
+            # Consumption statistics come from the daily rollups, one row per serving day
+            lambda: MealDailyRollup.objects.filter(meal_id=pk).aggregate(
+                total_consumptions=Sum('consumption_count'),
+                portion_sum=Sum('portion_sum'),
+                total_waste=Sum('waste_sum'),
+            ),
+            lambda: paginate_consumptions(request, MealConsumption.objects.filter(meal_id=pk)),
+        )
+        total_consumptions = totals['total_consumptions'] or 0
+        avg_portion = totals['portion_sum'] / total_consumptions if total_consumptions else 0
+
+        context = {
+            'meal': meal,
+            'object': meal,
+            'total_consumptions': total_consumptions,
+            'avg_portion': round(avg_portion, 2),
+            'total_waste': round(totals['total_waste'] or 0, 2),
+            'consumptions': page.object_list,
+            'page': page,
+        }
+        # Rendering may touch the session and user, which only the sync ORM can load
+        return await sync_to_async(render)(request, self.template_name, context)
 
 class MealCreateView(CreateView):
     model = Meal
@@ -176,9 +233,7 @@ class MealCreateView(CreateView):
 
     def form_valid(self, form):
         try:
-            meal = form.save(commit=False)
-            # Calculate calories (4cal/g protein & carbs, 9cal/g fat)
-            meal.calories = int(4 * (meal.protein + meal.carbohydrates) + 9 * meal.fats)
+            # Calories are generated by the database from the macronutrients
             response = super().form_valid(form)
             messages.success(self.request, 'Meal created successfully!')
             return response
@@ -212,11 +267,10 @@ class MealDeleteView(DeleteView):
         return super().delete(request, *args, **kwargs)
 
 # Meal Consumption Views
-class MealConsumptionListView(ListView):
+class MealConsumptionListView(KeysetPaginationMixin, ListView):
     model = MealConsumption
     template_name = 'meals/consumption_list.html'
     context_object_name = 'consumptions'
-    ordering = ['-consumed_at']
 
 class MealConsumptionCreateView(CreateView):
     model = MealConsumption
@@ -225,165 +279,216 @@ class MealConsumptionCreateView(CreateView):
     success_url = reverse_lazy('consumption-list')
     
     def form_valid(self, form):
+        consumption = form.instance
+        conflicts = dietary.find_conflicts([(consumption.student_id, consumption.meal_id)])
+        for tags in conflicts.values():
+            # Recorded anyway: the student already has the tray, staff need to know about it
+            messages.warning(
+                self.request,
+                f'{consumption.student.name} is restricted from {", ".join(tags)}, '
+                f'which {consumption.meal.name} contains.',
+            )
+        if writebehind.is_enabled():
+            writebehind.get_queue().enqueue([form.instance])
+            messages.success(self.request, 'Meal consumption queued for recording!')
+            return redirect(self.success_url)
         messages.success(self.request, 'Meal consumption recorded successfully!')
         return super().form_valid(form)
 
+AUTOCOMPLETE_LIMIT = 20
+
+def student_autocomplete(request):
+    # Prefix search on name and student id through the full-text index; an empty box matches nothing
+    q = request.GET.get('q', '')
+    students = Student.objects.none()
+    if q.strip():
+        students = search.ranked(search.search(Student.objects.only('id', 'name', 'student_id'), q), 'name')
+    return JsonResponse({'results': [
+        {'id': student.pk, 'text': str(student)} for student in students[:AUTOCOMPLETE_LIMIT]
+    ]})
+
+def meal_autocomplete(request):
+    # Meals served on one day (today unless ?date= is given), optionally narrowed by ?q=
+    try:
+        day = parse_date(request.GET.get('date') or '') or timezone.localdate()
+    except ValueError:
+        day = None
+    if day is None:
+        return JsonResponse({'error': 'date must be YYYY-MM-DD.'}, status=400)
+    meals = search.search(Meal.objects.filter(serving_date=day).only('id', 'name', 'serving_date'),
+                          request.GET.get('q', ''))
+    return JsonResponse({'results': [
+        {'id': meal.pk, 'text': str(meal)} for meal in search.ranked(meals, 'meal_type', 'name')[:AUTOCOMPLETE_LIMIT]
+    ]})
+
+@csrf_exempt
+@require_POST
+def consumption_batch(request):
+    # Cafeteria line terminals post a JSON array of check-ins in one request
+    try:
+        records = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'Request body must be valid JSON.'}, status=400)
+
+    if isinstance(records, dict):
+        records = records.get('records')
+    if not isinstance(records, list):
+        return JsonResponse({'error': 'Expected a JSON array of consumption records.'}, status=400)
+    if len(records) > MAX_BATCH_RECORDS:
+        return JsonResponse({'error': f'A batch may contain at most {MAX_BATCH_RECORDS} records.'}, status=400)
+
+    consumptions, errors = validate_consumption_records(records)
+    conflicts = batch_conflicts(records, consumptions, errors)
+
+    if consumptions and writebehind.is_enabled():
+        # Acknowledge as soon as the records are durably queued; the flusher writes them in batches
+        writebehind.get_queue().enqueue(consumptions)
+        return JsonResponse({
+            'queued': len(consumptions),
+            'failed': len(errors),
+            'errors': errors,
+            'conflicts': conflicts,
+        }, status=202)
+
+    created = bulk_insert_consumptions(consumptions) if consumptions else []
+
+    return JsonResponse({
+        'created': len(created),
+        'failed': len(errors),
+        'errors': errors,
+        'conflicts': conflicts,
+    }, status=201 if created else 400 if errors else 200)
+
+def batch_conflicts(records, consumptions, errors):
+    """Dietary conflicts among the accepted records of a batch, reported by record index."""
+    found = dietary.find_conflicts((c.student_id, c.meal_id) for c in consumptions)
+    if not found:
+        return []
+    # Accepted consumptions keep the order of the records that had no errors
+    rejected = {error['index'] for error in errors}
+    indexes = [index for index in range(len(records)) if index not in rejected]
+    conflicts = []
+    for index, consumption in zip(indexes, consumptions):
+        tags = found.get((consumption.student_id, consumption.meal_id))
+        if tags:
+            conflicts.append({
+                'index': index,
+                'student_id': records[index]['student_id'],
+                'meal': consumption.meal_id,
+                'restrictions': tags,
+            })
+    return conflicts
+
+# School picker
+@sharding.district_view
+def school_select(request):
+    # The lists, forms and exports of the district view need a school; each choice goes back to the page asked for
+    next_url = request.GET.get('next', '')
+    if not url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
+        next_url = reverse('dashboard')
+    parts = urlsplit(next_url)
+    choices = []
+    for school in sharding.schools():
+        query = QueryDict(parts.query, mutable=True)
+        query['school'] = school.code
+        choices.append((school, urlunsplit(parts._replace(query=query.urlencode()))))
+    return render(request, 'meals/school_select.html', {'choices': choices})
+
 # Reports Views
-def nutrition_report(request):
-    # Get all meals
-    meals = Meal.objects.all()
-    
-    # Calculate average nutritional values
-    avg_values = meals.aggregate(
-        Avg('calories'),
-        Avg('protein'),
-        Avg('carbohydrates'),
-        Avg('fats')
-    )
-    
-    # Meal type analysis
-    meal_type_analysis = meals.values('meal_type').annotate(
-        avg_calories=Avg('calories'),
-        avg_protein=Avg('protein'),
-        avg_carbs=Avg('carbohydrates'),
-        avg_fats=Avg('fats'),
-        total_meals=Count('id')
-    ).order_by('meal_type')
-    
-    context = {
-        'meals': meals,
-        'avg_calories': round(avg_values['calories__avg'] or 0, 1),
-        'avg_protein': round(avg_values['protein__avg'] or 0, 1),
-        'avg_carbs': round(avg_values['carbohydrates__avg'] or 0, 1),
-        'avg_fats': round(avg_values['fats__avg'] or 0, 1),
-        'meal_type_analysis': meal_type_analysis
-    }
-    
-    return render(request, 'meals/nutrition_report.html', context)
-    
-    # Calculate averages by meal type
-    breakfast_avg = {
-        'calories': breakfast_meals.aggregate(Avg('calories'))['calories__avg'] or 0,
-        'protein': breakfast_meals.aggregate(Avg('protein'))['protein__avg'] or 0,
-        'carbs': breakfast_meals.aggregate(Avg('carbohydrates'))['carbohydrates__avg'] or 0,
-        'fats': breakfast_meals.aggregate(Avg('fats'))['fats__avg'] or 0,
-    }
-    
-    lunch_avg = {
-        'calories': lunch_meals.aggregate(Avg('calories'))['calories__avg'] or 0,
-        'protein': lunch_meals.aggregate(Avg('protein'))['protein__avg'] or 0,
-        'carbs': lunch_meals.aggregate(Avg('carbohydrates'))['carbohydrates__avg'] or 0,
-        'fats': lunch_meals.aggregate(Avg('fats'))['fats__avg'] or 0,
-    }
-    
-    snack_avg = {
-        'calories': snack_meals.aggregate(Avg('calories'))['calories__avg'] or 0,
-        'protein': snack_meals.aggregate(Avg('protein'))['protein__avg'] or 0,
-        'carbs': snack_meals.aggregate(Avg('carbohydrates'))['carbohydrates__avg'] or 0,
-        'fats': snack_meals.aggregate(Avg('fats'))['fats__avg'] or 0,
-    }
-    
-    # Calculate additional nutritional metrics
-    average_fiber = meals.aggregate(Avg('fiber'))['fiber__avg'] or 0
-    average_sodium = meals.aggregate(Avg('sodium'))['sodium__avg'] or 0
-    average_sugar = meals.aggregate(Avg('sugar'))['sugar__avg'] or 0
-    average_iron = meals.aggregate(Avg('iron'))['iron__avg'] or 0
-
-    # Prepare meal type analysis
-    meal_type_analysis = [
-        {
-            'name': 'Breakfast',
-            'avg_calories': breakfast_meals.aggregate(Avg('calories'))['calories__avg'] or 0,
-            'avg_protein': breakfast_meals.aggregate(Avg('protein'))['protein__avg'] or 0,
-            'avg_carbs': breakfast_meals.aggregate(Avg('carbohydrates'))['carbohydrates__avg'] or 0,
-            'avg_fats': breakfast_meals.aggregate(Avg('fats'))['fats__avg'] or 0,
-            'common_items': ', '.join(breakfast_meals.values_list('name', flat=True)[:3])
-        },
-        {
-            'name': 'Lunch',
-            'avg_calories': lunch_meals.aggregate(Avg('calories'))['calories__avg'] or 0,
-            'avg_protein': lunch_meals.aggregate(Avg('protein'))['protein__avg'] or 0,
-            'avg_carbs': lunch_meals.aggregate(Avg('carbohydrates'))['carbohydrates__avg'] or 0,
-            'avg_fats': lunch_meals.aggregate(Avg('fats'))['fats__avg'] or 0,
-            'common_items': ', '.join(lunch_meals.values_list('name', flat=True)[:3])
-        },
-        {
-            'name': 'Snack',
-            'avg_calories': snack_meals.aggregate(Avg('calories'))['calories__avg'] or 0,
-            'avg_protein': snack_meals.aggregate(Avg('protein'))['protein__avg'] or 0,
-            'avg_carbs': snack_meals.aggregate(Avg('carbohydrates'))['carbohydrates__avg'] or 0,
-            'avg_fats': snack_meals.aggregate(Avg('fats'))['fats__avg'] or 0,
-            'common_items': ', '.join(snack_meals.values_list('name', flat=True)[:3])
-        }
-    ]
-
-    # Define dietary requirements and calculate compliance
-    dietary_requirements = [
-        {
-            'name': 'Balanced Protein Intake',
-            'compliance': min(100, (avg_protein / 50) * 100),
-            'description': 'Daily protein intake should be at least 50g'
-        },
-        {
-            'name': 'Controlled Sugar',
-            'compliance': max(0, 100 - (average_sugar / 30) * 100),
-            'description': 'Daily sugar intake should be below 30g'
-        },
-        {
-            'name': 'Adequate Fiber',
-            'compliance': min(100, (average_fiber / 25) * 100),
-            'description': 'Daily fiber intake should be at least 25g'
-        }
-    ]
+def render_report_job(request, title, job):
+    # The report's first result is still being computed by run_report_worker; the page polls until it is done
+    return render(request, 'meals/report_job.html', {'title': title, 'job': jobs.job_state(job)}, status=202)
 
-    context = {
-        'avg_calories': round(avg_calories, 1),
-        'avg_protein': round(avg_protein, 1),
-        'avg_carbs': round(avg_carbs, 1),
-        'avg_fats': round(avg_fats, 1),
-        'breakfast_avg': {k: round(v, 1) for k, v in breakfast_avg.items()},
-        'lunch_avg': {k: round(v, 1) for k, v in lunch_avg.items()},
-        'snack_avg': {k: round(v, 1) for k, v in snack_avg.items()},
-        'meals': meals,
-        'average_fiber': round(average_fiber, 1),
-        'average_sodium': round(average_sodium, 1),
-        'average_sugar': round(average_sugar, 1),
-        'average_iron': round(average_iron, 1),
-        'meal_type_analysis': meal_type_analysis,
-        'dietary_requirements': dietary_requirements
-    }
-    
-    return render(request, 'meals/nutrition_report.html', context)
+@sharding.district_view
+async def nutrition_report(request):
+    # Averages and the meal list come from a report job, or from the versioned report cache when no worker runs
+    # With no school selected, every school's share is read concurrently and merged
+    context, job = await sync_to_async(jobs.report_for_view)('nutrition', {})
+    if context is None:
+        return await sync_to_async(render_report_job)(request, 'Nutrition Report', job)
+    return await sync_to_async(render)(request, 'meals/nutrition_report.html', {**context, 'updating': job})
 
+WASTE_REPORT_PAGE_SIZE = 50
+
+@sharding.district_view
 def waste_report(request):
-    # Get all consumptions
-    consumptions = MealConsumption.objects.all()
-    
-    # Calculate total waste
-    total_waste = consumptions.aggregate(Sum('waste_weight'))['waste_weight__sum'] or 0
-    
-    # Calculate average waste per meal
-    avg_waste_per_meal = consumptions.values('meal').annotate(
-        avg_waste=Avg('waste_weight'),
-        total_waste=Sum('waste_weight'),
-        count=Count('id')
-    ).order_by('-avg_waste')
-    
-    # Get meals with highest waste
-    meals_with_waste = []
-    for item in avg_waste_per_meal:
-        meal = Meal.objects.get(id=item['meal'])
-        meals_with_waste.append({
-            'meal': meal,
-            'avg_waste': round(item['avg_waste'] or 0, 2),
-            'total_waste': round(item['total_waste'] or 0, 2),
-            'count': item['count']
-        })
-    
+    form = WasteReportForm(request.GET or None)
+    filters = form.cleaned_data if form.is_valid() else {}
+    date_from = filters.get('date_from')
+    date_to = filters.get('date_to')
+    grade = filters.get('grade')
+    meal_type = filters.get('meal_type')
+
+    consumptions = exports.filter_consumptions(MealConsumption.objects.all(), date_from, date_to, meal_type)
+    if grade:
+        consumptions = consumptions.filter(student__grade=grade)
+
+    # Totals and the per-meal table come from a report job or the report cache; the records page is always live
+    summary, job = jobs.report_for_view(
+        'waste', {'date_from': date_from, 'date_to': date_to, 'grade': grade, 'meal_type': meal_type})
+    if summary is None:
+        return render_report_job(request, 'Food Waste Report', job)
+
+    district = sharding.is_district()
     context = {
-        'total_waste': round(total_waste, 2),
-        'meals_with_waste': meals_with_waste,
-        'consumptions': consumptions,
+        'form': form,
+        **summary,
+        'district': district,
+        'updating': job,
     }
+    # Records are browsed one school at a time
+    if not district:
+        page = paginate_consumptions(request, consumptions, WASTE_REPORT_PAGE_SIZE)
+        context.update({'consumptions': page.object_list, 'page': page})
     
     return render(request, 'meals/waste_report.html', context)
+
+INTAKE_REPORT_PAGE_SIZE = 50
+
+@sharding.district_view
+def intake_report(request):
+    form = IntakeReportForm(request.GET or None)
+    context = {'form': form, 'available': intake.is_available()}
+    if not context['available']:
+        return render(request, 'meals/intake_report.html', context)
+
+    filters = form.cleaned_data if form.is_valid() else {}
+    date_from, date_to = intake.default_period(filters.get('date_from'), filters.get('date_to'))
+    summary, job = jobs.report_for_view(
+        'intake', {'date_from': date_from, 'date_to': date_to, 'grade': filters.get('grade')})
+    if summary is None:
+        return render_report_job(request, 'Nutrient Intake Report', job)
+
+    # Lowest average daily calories first, so under-eating students lead the report
+    page = Paginator(summary['lowest_intake'], INTAKE_REPORT_PAGE_SIZE).get_page(request.GET.get('page'))
+    context.update({
+        # A job's result holds the period as strings
+        'date_from': date_from,
+        'date_to': date_to,
+        'student_count': summary['student_count'],
+        'student_days': summary['student_days'],
+        'school_average': summary['school_average'],
+        'rows': page.object_list,
+        'page': page,
+        'updating': job,
+    })
+    return render(request, 'meals/intake_report.html', context)
+
+# Export Views
+def export_data(request, dataset):
+    form = ExportForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    fmt = form.cleaned_data.get('format') or 'csv'
+    rows_func, fields = exports.EXPORTS[dataset]
+    rows = rows_func(
+        date_from=form.cleaned_data.get('date_from'),
+        date_to=form.cleaned_data.get('date_to'),
+        meal_type=form.cleaned_data.get('meal_type'),
+    )
+
+    content_type = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+    response = StreamingHttpResponse(exports.render(rows, fields, fmt), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{dataset}.{fmt}"'
+    return response
@@ -0,0 +1,286 @@
+"""Write-behind queue for MealConsumption inserts.
+
+When ``MEALS_WRITE_BEHIND`` is enabled, accepted check-ins are appended to a
+per-process log file under ``MEALS_WRITE_BEHIND_DIR`` and acknowledged
+immediately.  A background thread drains the log into the database in
+batched transactions, so terminals no longer wait on the SQLite write lock.
+Logs left behind by a stopped process are drained by ``flush_consumptions``.
+The idempotency keys of queued kiosk pushes are remembered until they are
+written, so a replayed push is recognised before the roster, which already
+counts the queued check-ins as served, refuses it.
+Each school database (see ``meals.sharding``) has its own queue and log
+directory.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, router, transaction
+from django.utils.dateparse import parse_datetime
+
+from . import roster, sharding
+from .batch import INSERT_BATCH_SIZE, bulk_insert_consumptions
+from .models import Student, Meal, MealConsumption
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows development servers run a single process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_queues = {}
+_queue_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'MEALS_WRITE_BEHIND', False)
+
+
+def get_log_dir():
+    log_dir = Path(getattr(settings, 'MEALS_WRITE_BEHIND_DIR', Path(settings.BASE_DIR) / 'var' / 'write-behind'))
+    database = router.db_for_write(MealConsumption)
+    return log_dir if database == 'default' else log_dir / database
+
+
+def _lock(handle):
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+
+
+def _serialize(consumption):
+    return json.dumps({
+        'student': consumption.student_id,
+        'meal': consumption.meal_id,
+        'consumed_at': consumption.consumed_at.isoformat(),
+        'portion_consumed': consumption.portion_consumed,
+        'waste_weight': consumption.waste_weight,
+        'key': consumption.idempotency_key,
+    })
+
+
+def _deserialize(line):
+    data = json.loads(line)
+    return MealConsumption(
+        student_id=data['student'],
+        meal_id=data['meal'],
+        consumed_at=parse_datetime(data['consumed_at']),
+        portion_consumed=data['portion_consumed'],
+        waste_weight=data['waste_weight'],
+        idempotency_key=data.get('key'),
+    )
+
+
+def _write_chunk(consumptions):
+    with transaction.atomic(using=router.db_for_write(MealConsumption)):
+        # Replaying a segment after a crash must not insert the same check-in twice
+        existing = set(MealConsumption.objects.filter(
+            consumed_at__in={c.consumed_at for c in consumptions},
+        ).values_list('student_id', 'meal_id', 'consumed_at'))
+        # A kiosk replaying its outbox before the flush queues the same keyed check-in twice
+        keys = set(MealConsumption.objects.filter(
+            idempotency_key__in={c.idempotency_key for c in consumptions if c.idempotency_key},
+        ).values_list('idempotency_key', flat=True))
+        students = set(Student.objects.filter(
+            id__in={c.student_id for c in consumptions},
+        ).values_list('id', flat=True))
+        meals = set(Meal.objects.filter(id__in={c.meal_id for c in consumptions}).values_list('id', flat=True))
+
+        pending = []
+        for consumption in consumptions:
+            if (consumption.student_id, consumption.meal_id, consumption.consumed_at) in existing:
+                continue
+            if consumption.idempotency_key in keys:
+                continue
+            if consumption.student_id not in students or consumption.meal_id not in meals:
+                logger.warning('Dropping queued consumption for a deleted student or meal: %s', _serialize(consumption))
+                continue
+            pending.append(consumption)
+            if consumption.idempotency_key:
+                keys.add(consumption.idempotency_key)
+        if pending:
+            bulk_insert_consumptions(pending)
+        return len(pending)
+
+
+def drain_segment(path):
+    """Write every record of a rotated log segment to the database, then delete it."""
+    written = 0
+    chunk = []
+    try:
+        handle = open(path, encoding='utf-8')
+    except FileNotFoundError:
+        # Another drainer got to this segment first
+        return 0
+    with handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                chunk.append(_deserialize(line))
+            except (ValueError, KeyError, TypeError):
+                logger.error('Skipping unreadable write-behind record in %s: %r', path, line)
+                continue
+            if len(chunk) >= INSERT_BATCH_SIZE:
+                written += _write_chunk(chunk)
+                chunk = []
+    if chunk:
+        written += _write_chunk(chunk)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    return written
+
+
+def rotate(log_path):
+    """Atomically move a live log aside so it can be drained; returns the segment path or None."""
+    if not os.path.exists(log_path):
+        return None
+    try:
+        handle = open(log_path, 'a', encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    with handle:
+        _lock(handle)
+        if not os.path.exists(log_path) or os.path.getsize(log_path) == 0:
+            return None
+        segment = log_path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.flushing')
+        os.replace(log_path, segment)
+    return segment
+
+
+def drain_directory(log_dir=None):
+    """Drain every log and leftover segment in the write-behind directory.
+
+    Without a directory, in the district view, every school's directory is
+    drained into that school's database.
+    """
+    if log_dir is None and sharding.is_district():
+        return sum(written for _, written in sharding.fan_out(drain_directory))
+    log_dir = Path(log_dir or get_log_dir())
+    if not log_dir.exists():
+        return 0
+    written = 0
+    for segment in sorted(log_dir.glob('*.flushing')):
+        written += drain_segment(segment)
+    for log_path in sorted(log_dir.glob('*.log')):
+        segment = rotate(log_path)
+        if segment is not None:
+            written += drain_segment(segment)
+    return written
+
+
+class WriteBehindQueue:
+    def __init__(self, log_dir, interval=1.0, database=None):
+        self.log_dir = Path(log_dir)
+        # The flusher thread does not inherit the enqueuing request's school
+        self.database = database
+        self.log_path = self.log_dir / f'consumptions-{os.getpid()}.log'
+        self.interval = interval
+        self._append_lock = threading.Lock()
+        # Idempotency keys enqueued by this process and not yet known to be written
+        self._pending_keys = set()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._registered = False
+
+    def enqueue(self, consumptions):
+        lines = ''.join(_serialize(c) + '\n' for c in consumptions)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        with self._append_lock:
+            while True:
+                with open(self.log_path, 'a', encoding='utf-8') as handle:
+                    _lock(handle)
+                    # A concurrent rotate may have moved the file between open() and the lock
+                    try:
+                        current = os.stat(self.log_path).st_ino
+                    except FileNotFoundError:
+                        continue
+                    if os.fstat(handle.fileno()).st_ino == current:
+                        handle.write(lines)
+                        handle.flush()
+                        os.fsync(handle.fileno())
+                        break
+            self._pending_keys.update(c.idempotency_key for c in consumptions if c.idempotency_key)
+        # Queued check-ins count as served, so a second tray is refused before the flush
+        roster.mark_served((c.student_id, c.meal_id) for c in consumptions)
+        self.start()
+        self._wakeup.set()
+
+    def queued_keys(self, keys):
+        """The ones of ``keys`` enqueued here and not written yet."""
+        with self._append_lock:
+            return self._pending_keys.intersection(keys)
+
+    def flush(self):
+        with self._flush_lock, sharding.use_database(self.database):
+            with self._append_lock:
+                # Every one of these is in the log rotated below, or in a segment left by an earlier flush
+                flushing = set(self._pending_keys)
+            # Segments left by a failed flush are retried before new records
+            written = 0
+            for segment in sorted(self.log_dir.glob(f'{self.log_path.stem}.*.flushing')):
+                written += drain_segment(segment)
+            segment = rotate(self.log_path)
+            if segment is not None:
+                written += drain_segment(segment)
+            with self._append_lock:
+                self._pending_keys -= flushing
+            return written
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='meals-write-behind', daemon=True)
+        self._thread.start()
+        if not self._registered:
+            # Drain whatever is still queued when the worker process exits cleanly
+            atexit.register(self.stop)
+            self._registered = True
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed; records stay in %s', self.log_dir)
+            finally:
+                close_old_connections()
+
+
+def queued_keys(keys):
+    """The ones of ``keys`` waiting in this process's queue for the current school database."""
+    if not is_enabled():
+        return set()
+    return get_queue().queued_keys(keys)
+
+
+def get_queue():
+    database = router.db_for_write(MealConsumption)
+    with _queue_lock:
+        queue = _queues.get(database)
+        if queue is None:
+            queue = _queues[database] = WriteBehindQueue(
+                get_log_dir(),
+                interval=getattr(settings, 'MEALS_WRITE_BEHIND_FLUSH_INTERVAL', 1.0),
+                database=database,
+            )
+        return queue
@@ -2,6 +2,9 @@
 ASGI config for school_lunch_system project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serving it with an ASGI server (e.g. ``uvicorn school_lunch_system.asgi:application``)
+is supported alongside WSGI; the meal detail and nutrition report views are async
+and run their independent queries concurrently.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -0,0 +1,188 @@
+"""Per-request performance instrumentation.
+
+``RequestMetricsMiddleware`` records, per resolved view, a latency histogram,
+the number and total duration of database queries (captured with
+``connection.execute_wrapper``) and response sizes.  Everything is kept in
+process memory with a fixed number of series, and ``metrics_view`` exposes it
+in the Prometheus text format.  Requests slower than
+``SLOW_REQUEST_THRESHOLD_MS`` are logged together with their slowest SQL.
+"""
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger('school_lunch_system.slow_requests')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Distinct view labels kept before new views are folded into "other"
+MAX_VIEWS = 200
+
+# SQL statements remembered per request for the slow-request log
+MAX_CAPTURED_QUERIES = 100
+
+
+class ViewStats:
+    __slots__ = ('buckets', 'count', 'latency_sum', 'query_count', 'query_time', 'response_bytes', 'statuses')
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.query_count = 0
+        self.query_time = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+
+class MetricsRegistry:
+    def __init__(self, max_views=MAX_VIEWS):
+        self.max_views = max_views
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def observe(self, view, status, latency, query_count, query_time, response_bytes):
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                if len(self._views) >= self.max_views:
+                    view = 'other'
+                stats = self._views.setdefault(view, ViewStats())
+            stats.count += 1
+            stats.latency_sum += latency
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.buckets[index] += 1
+                    break
+            stats.query_count += query_count
+            stats.query_time += query_time
+            stats.response_bytes += response_bytes
+            status_class = f'{status // 100}xx'
+            stats.statuses[status_class] = stats.statuses.get(status_class, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                view: {
+                    'buckets': list(stats.buckets),
+                    'count': stats.count,
+                    'latency_sum': stats.latency_sum,
+                    'query_count': stats.query_count,
+                    'query_time': stats.query_time,
+                    'response_bytes': stats.response_bytes,
+                    'statuses': dict(stats.statuses),
+                }
+                for view, stats in self._views.items()
+            }
+
+    def render_prometheus(self):
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP http_request_duration_seconds Time spent producing the response, by view.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for view, stats in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{view="{view}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'http_request_duration_seconds_sum{{view="{view}"}} {stats["latency_sum"]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{view="{view}"}} {stats["count"]}')
+
+        counters = [
+            ('db_queries_total', 'Database queries executed, by view.', 'query_count', '{}'),
+            ('db_query_duration_seconds_total', 'Time spent in database queries, by view.', 'query_time', '{:.6f}'),
+            ('http_response_size_bytes_total', 'Bytes of non-streaming response bodies, by view.',
+             'response_bytes', '{}'),
+        ]
+        for name, help_text, key, fmt in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for view, stats in sorted(snapshot.items()):
+                lines.append(f'{name}{{view="{view}"}} {fmt.format(stats[key])}')
+
+        lines.append('# HELP http_responses_total Responses by view and status class.')
+        lines.append('# TYPE http_responses_total counter')
+        for view, stats in sorted(snapshot.items()):
+            for status_class, count in sorted(stats['statuses'].items()):
+                lines.append(f'http_responses_total{{view="{view}",status="{status_class}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class QueryRecorder:
+    """``execute_wrapper`` hook that counts and times every query of a request."""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.count = 0
+        self.duration = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+            if len(self.queries) < MAX_CAPTURED_QUERIES:
+                self.queries.append((elapsed, self.alias, sql))
+
+
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorders = [QueryRecorder(alias) for alias in connections]
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for recorder in recorders:
+                stack.enter_context(connections[recorder.alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+        latency = time.perf_counter() - started
+
+        view = view_label(request)
+        query_count = sum(r.count for r in recorders)
+        query_time = sum(r.duration for r in recorders)
+        size = 0 if response.streaming else len(response.content)
+        registry.observe(view, response.status_code, latency, query_count, query_time, size)
+
+        slow_threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD_MS', None)
+        if slow_threshold is not None and latency * 1000 >= slow_threshold:
+            slowest = sorted((q for r in recorders for q in r.queries), reverse=True)[:5]
+            logger.warning(
+                'Slow request: %s %s (view %s) took %.1f ms with %d queries (%.1f ms in SQL)%s',
+                request.method, request.path, view, latency * 1000, query_count, query_time * 1000,
+                ''.join(f'\n  [{elapsed * 1000:.1f} ms, {alias}] {sql}' for elapsed, alias, sql in slowest),
+            )
+        return response
+
+
+def metrics_view(request):
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if request.META.get('REMOTE_ADDR') not in allowed and not request.user.is_staff:
+        return HttpResponseForbidden('Metrics are only available to allowed hosts and staff.')
+    return HttpResponse(registry.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,141 @@
+"""On-demand, staff-only request profiling.
+
+A staff user adds ``?profile=1`` to a URL (or sends an ``X-Profile: 1``
+header) and ``ProfilingMiddleware`` runs the rest of the request under
+cProfile.  Functions the request runs on the ``meals.parallel`` query pool
+are profiled in their worker threads and merged into the request's stats, so
+the queries of the async views show up too.  The stats are saved to
+``PROFILE_DIR`` with a small JSON sidecar, and ``profile_index``/
+``profile_detail`` list and display them.
+"""
+import cProfile
+import io
+import json
+import pstats
+import re
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404
+from django.shortcuts import render
+from django.utils import timezone
+
+from meals import parallel
+
+SORT_KEYS = ['cumulative', 'tottime', 'ncalls']
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def get_profile_dir():
+    return Path(getattr(settings, 'PROFILE_DIR', Path(settings.BASE_DIR) / 'var' / 'profiles'))
+
+
+def profiling_requested(request):
+    if not getattr(settings, 'PROFILING_ENABLED', True):
+        return False
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_staff:
+        return False
+    return request.GET.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+
+
+def prune(profile_dir, keep):
+    sidecars = sorted(profile_dir.glob('*.json'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for sidecar in sidecars[keep:]:
+        sidecar.with_suffix('.prof').unlink(missing_ok=True)
+        sidecar.unlink(missing_ok=True)
+
+
+def load_profiles(profile_dir):
+    profiles = []
+    for sidecar in profile_dir.glob('*.json'):
+        try:
+            profiles.append(json.loads(sidecar.read_text(encoding='utf-8')))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+class ProfilingMiddleware:
+    """Must come after AuthenticationMiddleware so ``request.user`` is available."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profiling_requested(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        worker_profilers = []
+
+        def profile_worker(function):
+            worker_profiler = cProfile.Profile()
+            try:
+                return worker_profiler.runcall(function)
+            finally:
+                worker_profilers.append(worker_profiler)
+
+        token = parallel.worker_wrapper.set(profile_worker)
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+            # Render lazily-rendered responses inside the profile too
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+        finally:
+            profiler.disable()
+            parallel.worker_wrapper.reset(token)
+        duration = time.perf_counter() - started
+
+        profile_dir = get_profile_dir()
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        profile_id = uuid.uuid4().hex
+        stats = pstats.Stats(profiler)
+        for worker_profiler in worker_profilers:
+            stats.add(worker_profiler)
+        stats.dump_stats(profile_dir / f'{profile_id}.prof')
+        match = getattr(request, 'resolver_match', None)
+        (profile_dir / f'{profile_id}.json').write_text(json.dumps({
+            'id': profile_id,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 2),
+            'created': timezone.now().isoformat(),
+        }), encoding='utf-8')
+        prune(profile_dir, getattr(settings, 'PROFILE_MAX_FILES', 200))
+
+        response['X-Profile-Id'] = profile_id
+        return response
+
+
+@staff_member_required
+def profile_index(request):
+    profiles = sorted(load_profiles(get_profile_dir()), key=lambda p: p['duration_ms'], reverse=True)
+    return render(request, 'profiling/index.html', {'profiles': profiles})
+
+
+@staff_member_required
+def profile_detail(request, profile_id):
+    profile_dir = get_profile_dir()
+    if not PROFILE_ID.match(profile_id) or not (profile_dir / f'{profile_id}.prof').exists():
+        raise Http404('Profile not found')
+
+    sort = request.GET.get('sort') if request.GET.get('sort') in SORT_KEYS else SORT_KEYS[0]
+    output = io.StringIO()
+    stats = pstats.Stats(str(profile_dir / f'{profile_id}.prof'), stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(60)
+    meta = json.loads((profile_dir / f'{profile_id}.json').read_text(encoding='utf-8'))
+
+    return render(request, 'profiling/detail.html', {
+        'profile': meta,
+        'stats': output.getvalue(),
+        'sort': sort,
+        'sort_keys': SORT_KEYS,
+    })
@@ -41,11 +41,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'school_lunch_system.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'meals.sharding.SchoolMiddleware',
+    'school_lunch_system.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -55,7 +58,7 @@ ROOT_URLCONF = 'school_lunch_system.urls'
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [],
+        'DIRS': [BASE_DIR / 'school_lunch_system' / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
@@ -77,8 +80,76 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Wait for the write lock instead of failing with "database is locked"
+            'timeout': 20,
+        },
+    }
+}
+
+# Schools kept in databases of their own (see meals/sharding.py): school code -> SQLite
+# file. Each becomes the `school_<code>` alias; add a School row with the same code
+# and create its tables with `manage.py migrate --database school_<code>`.
+MEALS_SCHOOL_DATABASES = {}
+for _code, _path in MEALS_SCHOOL_DATABASES.items():
+    DATABASES['school_' + _code] = {**DATABASES['default'], 'NAME': _path}
+
+DATABASE_ROUTERS = ['meals.sharding.SchoolRouter']
+
+# Write-behind mode for consumption check-ins: records are appended to a local
+# log and written to the database in batches by a background flusher.
+# Drain leftover logs with `manage.py flush_consumptions`.
+MEALS_WRITE_BEHIND = False
+MEALS_WRITE_BEHIND_DIR = BASE_DIR / 'var' / 'write-behind'
+MEALS_WRITE_BEHIND_FLUSH_INTERVAL = 1.0
+
+# Per-process roster of today's students, menu and served trays used by check-ins
+# (see meals/roster.py); other processes' writes are picked up this often, in seconds.
+MEALS_SERVING_ROSTER = True
+MEALS_ROSTER_RECHECK_INTERVAL = 2.0
+
+# Threads running the independent queries of a report or detail page side by side
+# (see meals/parallel.py); 0 runs them one after another. The async views benefit
+# most when served through school_lunch_system.asgi:application. Workers close their
+# connections after each call unless the database sets CONN_MAX_AGE.
+MEALS_QUERY_POOL_SIZE = 4
+
+# Report jobs computed by `manage.py run_report_worker` (see meals/jobs.py): seconds a
+# running job may take before another worker queues it again, and seconds finished
+# jobs are kept. While a worker has checked the queue within the last
+# MEALS_REPORT_WORKER_HEARTBEAT seconds, the report pages queue jobs instead of
+# computing the reports in the web process.
+MEALS_REPORT_JOB_TIMEOUT = 30 * 60
+MEALS_REPORT_JOB_RETENTION = 7 * 24 * 60 * 60
+MEALS_REPORT_WORKER_HEARTBEAT = 30
+
+# Column files of consumptions moved out of the live table by archive_term
+MEALS_ARCHIVE_DIR = BASE_DIR / 'var' / 'archive'
+
+
+# Request instrumentation (see school_lunch_system/metrics.py).
+# Requests slower than this are logged with their slowest SQL; None disables the log.
+SLOW_REQUEST_THRESHOLD_MS = 1000
+# Clients allowed to scrape /metrics/ without a staff login
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# On-demand profiling: staff add ?profile=1 (or send X-Profile: 1) to a request,
+# and the saved profiles are listed at /profiles/.
+PROFILING_ENABLED = True
+PROFILE_DIR = BASE_DIR / 'var' / 'profiles'
+PROFILE_MAX_FILES = 200
+
+# Report results are cached on disk, shared by all server processes and warm_report_cache,
+# and invalidated by data versions kept in the database
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'var' / 'cache',
     }
 }
+REPORT_CACHE_TIMEOUT = 24 * 60 * 60
+# Seconds an out-of-date report may still be served while it is recomputed in the background
+REPORT_CACHE_MAX_STALE = 60
 
 
 # Password validation
@@ -18,8 +18,14 @@ from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import RedirectView
 
+from .metrics import metrics_view
+from .profiling import profile_detail, profile_index
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('meals/', include('meals.urls')),
+    path('metrics/', metrics_view, name='metrics'),
+    path('profiles/', profile_index, name='profile-index'),
+    path('profiles/<str:profile_id>/', profile_detail, name='profile-detail'),
     path('', RedirectView.as_view(url='meals/', permanent=True)),
 ]